@@ -17,15 +17,124 @@ __license__ = "Python"
 
 import math
 import copy
+import hashlib
+import multiprocessing
+import sys
+import contextlib
+import functools
+import heapq
+import timeit
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #Define exceptions
 class MetricMakerError(Exception): pass
 class TooManyEmptyValues(MetricMakerError): pass
 class TimePointsMismatchWithTimeCourse(MetricMakerError): pass
 class UnknownError(MetricMakerError): pass
+class UnknownEngine(MetricMakerError): pass
+class UnknownMissingValuePolicy(MetricMakerError): pass
+class EmptyValueAppended(MetricMakerError): pass
+
+# metric_select order used by generate
+METRIC_NAMES = ['mean', 'AUC_whole', 'Max', 'Equilibrium', 'Derivative', 'Data_Points',
+                'AUC_peak', 'ActivationSlope_peak', 'DecayRate_peak']
+
+class TimeCourse(object):
+    """
+     Compact timecourse for large panels (requires numpy).
+     Input format: TimeCourse(values, time_points, label)
+
+     values:
+     An array of length N, empty values given as None or nan.  Values are kept in one
+     contiguous float64 buffer with nan in the empty positions, and a packed bitmask
+     (one bit per timepoint) records which positions are empty.
+
+     time_points:
+     Optional array of length N.  A float64 numpy array is used without copying, so one
+     array of time points can be shared by every timecourse measured on the same grid.
+
+     label:
+     Optional TC_label of the timecourse.
+
+     Slicing with a step of 1 returns a TimeCourse view sharing the buffers of the original
+     (e.g. for the window around a peak).  Indexing and iterating give floats and None for
+     empty values, like the plain lists.  diff, trapz, mean, find, peak_finder and generate
+     accept a TimeCourse in place of a list.
+    """
+    __slots__ = ('values', 'time_points', 'label', 'bits', 'offset')
+
+    def __init__(self, values, time_points=None, label=None):
+        self.values = numpy.asarray(values, dtype=float)
+        if time_points is not None:
+            time_points = numpy.asarray(time_points, dtype=float)
+            if len(time_points) != len(self.values):
+                raise TimePointsMismatchWithTimeCourse, "time course has %d values but %d time points were given." % (len(self.values), len(time_points))
+        self.time_points = time_points
+        self.label = label
+        self.bits = numpy.packbits(numpy.isnan(self.values))
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            value = self.values[index]
+            return None if value != value else float(value)
+        start, stop, step = index.indices(len(self.values))
+        if step != 1:
+            raise ValueError, "TimeCourse views need a step of 1"
+        stop = max(start, stop)
+        view = TimeCourse.__new__(TimeCourse)
+        view.values = self.values[start:stop]
+        view.time_points = None if self.time_points is None else self.time_points[start:stop]
+        view.label = self.label
+        view.bits = self.bits
+        view.offset = self.offset + start
+        return view
+
+    def missing(self):
+        "Returns a boolean array which is True for the empty values"
+        return numpy.unpackbits(self.bits)[self.offset:self.offset+len(self.values)].astype(bool)
+
+    def missing_count(self):
+        "Returns the number of empty values"
+        return int(numpy.unpackbits(self.bits)[self.offset:self.offset+len(self.values)].sum())
+
+    def present(self):
+        "Returns the positions of the values which are not empty"
+        return numpy.flatnonzero(~self.missing())
+
+    def max(self):
+        "Returns the largest value which is not empty"
+        return float(numpy.nanmax(self.values))
+
+    def tolist(self):
+        "Returns the values as a list of floats with None for the empty values"
+        values = self.values.tolist()
+        for i in self.missing_positions():
+            values[i] = None
+        return values
+
+    def missing_positions(self):
+        "Returns the positions of the empty values"
+        return numpy.flatnonzero(self.missing()).tolist()
 
 def find(array, value):
     "Searches through array for value. Returns an array of the indexes found"
+    if isinstance(array, TimeCourse):
+        if value is None:
+            return array.missing_positions()
+        return numpy.flatnonzero(array.values == value).tolist()
     return map(None,(i for i in xrange(len(array)) if array[i] == value))
     
 def sort(data):
@@ -39,24 +148,102 @@ def sort(data):
     
 def diff(data):
     "Calculates Difference and approximate derivative."
+    if isinstance(data, TimeCourse):
+        # None wherever either value is empty
+        return TimeCourse(numpy.diff(data.values)).tolist()
     diff = []
     for i in range(1, len(data)):
         diff.append(data[i] - data[i-1])
     return diff
     
 def trapz(time_points, time_course):
-    "Calculates the area under the curve using the trapazoid rule"
+    """
+     Calculates the area under the curve using the trapazoid rule.
+     A TimeCourse may be given as time_course, with time_points None to use its own time
+     points; its empty values are left out.
+    """
+    if isinstance(time_course, TimeCourse):
+        if time_points is None:
+            time_points = time_course.time_points
+        present = time_course.present()
+        x = numpy.asarray(time_points, dtype=float)[present]
+        y = time_course.values[present]
+        return float((numpy.diff(x) * (y[1:]+y[:-1])/2).sum())
     area = 0.0
     for i in range(1,len(time_points)):
         height = time_points[i]-time_points[i-1]
-        base = (time_course[i]+time_course[i-1])/2
+        base = (time_course[i]+time_course[i-1])/2.0
         area += height * base
         #print "i = %f height = %f base = %f area = %f" % (i,height,base,area)
     return area
     
+def trapz_index(time_points, time_course):
+    """
+     Cumulative trapezoid index of a timecourse: element i is the area under the curve from the
+     first timepoint to timepoint i, so element 0 is 0 and the last element equals trapz.  The
+     area between any two timepoints is then one subtraction (see trapz_window).
+     Empty values of a TimeCourse are left out, as in trapz; at an empty position the index
+     holds the area up to the value before it.
+    """
+    if isinstance(time_course, TimeCourse):
+        if time_points is None:
+            time_points = time_course.time_points
+        return trapz_index_batch(time_points, time_course.values[None, :])[0].tolist()
+    index = [0.0]
+    area = 0.0
+    for i in range(1,len(time_points)):
+        area += (time_points[i]-time_points[i-1]) * ((time_course[i]+time_course[i-1])/2.0)
+        index.append(area)
+    return index
+
+def trapz_index_batch(time_points, time_courses_2d):
+    """
+     trapz_index of every row of an (S, N) array of timecourses sharing time_points, with nan
+     for empty values.  Returns an (S, N) array.
+    """
+    time_courses = numpy.array(time_courses_2d, dtype=float, ndmin=2)
+    time_points = numpy.asarray(time_points, dtype=float)
+    if not numpy.isnan(time_courses).any():
+        areas = numpy.diff(time_points) * ((time_courses[:, 1:]+time_courses[:, :-1])/2)
+    else:
+        # each value is joined to the closest value before it, as in trapz on a TimeCourse
+        present = ~numpy.isnan(time_courses)
+        positions = numpy.arange(time_courses.shape[1])
+        before = numpy.maximum.accumulate(numpy.where(present, positions, -1), axis=1)[:, :-1]
+        joined = present[:, 1:] & (before >= 0)
+        before = before.clip(0)
+        rows = numpy.arange(len(time_courses))[:, None]
+        with numpy.errstate(invalid='ignore'):
+            areas = (time_points[1:] - time_points[before]) * ((time_courses[:, 1:] + time_courses[rows, before])/2)
+        areas = numpy.where(joined, areas, 0)
+    index = numpy.zeros(time_courses.shape)
+    numpy.cumsum(areas, axis=1, out=index[:, 1:])
+    return index
+
+def trapz_window(index, start, end):
+    "Area under the curve from timepoint start to timepoint end (start <= end) of a trapz_index"
+    return index[end] - index[start]
+
+def trapz_windows(index, starts, ends):
+    """
+     Batched trapz_window.  With a 1-D index, starts and ends are arrays of windows on that
+     timecourse.  With an (S, N) index from trapz_index_batch, starts and ends have S rows
+     (shape (S,) or (S, K)) giving the windows of each timecourse.  Returns an array of areas
+     shaped like starts.
+    """
+    index = numpy.asarray(index, dtype=float)
+    starts = numpy.asarray(starts, dtype=int)
+    ends = numpy.asarray(ends, dtype=int)
+    if index.ndim == 1:
+        return index[ends] - index[starts]
+    rows = numpy.arange(len(index)).reshape((-1,) + (1,)*(starts.ndim-1))
+    return index[rows, ends] - index[rows, starts]
+
 def mean(values):
-    "Returns the mean of a list."
-    return sum(values)/len(values)
+    "Returns the mean of a list.  Empty values of a TimeCourse are left out"
+    if isinstance(values, TimeCourse):
+        return float(numpy.nanmean(values.values))
+    return float(sum(values))/len(values)
     
 def zeros(rows, columns):
     "Provides a zero matrix with the specified rows and columns"
@@ -68,10 +255,137 @@ def zeros(rows, columns):
         matrix.append(row)
     return matrix
     
-def generate(time_course, time_points, TC_label, sensitivity, metric_select):
+#----Profiling---------------------------------------------
+
+class Profile(object):
+    """
+       Per stage statistics collected while profiling is on (see enable_profiling and
+       profiling).
+
+       Stages are 'generate', 'peak_finder' and 'calculate_peak_valley' for the whole call,
+       'generate.<intermediate>' and 'generate.metrics' for the parts of generate, and
+       'peak_finder.walks', 'peak_finder.sort' and 'peak_finder.valleys' for the parts of the
+       peak finder engines.  For every stage the calls, wall time, input size and inner loop
+       iterations are summed.  The iterations of 'peak_finder.walks' are the points compared
+       by the left and right walks (the j steps), those of 'peak_finder.sort' the re-sorts.
+
+       Power of two histograms of the time (in microseconds), size and iterations of single
+       calls, and the slowest calls with their size, iterations and label, help to find the
+       timecourses which make a run slow.  Each process has its own profile, the workers of
+       generate_parallel do not report into it.
+    """
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.clear()
+
+    def clear(self):
+        "Drops every statistic"
+        self.stages = {}
+
+    def record(self, stage, seconds, size=0, iterations=0, label=None):
+        "Adds one call of a stage"
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = {'calls': 0, 'seconds': 0.0, 'size': 0, 'iterations': 0,
+                                          'histograms': {'microseconds': {}, 'size': {}, 'iterations': {}},
+                                          'slowest': []}
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['size'] += size
+        stats['iterations'] += iterations
+        histograms = stats['histograms']
+        for name, value in (('microseconds', seconds*1e6), ('size', size), ('iterations', iterations)):
+            bucket = histogram_bucket(value)
+            histograms[name][bucket] = histograms[name].get(bucket, 0) + 1
+        if len(stats['slowest']) < self.slowest:
+            heapq.heappush(stats['slowest'], (seconds, size, iterations, label))
+        elif seconds > stats['slowest'][0][0]:
+            heapq.heapreplace(stats['slowest'], (seconds, size, iterations, label))
+
+    def stats(self):
+        """
+           Returns a dictionary stage -> statistics: 'calls', 'seconds', 'size', 'iterations',
+           'mean_seconds', 'histograms' (name -> {bucket upper bound: calls}) and 'slowest', a
+           list of (seconds, size, iterations, label) slowest first.
+        """
+        stats = {}
+        for stage, stage_stats in self.stages.items():
+            stats[stage] = copy.deepcopy(stage_stats)
+            stats[stage]['mean_seconds'] = stage_stats['seconds']/stage_stats['calls']
+            stats[stage]['slowest'].sort(reverse=True)
+        return stats
+
+    def report(self):
+        "Returns the statistics as a table, the stages taking the most time first"
+        lines = ["%-32s %8s %12s %12s %12s %14s" % ('stage', 'calls', 'seconds', 'mean', 'size', 'iterations')]
+        for stage, stats in sorted(self.stages.items(), key=lambda item: -item[1]['seconds']):
+            lines.append("%-32s %8d %12.6f %12.6f %12d %14d" % (stage, stats['calls'], stats['seconds'],
+                         stats['seconds']/stats['calls'], stats['size'], stats['iterations']))
+        return "\n".join(lines)
+
+def histogram_bucket(value):
+    "Returns the smallest power of two which is at least value (0 for values up to 0)"
+    if value <= 0:
+        return 0
+    mantissa, exponent = math.frexp(value)
+    if mantissa == 0.5:
+        exponent -= 1
+    return 2**exponent if exponent >= 0 else 2.0**exponent
+
+# profile filled in by the instrumented functions, None when profiling is off
+profiler = None
+clock = timeit.default_timer
+
+def enable_profiling(slowest=10):
+    "Turns on profiling with a new, empty Profile.  Returns the profile"
+    global profiler
+    profiler = Profile(slowest)
+    return profiler
+
+def disable_profiling():
+    "Turns off profiling"
+    global profiler
+    profiler = None
+
+@contextlib.contextmanager
+def profiling(profile=None):
+    """
+       Profiles the enclosed code into profile (a new Profile by default), which is returned
+       by the with statement.  Whatever profiling was on before is restored afterwards.
+    """
+    global profiler
+    previous = profiler
+    profiler = Profile() if profile is None else profile
+    try:
+        yield profiler
+    finally:
+        profiler = previous
+
+def profiled(stage, label_argument=None):
+    """
+       Decorator recording every call of a function as a stage while profiling is on.  The
+       input size is the length of the first argument, the label is taken from the argument
+       at position label_argument.  With profiling off the only cost is one check.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def profiled_function(*arguments, **keywords):
+            if profiler is None:
+                return function(*arguments, **keywords)
+            started = clock()
+            try:
+                return function(*arguments, **keywords)
+            finally:
+                label = arguments[label_argument] if label_argument is not None and len(arguments) > label_argument else None
+                profiler.record(stage, clock()-started, len(arguments[0]), 0, label)
+        return profiled_function
+    return decorate
+
+@profiled('generate', 2)
+def generate(time_course, time_points, TC_label, sensitivity, metric_select, missing_policy=None):
     """
      INPUT: One timecourse.
-     Input format: metric_maker(time_course, time_points, TC_label, sensitivity, metric_select)
+     Input format: metric_maker(time_course, time_points, TC_label, sensitivity, metric_select, missing_policy)
 
      time_course:
      An array of length N where N = number of timepoints in the timecourse.
@@ -89,6 +403,7 @@ def generate(time_course, time_points, TC_label, sensitivity, metric_select):
      A number between 0-1 which determines how large a peak needs to be in order to be considered significant. 
      Peak height is determined by comparing the tip of the peak to the lowest valleys on either side.  Both
      distances must exceed the distance X=sensitivity * (max point in timecourse - min point in timecourse).
+     None uses DEFAULT_SENSITIVITY.
 
      TC_label:
      A string which provides the name of the timecourse measured  (i.e. AKT, JNK)
@@ -99,34 +414,674 @@ def generate(time_course, time_points, TC_label, sensitivity, metric_select):
      and a value of 0 if it is to be omitted.
      current metric_select order: 
      [mean, AUC_whole, Max, Equilibrium, Derivative, Data_Points, AUC_peak, ActivationSLope_peak, DecayRate_peak]
+     None selects every metric.
+     The peak metrics describe the highest significant peak, from the valley before it to the
+     valley after it (or the ends of the timecourse), and are None without significant peaks
+     or when peak detection fails on the timecourse:
+     AUC_peak is the area under the peak, ActivationSlope_peak the least squares slope of the
+     rise from the valley to the peak and DecayRate_peak the rate k of an exponential decay
+     y = a*exp(-k*t) fitted to the fall from the peak to the valley (a line fitted to log(y),
+     leaving out values <= 0).  The slope and decay rate are None when fewer than two values
+     can be fitted.  Only the selected metrics are computed, together with the intermediates
+     they need (see METRIC_REQUIREMENTS).
+
+     missing_policy:
+     How empty (None) values are handled when there are fewer than N/2 of them, one of
+     MISSING_VALUE_POLICIES (see fill_missing).  Defaults to MISSING_VALUE_POLICY.  With
+     'drop' the metrics leave the empty values out and Derivative and Data_Points hold None
+     where they are undefined, as does Equilibrium when its whole window is empty (nan in
+     generate_batch).  Timecourses with empty values need numpy.
+
+     OUTPUT: (headers, values)
+     values is a flat list of the selected metrics in metric_select order; Derivative adds one
+     value per interval between timepoints and Data_Points one value per timepoint.
+     headers holds a column name for each value, built from TC_label and the metric name.
     """
     
+    # a TimeCourse carries its own time points and label
+    if isinstance(time_course, TimeCourse):
+        if time_points is None:
+            time_points = time_course.time_points
+        if TC_label is None:
+            TC_label = time_course.label
+
     # first check if there are more empty values than measurments
     # if there are too many empty values, then metric_maker exits
-    if sum(1 for v in time_course if v == None) >= len(time_points)/2:
+    if count_empty(time_course) >= len(time_points)/2:
         raise TooManyEmptyValues, "found too many empty values in the time course."
+    if len(time_course) != len(time_points):
+        raise TimePointsMismatchWithTimeCourse, "time course has %d values but %d time points were given." % (len(time_course), len(time_points))
+    if missing_policy is None:
+        missing_policy = MISSING_VALUE_POLICY
+    if missing_policy not in MISSING_VALUE_POLICIES:
+        raise UnknownMissingValuePolicy, "unknown missing value policy %r (available: %s)" % (
+            missing_policy, ", ".join(MISSING_VALUE_POLICIES))
+
+    # return a copy of the cached result if this timecourse has been seen before
+    if result_cache is not None:
+        key = content_key('generate', time_course, time_points, sensitivity, metric_select, missing_policy)
+        cached = result_cache.get(key)
+        if cached is not None:
+            return label_headers(TC_label, cached[0]), list(cached[1])
     
-    # number of timepoints in the timecourse.
+    time_course = apply_missing_policy(time_course, time_points, missing_policy)
+
+    # compute only the selected metrics and the intermediates they need
+    names = selected_metrics(metric_select, METRIC_NAMES)
+    intermediates = compute_intermediates(plan_metrics(names), time_course, time_points, sensitivity)
+    if profiler is not None:
+        started = clock()
+    metrics = {}
+    for name in names:
+        if name in METRICS:
+            metrics[name] = METRICS[name](time_course, time_points, intermediates)
+    if profiler is not None:
+        profiler.record('generate.metrics', clock()-started, len(time_course))
+    headers, values = select_metrics(None, metrics, metric_select)
+    if result_cache is not None:
+        result_cache.put(key, (tuple(headers), tuple(values)))
+    return label_headers(TC_label, headers), values
+
+#----Empty values------------------------------------------
+
+MISSING_VALUE_POLICIES = ['drop', 'interpolate', 'carry_forward']
+MISSING_VALUE_POLICY = 'drop'
+# sensitivity used when generate is given None
+DEFAULT_SENSITIVITY = 0.1
+
+def too_many_empty(time_courses_2d, num_timepoints):
+    """
+     The empty value check of generate for a whole batch at once.  time_courses_2d is an
+     (S, N) array with nan for empty values.  Returns a boolean array which is True for the
+     rows with at least num_timepoints/2 (rounded down) empty values.
+    """
+    return numpy.isnan(time_courses_2d).sum(axis=1) >= num_timepoints//2
+
+def fill_missing(time_courses_2d, time_points, policy):
+    """
+     Applies a missing value policy to a batch of timecourses in one pass.
+
+     time_courses_2d:
+     An (S, N) array of timecourses with nan for empty values.
+
+     policy:
+     'drop' - the empty values stay empty, the metrics leave them out
+     'interpolate' - linear interpolation in time between the closest values on either side
+     'carry_forward' - the last value before the gap
+     Gaps at the start take the first value and gaps at the end the last value of the row.
+     Rows without any value stay empty.
+
+     OUTPUT: a new (S, N) float array
+    """
+    if policy not in MISSING_VALUE_POLICIES:
+        raise UnknownMissingValuePolicy, "unknown missing value policy %r (available: %s)" % (
+            policy, ", ".join(MISSING_VALUE_POLICIES))
+    values = numpy.array(time_courses_2d, dtype=float, ndmin=2)
+    missing = numpy.isnan(values)
+    if policy == 'drop' or not missing.any():
+        return values
+    num_timepoints = values.shape[1]
+    positions = numpy.arange(num_timepoints)
+
+    # position of the closest value at or before (-1 for none) and at or after (N for none)
+    # every position, by running maxima and minima over the positions holding a value
+    before = numpy.maximum.accumulate(numpy.where(missing, -1, positions), axis=1)
+    after = numpy.minimum.accumulate(numpy.where(missing, num_timepoints, positions)[:, ::-1], axis=1)[:, ::-1]
+    before = numpy.where(before < 0, after, before).clip(0, num_timepoints-1)
+    after = numpy.where(after >= num_timepoints, before, after).clip(0, num_timepoints-1)
+
+    rows = numpy.arange(len(values))[:, None]
+    if policy == 'carry_forward':
+        filled = values[rows, before]
+    else:
+        time_points = numpy.asarray(time_points, dtype=float)
+        span = time_points[after] - time_points[before]
+        weight = (time_points - time_points[before]) / numpy.where(span > 0, span, 1)
+        filled = values[rows, before] + (values[rows, after] - values[rows, before])*numpy.where(span > 0, weight, 0)
+    values[missing] = filled[missing]
+    return values
+
+def apply_missing_policy(time_course, time_points, policy):
+    """
+     Returns time_course ready for the metrics: unchanged without empty values, as a
+     TimeCourse for 'drop', and as a filled list for the other policies.
+    """
+    if isinstance(time_course, TimeCourse):
+        if not time_course.missing_count() or policy == 'drop':
+            return time_course
+        return fill_missing(time_course.values, time_points, policy)[0].tolist()
+    if not count_empty(time_course):
+        return time_course
+    if numpy is None:
+        raise UnknownMissingValuePolicy, "time courses with empty values need numpy."
+    if policy == 'drop':
+        return TimeCourse(time_course, time_points)
+    values = numpy.array([numpy.nan if value is None else value for value in time_course], dtype=float)
+    return fill_missing(values, time_points, policy)[0].tolist()
+
+#----Metrics and the intermediates they need---------------
+# An intermediate is computed at most once per timecourse, and only when a selected metric
+# needs it.  Each intermediate function is called with (time_course, time_points, sensitivity,
+# intermediates) and each metric function with (time_course, time_points, intermediates).
+
+def time_steps_intermediate(time_course, time_points, sensitivity, intermediates):
+    return diff(time_points)
+
+def diff_intermediate(time_course, time_points, sensitivity, intermediates):
+    return diff(time_course)
+
+def cumulative_integral_intermediate(time_course, time_points, sensitivity, intermediates):
+    return trapz_index(time_points, time_course)
+
+def peak_valley_intermediate(time_course, time_points, sensitivity, intermediates):
+    try:
+        return peak_finder(time_course, DEFAULT_SENSITIVITY if sensitivity is None else sensitivity)
+    except MetricMakerError:
+        # without peaks or valleys, as in peak_finder_batch
+        return [0]*len(time_course)
+
+def peak_index_intermediate(time_course, time_points, sensitivity, intermediates):
+    return find(intermediates['peak_valley'], 1)
+
+def valley_index_intermediate(time_course, time_points, sensitivity, intermediates):
+    return find(intermediates['peak_valley'], -1)
+
+def highest_peak_intermediate(time_course, time_points, sensitivity, intermediates):
+    return highest_peak(time_course, intermediates['peak_index'], intermediates['valley_index'])
+
+# name -> (function, names of the intermediates it needs)
+INTERMEDIATES = {'time_steps': (time_steps_intermediate, []),
+                 'diff': (diff_intermediate, []),
+                 'cumulative_integral': (cumulative_integral_intermediate, []),
+                 'peak_valley': (peak_valley_intermediate, []),
+                 'peak_index': (peak_index_intermediate, ['peak_valley']),
+                 'valley_index': (valley_index_intermediate, ['peak_valley']),
+                 'highest_peak': (highest_peak_intermediate, ['peak_index', 'valley_index'])}
+
+def mean_metric(time_course, time_points, intermediates):
+    return [mean(time_course)]
+
+def auc_whole_metric(time_course, time_points, intermediates):
+    return [intermediates['cumulative_integral'][-1]]
+
+def max_metric(time_course, time_points, intermediates):
+    return [time_course.max() if isinstance(time_course, TimeCourse) else max(time_course)]
+
+def equilibrium_metric(time_course, time_points, intermediates):
     num_timepoints = len(time_course)
-    
-    #----Initialize New Metric Variables----------------------
-    avg = 0;        # averages across the timecourse
-    peak = 0;       # peak value of variable across the time course
-    AUC = 0;        # itegral of the timecourse 
-    maxpeaktime = 0;# time until peaks
-    equil = 0;      # equilibrium activity based on the last 25% of timepoints
-    deriv = zeros(1,num_timepoints-1); # derivative at each timepoint
-    peaktime = 0;   # time of the max point in the timecourse.
-    
-    # Call the peakfinder to build the peak_valley_course
-    peak_valley_course = peak_finder(time_course,sensitivity)
+    window = time_course[num_timepoints-equilibrium_points(num_timepoints):]
+    if isinstance(window, TimeCourse) and window.missing().all():
+        # every value of the window was dropped
+        return [None]
+    return [mean(window)]
+
+def derivative_metric(time_course, time_points, intermediates):
+    time_steps = intermediates['time_steps']
+    return [None if step is None else float(step)/time_steps[i] for i, step in enumerate(intermediates['diff'])]
 
-    # Create indexes of the locations of peaks and valleys in the timecourse.
-    peak_index = find(peak_valley_course == 1);
-    num_of_peaks = length(peak_index);
-    valley_index = find(peak_valley_course == -1);
-    num_of_valleys = length(valley_index);
+def data_points_metric(time_course, time_points, intermediates):
+    return list(time_course)
 
+def highest_peak(time_course, peak_index, valley_index):
+    """
+     Returns (left valley, peak, right valley) for the highest significant peak, None without
+     peaks.  A side without a valley extends to the end of the timecourse.
+    """
+    if not peak_index:
+        return None
+    peak = peak_index[0]
+    for position in peak_index:
+        if time_course[position] > time_course[peak]:
+            peak = position
+    following = bisect_right(valley_index, peak)
+    left = valley_index[following-1] if following else 0
+    right = valley_index[following] if following < len(valley_index) else len(time_course)-1
+    return left, peak, right
+
+def least_squares(x, y):
+    """
+     Fits the line y = intercept + slope*x.  Returns (slope, intercept, r_squared), None
+     without two distinct x values.  r_squared is 1 when y does not vary.
+    """
+    count = len(x)
+    if count < 2:
+        return None
+    mean_x = sum(x)/float(count)
+    mean_y = sum(y)/float(count)
+    sxx = sum((xi-mean_x)*(xi-mean_x) for xi in x)
+    if sxx == 0:
+        return None
+    sxy = sum((xi-mean_x)*(yi-mean_y) for xi, yi in zip(x, y))
+    syy = sum((yi-mean_y)*(yi-mean_y) for yi in y)
+    slope = sxy/sxx
+    residual = max(0.0, syy - slope*sxy)
+    return slope, mean_y - slope*mean_x, 1 - residual/syy if syy else 1.0
+
+def segment_points(time_course, time_points, start, end, log=False):
+    """
+     Returns (times, values) of the timepoints start to end, leaving out empty values.  With
+     log the values are replaced by their logarithm, leaving out values <= 0.
+    """
+    x = []
+    y = []
+    for i in xrange(start, end+1):
+        value = time_course[i]
+        if value is None or value != value or (log and value <= 0):
+            continue
+        x.append(float(time_points[i]))
+        y.append(math.log(value) if log else float(value))
+    return x, y
+
+def auc_peak_metric(time_course, time_points, intermediates):
+    "Area under the highest significant peak, between the valleys on either side of it"
+    flanks = intermediates['highest_peak']
+    if flanks is None:
+        return [None]
+    return [trapz_window(intermediates['cumulative_integral'], flanks[0], flanks[2])]
+
+def activation_slope_metric(time_course, time_points, intermediates):
+    "Least squares slope from the valley before the highest significant peak to the peak"
+    flanks = intermediates['highest_peak']
+    fit = None if flanks is None else least_squares(*segment_points(time_course, time_points, flanks[0], flanks[1]))
+    return [None if fit is None else fit[0]]
+
+def decay_rate_metric(time_course, time_points, intermediates):
+    "Exponential decay rate from the highest significant peak to the valley after it"
+    flanks = intermediates['highest_peak']
+    fit = None if flanks is None else least_squares(*segment_points(time_course, time_points, flanks[1], flanks[2], True))
+    return [None if fit is None else -fit[0]]
+
+# name -> function for every metric generate computes
+METRICS = {'mean': mean_metric,
+           'AUC_whole': auc_whole_metric,
+           'Max': max_metric,
+           'Equilibrium': equilibrium_metric,
+           'Derivative': derivative_metric,
+           'Data_Points': data_points_metric,
+           'AUC_peak': auc_peak_metric,
+           'ActivationSlope_peak': activation_slope_metric,
+           'DecayRate_peak': decay_rate_metric}
+
+# name -> names of the intermediates each metric needs
+METRIC_REQUIREMENTS = {'mean': [],
+                       'AUC_whole': ['cumulative_integral'],
+                       'Max': [],
+                       'Equilibrium': [],
+                       'Derivative': ['time_steps', 'diff'],
+                       'Data_Points': [],
+                       'AUC_peak': ['highest_peak', 'cumulative_integral'],
+                       'ActivationSlope_peak': ['highest_peak'],
+                       'DecayRate_peak': ['highest_peak']}
+
+def plan_metrics(names):
+    """
+     Returns the intermediates needed by the named metrics, each once, ordered so that every
+     intermediate comes after the intermediates it needs.
+    """
+    plan = []
+    def visit(intermediate):
+        if intermediate in plan:
+            return
+        for required in INTERMEDIATES[intermediate][1]:
+            visit(required)
+        plan.append(intermediate)
+    for name in names:
+        for intermediate in METRIC_REQUIREMENTS[name]:
+            visit(intermediate)
+    return plan
+
+def compute_intermediates(plan, time_course, time_points, sensitivity):
+    "Computes the intermediates of a plan from plan_metrics, returning a dictionary name -> value"
+    intermediates = {}
+    for name in plan:
+        if profiler is None:
+            intermediates[name] = INTERMEDIATES[name][0](time_course, time_points, sensitivity, intermediates)
+        else:
+            started = clock()
+            intermediates[name] = INTERMEDIATES[name][0](time_course, time_points, sensitivity, intermediates)
+            profiler.record('generate.' + name, clock()-started, len(time_course))
+    return intermediates
+
+def generate_batch(time_courses_2d, time_points, labels, sensitivity, metric_select, missing_policy=None):
+    """
+     INPUT: A matrix of timecourses sharing the same time_points.
+     Input format: generate_batch(time_courses_2d, time_points, labels, sensitivity, metric_select, missing_policy)
+
+     time_courses_2d:
+     An array of shape (S, N) where S = number of signals and N = number of timepoints.
+     Each row is one timecourse as passed to generate; empty values are given as None or nan.
+
+     labels:
+     An array of length S with the TC_label of each row (or None).
+
+     time_points, sensitivity, metric_select, missing_policy:
+     As for generate.
+
+     Each metric is calculated for all rows at once with numpy instead of calling generate
+     once per row.  The empty value check and the missing value policy are also applied to
+     the whole batch at once (see too_many_empty and fill_missing).  Peak detection runs
+     once per row, for the first selected peak metric, and the peak segments of every row
+     are fitted together (see fit_segments).  The peak metrics of a row where peak detection
+     fails are nan, where generate gives None.
+
+     OUTPUT: (headers, matrix)
+     matrix is an (S, M) array where row i holds the values generate returns for row i and
+     headers[i] holds the matching column names.
+    """
+    time_courses = numpy.atleast_2d(numpy.asarray(time_courses_2d, dtype=float))
+    time_points = numpy.asarray(time_points, dtype=float)
+    num_signals, num_timepoints = time_courses.shape
+    if labels is None:
+        labels = [None]*num_signals
+
+    # reject the whole batch if any row has too many empty values
+    rejected = numpy.flatnonzero(too_many_empty(time_courses, len(time_points)))
+    if len(rejected):
+        raise TooManyEmptyValues, "found too many empty values in time course %d (%s)." % (rejected[0], labels[rejected[0]])
+    if num_timepoints != len(time_points):
+        raise TimePointsMismatchWithTimeCourse, "time courses have %d values but %d time points were given." % (num_timepoints, len(time_points))
+    if missing_policy is None:
+        missing_policy = MISSING_VALUE_POLICY
+    time_courses = fill_missing(time_courses, time_points, missing_policy)
+
+    # only the selected metrics are computed; empty values left by 'drop' are left out
+    equilibrium_start = num_timepoints-equilibrium_points(num_timepoints)
+    if numpy.isnan(time_courses).any():
+        average, highest = nan_average, numpy.nanmax
+        area = lambda time_points, time_courses: trapz_index_batch(time_points, time_courses)[:, -1]
+    else:
+        average, highest = numpy.mean, numpy.max
+        area = lambda time_points, time_courses: ((time_courses[:, 1:] + time_courses[:, :-1])/2 * numpy.diff(time_points)).sum(axis=1)
+    flanks = {}
+    def highest_peaks():
+        if not flanks:
+            flanks['highest'] = highest_peak_batch(time_courses, peak_finder_batch(time_courses, sensitivity))
+        return flanks['highest']
+    batch_metrics = {'mean': lambda: average(time_courses, axis=1)[:, None],
+                     'AUC_whole': lambda: area(time_points, time_courses)[:, None],
+                     'Max': lambda: highest(time_courses, axis=1)[:, None],
+                     'Equilibrium': lambda: average(time_courses[:, equilibrium_start:], axis=1)[:, None],
+                     'Derivative': lambda: numpy.diff(time_courses, axis=1) / numpy.diff(time_points),
+                     'Data_Points': lambda: time_courses,
+                     'AUC_peak': lambda: auc_peak_batch(time_courses, time_points, highest_peaks())[:, None],
+                     'ActivationSlope_peak': lambda: activation_slope_batch(time_courses, time_points, highest_peaks())[:, None],
+                     'DecayRate_peak': lambda: decay_rate_batch(time_courses, time_points, highest_peaks())[:, None]}
+
+    names = selected_metrics(metric_select, batch_metrics)
+    metrics = dict((name, batch_metrics[name]()) for name in names)
+    headers = [sum((metric_headers(label, name, metrics[name].shape[1]) for name in names), [])
+               for label in labels]
+    if not names:
+        return headers, numpy.zeros((num_signals, 0))
+    return headers, numpy.hstack([metrics[name] for name in names])
+
+def nan_average(values, axis):
+    "numpy.nanmean without its warning for empty slices, which are nan"
+    present = ~numpy.isnan(values)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(present, values, 0).sum(axis=axis) / present.sum(axis=axis)
+
+def peak_finder_batch(time_courses_2d, sensitivity):
+    """
+     peak_finder on every row of an (S, N) array, rows with empty (nan) values as a TimeCourse.
+     None uses DEFAULT_SENSITIVITY.  Returns an (S, N) int8 array.  Rows where peak_finder
+     raises a MetricMakerError are left without peaks or valleys (all 0), so one row can not
+     fail the whole batch.
+    """
+    if sensitivity is None:
+        sensitivity = DEFAULT_SENSITIVITY
+    peak_valley = numpy.zeros(time_courses_2d.shape, dtype=numpy.int8)
+    for i, row in enumerate(time_courses_2d):
+        try:
+            if numpy.isnan(row).any():
+                peak_valley[i] = peak_finder(TimeCourse(row), sensitivity)
+            else:
+                peak_valley[i] = peak_finder(row.tolist(), sensitivity)
+        except MetricMakerError:
+            continue
+    return peak_valley
+
+def flanking_valleys(peak_valley):
+    """
+     For every position of an (S, N) peak_valley array, the closest valley at or before it
+     (0 without one) and the closest valley at or after it (N-1 without one).
+     Returns two (S, N) arrays.
+    """
+    num_timepoints = peak_valley.shape[1]
+    valleys = peak_valley == -1
+    positions = numpy.arange(num_timepoints)
+    last_valley = numpy.maximum.accumulate(numpy.where(valleys, positions, -1), axis=1)
+    next_valley = numpy.minimum.accumulate(numpy.where(valleys, positions, num_timepoints)[:, ::-1], axis=1)[:, ::-1]
+    return last_valley.clip(0), next_valley.clip(0, num_timepoints-1)
+
+def highest_peak_batch(time_courses_2d, peak_valley):
+    """
+     highest_peak for every row at once.  Returns (has_peak, left, peak, right) arrays of
+     length S; left, peak and right are 0 for rows without peaks.
+    """
+    peaks = peak_valley == 1
+    has_peak = peaks.any(axis=1)
+    # the first of the highest peaks, as in highest_peak
+    peak = numpy.where(peaks, time_courses_2d, -INFINITY).argmax(axis=1)
+    last_valley, next_valley = flanking_valleys(peak_valley)
+    rows = numpy.arange(len(time_courses_2d))
+    left = last_valley[rows, peak]
+    right = next_valley[rows, peak]
+    return has_peak, numpy.where(has_peak, left, 0), peak, numpy.where(has_peak, right, 0)
+
+def peak_segments(peak_valley):
+    """
+     Every significant peak of an (S, N) peak_valley array with the valleys on either side
+     of it, as highest_peak finds them for the highest peak.  Returns (row, left, peak, right)
+     arrays with one element per peak, ordered by row and then by position.
+    """
+    rows, peaks = numpy.nonzero(peak_valley == 1)
+    last_valley, next_valley = flanking_valleys(peak_valley)
+    return rows, last_valley[rows, peaks], peaks, next_valley[rows, peaks]
+
+def segment_buffers(rows, starts, ends):
+    """
+     Gathers segments of different lengths into flat buffers.  Segment k covers the
+     positions starts[k] to ends[k] (inclusive) of row rows[k].
+     Returns (segment, row, position) with one element per point of every segment.
+    """
+    starts = numpy.asarray(starts, dtype=int)
+    lengths = numpy.asarray(ends, dtype=int) - starts + 1
+    segment = numpy.repeat(numpy.arange(len(starts)), lengths)
+    # where each segment begins in the buffers
+    offsets = numpy.cumsum(lengths) - lengths
+    position = numpy.arange(len(segment)) - offsets[segment] + starts[segment]
+    return segment, numpy.asarray(rows, dtype=int)[segment], position
+
+def fit_lines(segment, x, y, num_segments):
+    """
+     least_squares for every segment of flat buffers at once, leaving out the points where
+     y is nan.  Returns (slope, intercept, r_squared) arrays of length num_segments, nan
+     for segments without two distinct x values.
+    """
+    present = ~numpy.isnan(y)
+    segment, x, y = segment[present], x[present], y[present]
+    count = numpy.bincount(segment, minlength=num_segments).astype(float)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_x = numpy.bincount(segment, x, num_segments)/count
+        mean_y = numpy.bincount(segment, y, num_segments)/count
+        dx = x - mean_x[segment]
+        dy = y - mean_y[segment]
+        sxx = numpy.bincount(segment, dx*dx, num_segments)
+        sxy = numpy.bincount(segment, dx*dy, num_segments)
+        syy = numpy.bincount(segment, dy*dy, num_segments)
+        slope = sxy/sxx
+        residual = (syy - slope*sxy).clip(0)
+        r_squared = numpy.where(syy > 0, 1 - residual/syy, 1.0)
+    fitted = (count >= 2) & (sxx > 0)
+    return (numpy.where(fitted, slope, numpy.nan), numpy.where(fitted, mean_y - slope*mean_x, numpy.nan),
+            numpy.where(fitted, r_squared, numpy.nan))
+
+def fit_segments(time_courses_2d, time_points, rows, starts, ends, log=False):
+    """
+     Fits a line to the values of many segments of an (S, N) array at once, segment k
+     covering the positions starts[k] to ends[k] of row rows[k].  Empty (nan) values are left
+     out.  With log the line is fitted to log(values), leaving out values <= 0.
+     Returns (slope, intercept, r_squared) arrays with one element per segment (see fit_lines).
+    """
+    time_points = numpy.asarray(time_points, dtype=float)
+    segment, row, position = segment_buffers(rows, starts, ends)
+    y = time_courses_2d[row, position]
+    if log:
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            y = numpy.where(y > 0, numpy.log(y), numpy.nan)
+    return fit_lines(segment, time_points[position], y, len(starts))
+
+def peak_fits(time_courses_2d, time_points, sensitivity):
+    """
+     Fits the rise and the fall of every significant peak of every row of an (S, N) array of
+     timecourses sharing time_points, as ActivationSlope_peak and DecayRate_peak do for the
+     highest peak.  Empty values are given as nan.  None uses DEFAULT_SENSITIVITY.
+
+     OUTPUT: a dictionary of arrays with one element per peak (see peak_segments):
+     'row', 'left', 'peak', 'right': the row of the peak and the positions of its valleys and tip
+     'activation_slope', 'activation_r_squared': the line fitted from left to peak
+     'decay_rate', 'decay_r_squared': the exponential decay fitted from peak to right
+     Fits with fewer than two values are nan.
+    """
+    time_courses = numpy.atleast_2d(numpy.asarray(time_courses_2d, dtype=float))
+    rows, left, peak, right = peak_segments(peak_finder_batch(time_courses, sensitivity))
+    activation_slope, intercept, activation_r_squared = fit_segments(time_courses, time_points, rows, left, peak)
+    decay_slope, intercept, decay_r_squared = fit_segments(time_courses, time_points, rows, peak, right, True)
+    return {'row': rows, 'left': left, 'peak': peak, 'right': right,
+            'activation_slope': activation_slope, 'activation_r_squared': activation_r_squared,
+            'decay_rate': -decay_slope, 'decay_r_squared': decay_r_squared}
+
+def auc_peak_batch(time_courses_2d, time_points, flanks):
+    "AUC_peak of every row from the highest_peak_batch flanks, nan for rows without significant peaks"
+    has_peak, left, peak, right = flanks
+    areas = trapz_windows(trapz_index_batch(time_points, time_courses_2d), left, right)
+    return numpy.where(has_peak, areas, numpy.nan)
+
+def activation_slope_batch(time_courses_2d, time_points, flanks):
+    "ActivationSlope_peak of every row from the highest_peak_batch flanks"
+    has_peak, left, peak, right = flanks
+    slope = fit_segments(time_courses_2d, time_points, numpy.arange(len(time_courses_2d)), left, peak)[0]
+    return numpy.where(has_peak, slope, numpy.nan)
+
+def decay_rate_batch(time_courses_2d, time_points, flanks):
+    "DecayRate_peak of every row from the highest_peak_batch flanks"
+    has_peak, left, peak, right = flanks
+    slope = fit_segments(time_courses_2d, time_points, numpy.arange(len(time_courses_2d)), peak, right, True)[0]
+    return numpy.where(has_peak, -slope, numpy.nan)
+
+def generate_parallel(time_courses, time_points, labels, sensitivity, metric_select, workers=None, chunk_size=None,
+                      missing_policy=None):
+    """
+     Runs generate over many timecourses in a pool of worker processes.
+     Input format: generate_parallel(time_courses, time_points, labels, sensitivity, metric_select, workers, chunk_size, missing_policy)
+
+     time_courses:
+     An array of timecourses, each given as to generate.
+
+     labels:
+     An array with the TC_label of each timecourse (or None).
+
+     time_points, sensitivity, metric_select, missing_policy:
+     As for generate, shared by every timecourse.
+
+     workers:
+     Number of worker processes, defaults to the number of cpus.  With 1 worker the
+     timecourses are processed in this process.
+
+     chunk_size:
+     Number of timecourses sent to a worker at a time.  Larger chunks cut the pickling
+     overhead, smaller chunks balance the load better.  Defaults to spreading the work
+     over about 4 chunks per worker.
+
+     OUTPUT: (results, failures)
+     results[i] is the (headers, values) returned by generate for timecourse i, or None if it
+     failed.  failures is a list of (i, error) for every timecourse where generate raised an
+     error; the other timecourses are still processed.
+    """
+    if labels is None:
+        labels = [None]*len(time_courses)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1, int(math.ceil(len(time_courses)/(workers*4.0))))
+
+    jobs = [(i, time_courses[i], labels[i]) for i in xrange(len(time_courses))]
+    chunks = [(jobs[i:i+chunk_size], time_points, sensitivity, metric_select, missing_policy)
+              for i in xrange(0, len(jobs), chunk_size)]
+    if workers == 1:
+        finished = map(generate_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            finished = pool.map(generate_chunk, chunks, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    results = []
+    failures = []
+    for chunk in finished:
+        for i, result, error in chunk:
+            results.append(result)
+            if error is not None:
+                failures.append((i, error))
+    return results, failures
+
+def generate_chunk(chunk):
+    "Worker for generate_parallel.  Returns (index, result, error) for each timecourse of the chunk"
+    jobs, time_points, sensitivity, metric_select, missing_policy = chunk
+    finished = []
+    for i, time_course, label in jobs:
+        try:
+            finished.append((i, generate(time_course, time_points, label, sensitivity, metric_select, missing_policy), None))
+        except Exception, error:
+            # any error fails this timecourse only
+            finished.append((i, None, error))
+    return finished
+
+def count_empty(time_course):
+    "Returns the number of empty (None) values in a timecourse"
+    if isinstance(time_course, TimeCourse):
+        return time_course.missing_count()
+    return sum(1 for v in time_course if v == None)
+
+def equilibrium_points(num_timepoints):
+    "Returns the number of timepoints at the end of a timecourse used for the equilibrium (the last 25%)"
+    return int(math.ceil(num_timepoints*0.25))
+
+def metric_headers(TC_label, name, count):
+    "Returns the column names for a metric with count values, e.g. AKT_mean or AKT_Derivative_1"
+    prefix = name if TC_label is None else "%s_%s" % (TC_label, name)
+    if count == 1:
+        return [prefix]
+    return ["%s_%d" % (prefix, i) for i in xrange(1, count+1)]
+
+def label_headers(TC_label, headers):
+    "Adds TC_label to column names made without a label"
+    if TC_label is None:
+        return list(headers)
+    return ["%s_%s" % (TC_label, header) for header in headers]
+
+def selected_metrics(metric_select, available):
+    "Returns the names flagged in metric_select (None selects all) which are in available, in METRIC_NAMES order"
+    if metric_select is None:
+        metric_select = [1]*len(METRIC_NAMES)
+    return [name for name, selected in zip(METRIC_NAMES, metric_select) if selected and name in available]
+
+def select_metrics(TC_label, metrics, metric_select):
+    """
+     Flattens a dictionary of metric name -> values into (headers, values) following the
+     order of METRIC_NAMES, keeping only the metrics flagged in metric_select.
+    """
+    headers = []
+    values = []
+    for name in selected_metrics(metric_select, metrics):
+        headers.extend(metric_headers(TC_label, name, len(metrics[name])))
+        values.extend(metrics[name])
+    return headers, values
+
+@profiled('calculate_peak_valley')
 def calculate_peak_valley(y_data):
     "Determines the peaks for a timeseries"
     # number of timepoints in the data series
@@ -179,7 +1134,8 @@ def calculate_peak_valley(y_data):
     
     return peak_valley
     
-def peak_finder(y_data, sensitivity):
+@profiled('peak_finder')
+def peak_finder(y_data, sensitivity, engine=None):
     """
        Function which determines the "significant" peaks/valleys for an input timecourse.
        Translated to python from code written in MATLAB by Jason Kelly, August 2003.
@@ -202,6 +1158,11 @@ def peak_finder(y_data, sensitivity):
        Sensitivity * (max value in time series - min value in timeseries) = minimum size for a significant peak.
        "size" of the peak is determined by the distance between the peak and the nearest 2 valleys.
 
+       engine:
+       Optional name of the peak finding engine, one of the keys of PEAK_FINDER_ENGINES.
+       'classic' is the original point by point translation of the MATLAB code, 'vectorized'
+       is the numpy engine which returns the same array.  Defaults to PEAK_FINDER_ENGINE.
+
        OUTPUT: array of length M where M equals the number of elements in the y_data array.
        Each position in the array holds a valut of -1, 0 , or 1 and corresponds to a timepoint
        in the y_data array.
@@ -209,6 +1170,38 @@ def peak_finder(y_data, sensitivity):
         0 = insiginificant 
         1 = peak
     """
+    if isinstance(y_data, TimeCourse):
+        # find the peaks among the values which are not empty, empty values are insignificant
+        present = y_data.present()
+        peak_valley = numpy.zeros(len(y_data), dtype=int)
+        peak_valley[present] = run_peak_finder(y_data.values[present].tolist(), sensitivity, engine)
+        return peak_valley.tolist()
+    return run_peak_finder(y_data, sensitivity, engine)
+
+def run_peak_finder(y_data, sensitivity, engine):
+    "Runs a peak finder engine on a list of values, through the result cache when it is on"
+    if engine is None:
+        engine = PEAK_FINDER_ENGINE
+    if engine not in PEAK_FINDER_ENGINES:
+        raise UnknownEngine, "unknown peak finder engine %r (available: %s)" % (
+            engine, ", ".join(sorted(PEAK_FINDER_ENGINES)))
+    if result_cache is None:
+        return PEAK_FINDER_ENGINES[engine](y_data, sensitivity)
+
+    # every engine gives the same array, so the engine is not part of the key
+    key = content_key('peak_finder', y_data, sensitivity)
+    cached = result_cache.get(key)
+    if cached is None:
+        cached = tuple(PEAK_FINDER_ENGINES[engine](y_data, sensitivity))
+        result_cache.put(key, cached)
+    return list(cached)
+
+def classic_peak_finder(y_data, sensitivity):
+    """
+       The original peak finder.  Walks left and right from every candidate peak one point
+       at a time, re-sorting the timeseries after each peak.  See peak_finder for the
+       description of the input and output.
+    """
     # number of timepoints in the data series
     num_timepoints = len(y_data);
     #print "num_timepoints = %d" % num_timepoints
@@ -235,6 +1228,11 @@ def peak_finder(y_data, sensitivity):
     
     #print        "combo_sort_by_TC = %s\nsort_TC_index = %s" % (combo_sort_by_TC,sort_TC_index)
     
+    # walk and re-sort time and the points compared by the walks, for the profiler
+    profiling = profiler is not None
+    walk_seconds = sort_seconds = 0.0
+    walk_steps = resorts = 0
+
     # Go through all time points
     for i in range(0,num_timepoints):
         #print "NEXT TIMEPOINT i = %d" %i
@@ -242,6 +1240,8 @@ def peak_finder(y_data, sensitivity):
         
         # If the current time point is a peak.
         if combo_sort_by_TC[i][1] == 1:
+            if profiling:
+                started = clock()
             j=1
             left_sig=0 #1 = significant ; -1 = insignificant
             # while left side not significant and not the beginning or end points and whose left point isn't at time position 0 (out of bounds)
@@ -283,6 +1283,7 @@ def peak_finder(y_data, sensitivity):
                 #print 'while loop left i=%d num_timepoints=%d left_sig=%d sort_TC_index[i]=%d sort_TC_index[i]-j=%d' % (i,num_timepoints,left_sig,sort_TC_index[i],sort_TC_index[i]-j)
 
             #print 'end compare left while'
+            walk_steps += j-1
             j=1
             right_sig=0 #1 = significant ; -1 = insignificant
 
@@ -329,6 +1330,10 @@ def peak_finder(y_data, sensitivity):
                         raise UnknownError, 'problem: shouldnt get here --  end peaks were not set properly. (Must be either a peak or valley)'  
                 
                 j=j+1
+            walk_steps += j-1
+            if profiling:
+                walk_seconds += clock()-started
+                started = clock()
 
             # Rebuild the combo sorted by time course to include the lost peaks (if peak was significant it wont be lost)
             #[sorted_timecourse,sort_TC_index] = sort(combo_sort_by_TP(:,1));
@@ -346,6 +1351,13 @@ def peak_finder(y_data, sensitivity):
             combo_sort_by_TC.reverse()
     
             sort_TC_index.reverse()
+            resorts += 1
+            if profiling:
+                sort_seconds += clock()-started
+    if profiling:
+        profiler.record('peak_finder.walks', walk_seconds, num_timepoints, walk_steps)
+        profiler.record('peak_finder.sort', sort_seconds, num_timepoints, resorts)
+        started = clock()
     #print "combo_sort_by_TP %s" % combo_sort_by_TP
     #---------SET VALLEYS--------------------------------
     # Valleys are set as the lowest point between two peaks.
@@ -354,6 +1366,7 @@ def peak_finder(y_data, sensitivity):
     no_first = 1 
     # initialize the low valley as the highest point, so valley will be guaranteed to be lower.
     low_valley = max(combo_sort_by_TP[0])
+    low_valley_position = None
     #print 'low_valley = %f' % low_valley
     for i in range(0,num_timepoints):
         if (combo_sort_by_TP[1][i] == 1): 
@@ -362,6 +1375,8 @@ def peak_finder(y_data, sensitivity):
                 low_valley = max(combo_sort_by_TP[0])
             else:
                 # if its a peak (but not the first one) set the low valley for the previous section and reset the low valley
+                if low_valley_position is None:
+                    raise UnknownError, 'problem: no point below the highest value before the second peak, so no valley can be set.'
                 combo_sort_by_TP[1][low_valley_position] = -1
                 low_valley = max(combo_sort_by_TP[0])
         if (combo_sort_by_TP[0][i]<low_valley):
@@ -369,5 +1384,1451 @@ def peak_finder(y_data, sensitivity):
             low_valley_position = i
     
     #print        "combo_sort_by_TP %s" % combo_sort_by_TP
+    if profiling:
+        profiler.record('peak_finder.valleys', clock()-started, num_timepoints)
     return combo_sort_by_TP[1]
-    
\ No newline at end of file
+    
+
+def calculate_peak_valley_vectorized(y_data):
+    "numpy version of calculate_peak_valley.  Returns an int8 array instead of a list"
+    y_data = numpy.asarray(y_data, dtype=float)
+    num_timepoints = len(y_data)
+    peak_valley = numpy.zeros(num_timepoints, dtype=numpy.int8)
+    diff_y_data = numpy.diff(y_data)
+    rising = diff_y_data >= 0
+
+    # a peak is wherever a non-negative slope turns negative (ignoring the endpoints)
+    peak_valley[1:num_timepoints-2] = rising[0:num_timepoints-3] & ~rising[1:num_timepoints-2]
+
+    # endpoints are always either a peak or a valley
+    peak_valley[0] = -1 if diff_y_data[0] > 0 else 1
+    peak_valley[-1] = 1 if diff_y_data[-1] > 0 else -1
+    return peak_valley
+
+def min_table(y_data):
+    """
+       Sparse table of running minima.  Level l holds min(y_data[i:i+2**l]) at position i,
+       so the minimum of any power of two window is a single lookup.
+    """
+    table = [numpy.asarray(y_data, dtype=float)]
+    width = 1
+    while 2*width <= len(y_data):
+        level = table[-1]
+        table.append(numpy.minimum(level[:-width], level[width:]))
+        width *= 2
+    return table
+
+def drop_positions(y_data, peaks, min_jump, table=None):
+    """
+       For every index in peaks find the closest point on either side which lies more than
+       min_jump below the peak, which is where the left/right walk of the peak finder stops.
+       Returns two arrays (left, right); -1 and len(y_data) mean no such point exists.
+    """
+    y_data = numpy.asarray(y_data, dtype=float)
+    num_timepoints = len(y_data)
+    if table is None:
+        table = min_table(y_data)
+    peaks = numpy.asarray(peaks, dtype=int)
+    height = y_data[peaks]
+
+    # binary lifting: skip the largest power of two windows which hold no significant drop
+    left = peaks.copy()
+    right = peaks + 1
+    for level in xrange(len(table)-1, -1, -1):
+        width = 1 << level
+        start = left - width
+        fits = start >= 0
+        skip = fits & ~(height - table[level][numpy.where(fits, start, 0)] > min_jump)
+        left = numpy.where(skip, start, left)
+
+        fits = right + width <= num_timepoints
+        skip = fits & ~(height - table[level][numpy.where(fits, right, 0)] > min_jump)
+        right = numpy.where(skip, right + width, right)
+    return left - 1, right
+
+def vectorized_peak_finder(y_data, sensitivity):
+    """
+       numpy peak finder which returns the same array as classic_peak_finder.
+
+       Rather than walking from every peak one point at a time, the place where each walk
+       stops (the first point more than min_jump below the peak) is found for all candidate
+       peaks at once with drop_positions.  The walks are then taken once each in the order
+       of walk_groups, each flagging the candidates it would have passed.
+    """
+    y = numpy.asarray(y_data, dtype=float)
+    num_timepoints = len(y)
+    if num_timepoints < 3:
+        return classic_peak_finder(y_data, sensitivity)
+    min_jump = (y.max()-y.min())*sensitivity
+    last = num_timepoints-1
+
+    peak_valley = calculate_peak_valley_vectorized(y)
+    candidates = numpy.flatnonzero(peak_valley == 1)
+    # candidates which the walks compare against.  The second point is skipped by the
+    # left walk, the last point is handled by the end point rule.
+    compared = candidates[(candidates > 1) & (candidates < last)]
+    compared_list = compared.tolist()
+
+    groups = walk_groups(y, peak_valley)
+    # a point of a group walks only while enough points of the group are flagged as peaks,
+    # which can only become fewer, so the first points of each group are all that can walk
+    walkers = [position for group, flagged in groups for position in group[:flagged]
+               if 0 < position < last]
+
+    profiling = profiler is not None
+    if profiling:
+        started = clock()
+        walk_steps = 0
+    left_stop = numpy.zeros(num_timepoints, dtype=int)
+    right_stop = numpy.zeros(num_timepoints, dtype=int)
+    if walkers:
+        left_stop[walkers], right_stop[walkers] = drop_positions(y, walkers, min_jump)
+
+    for group, flagged in groups:
+        # walks from higher values may have removed flags in the group since
+        flagged = int((peak_valley[group] == 1).sum())
+        walked = 0
+        while walked < flagged:
+            peak = group[walked]
+            walked += 1
+            if peak == 0 or peak == last:
+                # the end points never walk
+                continue
+            height = y[peak]
+            significant = True
+
+            #----------COMPARE TO THE LEFT-------------------------------
+            stop = max(left_stop[peak], 0)
+            if profiling:
+                walk_steps += peak - stop
+            passed = compared[bisect_left(compared_list, stop):bisect_left(compared_list, peak)]
+            if not flag_passed_peaks(passed, peak_valley, y, height):
+                significant = False
+            if stop == 0:
+                # reached the beginning of the time course
+                if peak_valley[0] == 0:
+                    raise UnknownError, 'problem: shouldnt get here --  end peaks were not set properly. (Must be either a peak or valley)'
+                if peak_valley[0] == 1:
+                    significant = False
+                    if height - y[0] > 0:
+                        peak_valley[0] = 0
+
+            #--------------COMPARE TO THE RIGHT-------------------------------
+            stop = min(right_stop[peak], last)
+            if profiling:
+                walk_steps += stop - peak
+            passed = compared[bisect_right(compared_list, peak):bisect_right(compared_list, stop)]
+            if not flag_passed_peaks(passed, peak_valley, y, height):
+                significant = False
+            if stop == last:
+                # reached the end of the time course
+                if peak_valley[last] == 0:
+                    raise UnknownError, 'problem: shouldnt get here --  end peaks were not set properly. (Must be either a peak or valley)'
+                if peak_valley[last] == 1:
+                    significant = False
+
+            if not significant and peak_valley[peak] == 1:
+                peak_valley[peak] = 0
+                flagged -= 1
+
+    if profiling:
+        profiler.record('peak_finder.walks', clock()-started, num_timepoints, walk_steps)
+        started = clock()
+    set_valleys(y, peak_valley)
+    if profiling:
+        profiler.record('peak_finder.valleys', clock()-started, num_timepoints)
+    return peak_valley.tolist()
+
+def walk_groups(y_data, peak_valley):
+    """
+       The order in which classic_peak_finder walks.  The classic engine visits the points by
+       descending (value, position), but checks the peak flag of the point at the same rank
+       by descending (value, flag).  Within a group of tied values it therefore walks from
+       the highest positions first, one position for each point of the group still flagged
+       as a peak, whether or not the position it walks from is a peak itself.
+
+       Returns a list of (positions, flagged) pairs from the highest value to the lowest,
+       positions being the points holding the value in descending order and flagged the
+       number of them flagged as a peak in peak_valley before any walk.  Walks only ever
+       remove flags, so values held by no flagged point are left out.
+    """
+    num_timepoints = len(y_data)
+    order = numpy.lexsort((-numpy.arange(num_timepoints), -y_data))
+    descending = y_data[order]
+    starts = numpy.flatnonzero(numpy.r_[True, descending[1:] != descending[:-1]])
+    ends = numpy.r_[starts[1:], num_timepoints]
+    flagged = numpy.add.reduceat((peak_valley[order] == 1).astype(int), starts)
+    groups = []
+    for group in numpy.flatnonzero(flagged).tolist():
+        groups.append((order[starts[group]:ends[group]].tolist(), int(flagged[group])))
+    return groups
+
+def set_valleys(y_data, peak_valley, table=None):
+    """
+       Marks the lowest point between each pair of consecutive peaks as a valley (-1), in
+       place on the numpy array peak_valley.  With an argmin_table of y_data each lowest
+       point is a constant time lookup instead of a scan.
+    """
+    highest = y_data.max()
+    low_valley_position = None
+    start = 0
+    for count, peak in enumerate(numpy.flatnonzero(peak_valley == 1).tolist()):
+        if peak > start:
+            if table is None:
+                position = start + int(y_data[start:peak].argmin())
+            else:
+                position = lowest_point(y_data, table, start, peak)
+            if y_data[position] < highest:
+                low_valley_position = position
+        if count:
+            if low_valley_position is None:
+                raise UnknownError, 'problem: no point below the highest value before the second peak, so no valley can be set.'
+            peak_valley[low_valley_position] = -1
+        start = peak
+
+def flag_passed_peaks(passed, peak_valley, y_data, height):
+    """
+       Applies the peak rules to the candidates a walk from a point of the given height passed
+       over.  Candidates lower than the walking point become insignificant.  Returns False if
+       a candidate at least as high is still a peak, making the walking point insignificant.
+    """
+    if not len(passed):
+        return True
+    lower = y_data[passed] < height
+    survived = (peak_valley[passed[~lower]] == 1).any()
+    peak_valley[passed[lower]] = 0
+    return not survived
+
+PEAK_FINDER_ENGINES = {'classic': classic_peak_finder}
+if numpy is not None:
+    PEAK_FINDER_ENGINES['vectorized'] = vectorized_peak_finder
+PEAK_FINDER_ENGINE = 'vectorized' if numpy is not None else 'classic'
+
+INFINITY = float('inf')
+
+def argmin_table(y_data):
+    """
+       Sparse table of running argmins.  Level l holds the position of min(y_data[i:i+2**l]),
+       so the lowest point of any window takes two lookups (see lowest_point).
+    """
+    y_data = numpy.asarray(y_data, dtype=float)
+    table = [numpy.arange(len(y_data))]
+    width = 1
+    while 2*width <= len(y_data):
+        level = table[-1]
+        first, second = level[:-width], level[width:]
+        table.append(numpy.where(y_data[second] < y_data[first], second, first))
+        width *= 2
+    return table
+
+def lowest_point(y_data, table, start, end):
+    "Returns the position of the lowest point in y_data[start:end] (the first one on ties)"
+    level = (end-start).bit_length()-1
+    first = int(table[level][start])
+    second = int(table[level][end-(1 << level)])
+    if y_data[second] < y_data[first]:
+        return second
+    return first
+
+def interval_union(intervals):
+    "Merges a list of [start, end) intervals into a sorted list of disjoint intervals"
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        elif start < end:
+            merged.append((start, end))
+    return merged
+
+def interval_difference(intervals, removed):
+    "Returns the parts of the sorted disjoint intervals which are not covered by removed"
+    removed = interval_union(removed)
+    difference = []
+    for start, end in intervals:
+        for cut_start, cut_end in removed:
+            if cut_end <= start or cut_start >= end:
+                continue
+            if cut_start > start:
+                difference.append((start, cut_start))
+            start = cut_end
+            if start >= end:
+                break
+        if start < end:
+            difference.append((start, end))
+    return difference
+
+def interval_intersection(first, second):
+    "Returns the parts covered by both lists of intervals"
+    return interval_union([(max(start, other_start), min(end, other_end))
+                           for start, end in first for other_start, other_end in second
+                           if max(start, other_start) < min(end, other_end)])
+
+def interval_clip(intervals, lower):
+    "Returns the parts of the sorted disjoint intervals at or above lower"
+    return [(max(start, lower), end) for start, end in intervals if end > lower]
+
+def interval_depth(added, removed, depth):
+    """
+       Returns the sorted disjoint intervals covered by more than depth of the lists of
+       intervals in added, each interval in removed taking one cover away
+    """
+    events = []
+    for intervals in added:
+        for start, end in intervals:
+            events += [(start, 1), (end, -1)]
+    for start, end in removed:
+        events += [(start, -1), (end, 1)]
+    events.sort()
+    covered = []
+    count = 0
+    for i in xrange(len(events)-1):
+        count += events[i][1]
+        if count > depth and events[i][0] < events[i+1][0]:
+            covered.append((events[i][0], events[i+1][0]))
+    return interval_union(covered)
+
+def interval_contains(intervals, value):
+    "True if value lies in one of the intervals"
+    for start, end in intervals:
+        if start <= value < end:
+            return True
+    return False
+
+class SignificanceIndex(object):
+    """
+       Precomputed significance of every candidate peak of a timeseries, for running
+       peak_finder at many sensitivity levels.
+
+       The result of peak_finder only changes with the sensitivity when one of the
+       left/right walks starts stopping at a different point.  For each candidate peak from
+       calculate_peak_valley the index stores the min_jump values for which the peak is
+       significant as a list of [start, end) intervals.  For almost every peak that is a
+       single interval starting at 0, whose end is the critical sensitivity of the peak.  A
+       peak which is made insignificant by a higher neighbour that itself drops out at a
+       larger sensitivity gets more than one interval.  Looking up a sensitivity is then a
+       check per candidate plus placing the valleys, and gives the same array as peak_finder.
+       Repeated values are walked in the order of walk_groups, a point of a group walking for
+       the min_jump values at which enough points of the group are still flagged.
+
+       Timeseries with fewer than 3 points are not indexed and peak_finder is simply called
+       for every lookup.
+
+       critical_sensitivity:
+       Dictionary of candidate peak position -> the largest sensitivity at which the peak is
+       still significant (the end of its last interval, inf if it never becomes insignificant,
+       None if it is never significant).
+    """
+    def __init__(self, y_data):
+        self.y_data = y_data
+        y = numpy.asarray(y_data, dtype=float)
+        num_timepoints = len(y)
+        self.indexed = num_timepoints >= 3
+        self.critical_sensitivity = {}
+        if not self.indexed:
+            return
+        self.y = y
+        self.jump_range = y.max()-y.min()
+        self.table = argmin_table(y)
+        self.peak_valley = calculate_peak_valley_vectorized(y)
+        candidates = numpy.flatnonzero(self.peak_valley == 1)
+        last = num_timepoints-1
+        interior = candidates[(candidates > 0) & (candidates < last)].tolist()
+        heights = y.tolist()
+        first_is_peak = self.peak_valley[0] == 1
+        last_is_peak = self.peak_valley[-1] == 1
+
+        def lowest(start, end):
+            if start >= end:
+                return INFINITY
+            return heights[lowest_point(y, self.table, start, end)]
+
+        # lowest point between each candidate and the one before it
+        gaps = [INFINITY]
+        if len(interior) > 1:
+            bounds = numpy.empty(2*len(interior)-2, dtype=int)
+            bounds[0::2] = numpy.array(interior[:-1]) + 1
+            bounds[1::2] = interior[1:]
+            gaps += numpy.minimum.reduceat(y, bounds)[0::2].tolist()
+
+        # Take the walks in the order of walk_groups like the peak finder does, working
+        # with sets of min_jump values instead of a single one.  A walk from peak passes
+        # another candidate when min_jump >= the drop between them, and the candidates a
+        # walk passes are compared exactly as in vectorized_peak_finder: a candidate at
+        # least as high which is still flagged makes the walking point insignificant, a
+        # lower one is made insignificant by the walking point.
+        killed = dict((peak, []) for peak in interior)
+        significant = {}
+        zeroed = []     # min_jump values for which the first point has lost its peak
+        errors = []     # min_jump values for which the classic engine raises UnknownError
+        everything = [(-INFINITY, INFINITY)]
+        for group, flagged in walk_groups(y, self.peak_valley):
+            # the min_jump values for which each point of the group is flagged as a peak
+            flags = []
+            for peak in group:
+                if peak in killed:
+                    significant[peak] = interval_difference(everything, killed.pop(peak))
+                    flags.append(significant[peak])
+                elif peak == 0 and first_is_peak:
+                    flags.append(interval_difference(everything, zeroed))
+                elif peak == last and last_is_peak:
+                    flags.append(everything)
+            lost = []
+            for walked, peak in enumerate(group):
+                # the point walks while more points of the group than have walked are flagged
+                alive = interval_depth(flags, lost, walked)
+                if not alive:
+                    break
+                if peak == 0 or peak == last:
+                    continue
+                dead = []
+                height = heights[peak]
+                reach = alive[-1][1]
+                position = bisect_left(interior, peak)
+                following = position + (peak in significant)
+                walks = (xrange(position-1, -1, -1), xrange(following, len(interior)))
+                for side, walk in enumerate(walks):
+                    low = INFINITY
+                    for i in walk:
+                        other = interior[i]
+                        if i == position-1 or i == following:
+                            # the walking point need not be a candidate, so the first gap
+                            # is looked up rather than taken from gaps
+                            low = lowest(peak+1, other) if side else lowest(other+1, peak)
+                        else:
+                            low = min(low, gaps[i+1-side])
+                        jump = height - low
+                        if jump >= reach:
+                            break
+                        if other == 1:
+                            continue
+                        if other in significant:
+                            if significant[other]:
+                                dead.extend(interval_clip(significant[other], jump))
+                        elif len(alive) == 1:
+                            killed[other].append((max(alive[0][0], jump), reach))
+                        else:
+                            killed[other].extend(interval_clip(alive, jump))
+                if first_is_peak:
+                    reached = interval_clip(alive, height - lowest(1, peak))
+                    dead.extend(reached)
+                    errors.extend(interval_intersection(reached, zeroed))
+                    if height - heights[0] > 0:
+                        zeroed = interval_union(zeroed + reached)
+                if last_is_peak:
+                    dead.extend(interval_clip(alive, height - lowest(peak+1, last)))
+                if peak in significant:
+                    removed = interval_intersection(interval_intersection(alive, significant[peak]),
+                                                    interval_union(dead))
+                    significant[peak] = interval_difference(significant[peak], removed)
+                    lost.extend(removed)
+
+        self.zeroed = zeroed
+        self.errors = interval_union(errors)
+        self.interior = numpy.array(interior, dtype=int)
+        owners = []
+        starts = []
+        ends = []
+        for peak, intervals in significant.iteritems():
+            for start, end in intervals:
+                owners.append(peak)
+                starts.append(start)
+                ends.append(end)
+            if not intervals:
+                self.critical_sensitivity[peak] = None
+            elif intervals[-1][1] == INFINITY:
+                self.critical_sensitivity[peak] = INFINITY
+            else:
+                self.critical_sensitivity[peak] = intervals[-1][1]/self.jump_range
+        self.owners = numpy.array(owners, dtype=int)
+        self.starts = numpy.array(starts, dtype=float)
+        self.ends = numpy.array(ends, dtype=float)
+
+    def peak_finder(self, sensitivity):
+        "Returns the same array as peak_finder(y_data, sensitivity)"
+        if not self.indexed:
+            return peak_finder(self.y_data, sensitivity)
+        min_jump = self.jump_range*sensitivity
+        if interval_contains(self.errors, min_jump):
+            raise UnknownError, 'problem: shouldnt get here --  end peaks were not set properly. (Must be either a peak or valley)'
+        peak_valley = self.peak_valley.copy()
+        peak_valley[self.interior] = 0
+        peak_valley[self.owners[(self.starts <= min_jump) & (min_jump < self.ends)]] = 1
+        if peak_valley[0] == 1 and interval_contains(self.zeroed, min_jump):
+            peak_valley[0] = 0
+        set_valleys(self.y, peak_valley, self.table)
+        return peak_valley.tolist()
+
+    def sweep(self, sensitivities):
+        "Returns the peak_finder array for each sensitivity in sensitivities"
+        return [self.peak_finder(sensitivity) for sensitivity in sensitivities]
+
+def peak_finder_sweep(y_data, sensitivities):
+    """
+       Runs peak_finder on y_data at every sensitivity level in sensitivities, building a
+       SignificanceIndex once instead of repeating the peak finding for each level.
+       Returns a list with the peak_finder array of each sensitivity.
+    """
+    return SignificanceIndex(y_data).sweep(sensitivities)
+
+class ResultCache(object):
+    """
+       Least recently used cache for the results of generate and peak_finder, keyed on a
+       hash of their input (see content_key).
+
+       max_entries:
+       Maximum number of results kept.
+
+       max_bytes:
+       Maximum approximate memory used by the kept results.
+
+       Results are stored as tuples and callers get a fresh list back on every hit, so
+       changing a returned array can not corrupt the cache.  hits, misses and evictions
+       count the lookups since the cache was created or cleared.  Each process has its own
+       cache, the workers of generate_parallel do not share one.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        "Drops every result and resets the counters"
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        "Returns the result stored under key, or None"
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        "Stores a result, evicting the least recently used ones beyond the limits"
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def stats(self):
+        "Returns a dictionary with the size of the cache and its counters"
+        return {'entries': len(self.entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# cache used by generate and peak_finder, None when caching is off
+result_cache = None
+
+def enable_cache(max_entries=1024, max_bytes=64*1024*1024):
+    "Turns on result caching for generate and peak_finder with a new, empty cache.  Returns the cache"
+    global result_cache
+    result_cache = ResultCache(max_entries, max_bytes)
+    return result_cache
+
+def disable_cache():
+    "Turns off result caching and drops the cached results"
+    global result_cache
+    result_cache = None
+
+def content_key(*parts):
+    "Returns a hash of the content of parts (numbers, strings, None, lists of these, numpy arrays or TimeCourses)"
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, TimeCourse):
+            # empty values are nan in the buffer, so values and time points are the content
+            digest.update(content_key(part.values, part.time_points))
+        elif numpy is not None and isinstance(part, numpy.ndarray):
+            digest.update('%s%r' % (part.dtype, part.shape))
+            digest.update(numpy.ascontiguousarray(part).tostring())
+        else:
+            digest.update(repr(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+def result_size(value):
+    "Approximate number of bytes used by a result made of tuples, lists, strings and numbers"
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(result_size(item) for item in value)
+    return size
+
+#----Resampling--------------------------------------------
+
+# interpolation weights of the (source grid, target grid) pairs seen so far
+interpolation_weight_cache = ResultCache(max_entries=256, max_bytes=16*1024*1024)
+
+def grid_key(time_points):
+    "A hashable form of a time grid"
+    return tuple(float(time_point) for time_point in time_points)
+
+def group_by_grid(time_points_list):
+    """
+     Groups signals by identical time grid.  time_points_list holds the time_points of every
+     signal.  Returns an OrderedDict grid (a tuple) -> indexes of the signals on that grid,
+     in the order the grids first appear.
+    """
+    groups = OrderedDict()
+    for i, time_points in enumerate(time_points_list):
+        groups.setdefault(grid_key(time_points), []).append(i)
+    return groups
+
+def interpolation_weights(source_grid, target_grid):
+    """
+     Returns (left, right, weight) for projecting values on source_grid onto target_grid:
+     value at target point k = values[left[k]]*(1-weight[k]) + values[right[k]]*weight[k].
+     Target points outside the source grid get left = right = -1.  The weights of each pair
+     of grids are computed once and kept in interpolation_weight_cache; the returned arrays
+     are read-only.
+    """
+    source = numpy.asarray(source_grid, dtype=float)
+    target = numpy.asarray(target_grid, dtype=float)
+    key = content_key('interpolation_weights', source, target)
+    weights = interpolation_weight_cache.get(key)
+    if weights is not None:
+        return weights
+    if len(source) < 1 or (numpy.diff(source) <= 0).any():
+        raise TimePointsMismatchWithTimeCourse, "a source grid must have increasing time points."
+
+    right = numpy.searchsorted(source, target).clip(1, max(len(source)-1, 1))
+    left = right - 1
+    if len(source) == 1:
+        left = right = numpy.zeros(len(target), dtype=int)
+        weight = numpy.zeros(len(target))
+    else:
+        weight = (target - source[left]) / (source[right] - source[left])
+    # exact hits on the last source point interpolate to it, anything else outside is empty
+    outside = (target < source[0]) | (target > source[-1])
+    left[outside] = -1
+    right[outside] = -1
+    weight[outside] = 0
+    weights = (left, right, weight)
+    # shared by every later call, so they must not be changed
+    for array in weights:
+        array.flags.writeable = False
+    interpolation_weight_cache.put(key, weights)
+    return weights
+
+def resample(time_courses_2d, source_grid, target_grid):
+    """
+     Projects an (S, N) array of timecourses on source_grid onto target_grid by linear
+     interpolation in time.  Target points outside the source grid, and target points next to
+     an empty (nan) source value, are empty (nan).  Returns an (S, T) array.
+    """
+    values = numpy.array(time_courses_2d, dtype=float, ndmin=2)
+    left, right, weight = interpolation_weights(source_grid, target_grid)
+    resampled = values[:, left]*(1-weight) + values[:, right]*weight
+    # exact hits on a source point ignore the other neighbour, which may be empty
+    resampled[:, weight == 0] = values[:, left[weight == 0]]
+    resampled[:, weight == 1] = values[:, right[weight == 1]]
+    resampled[:, left < 0] = numpy.nan
+    return resampled
+
+def resample_batch(time_courses, time_points_list, target_grid):
+    """
+     Projects signals on mixed time grids onto one target grid, so they can be passed to
+     generate_batch together.
+
+     time_courses:
+     An array of S timecourses, each as passed to generate (None for empty values).
+
+     time_points_list:
+     The time_points of every timecourse.
+
+     Signals sharing a grid are resampled together with one set of interpolation weights;
+     signals already on the target grid are copied.  Returns an (S, T) array with nan for
+     empty values.
+    """
+    if len(time_courses) != len(time_points_list):
+        raise TimePointsMismatchWithTimeCourse, "%d time courses but %d time grids were given." % (len(time_courses), len(time_points_list))
+    target = grid_key(target_grid)
+    resampled = numpy.empty((len(time_courses), len(target)))
+    for grid, indexes in group_by_grid(time_points_list).items():
+        rows = numpy.array([[numpy.nan if value is None else value for value in time_courses[i]] for i in indexes],
+                           dtype=float, ndmin=2)
+        if rows.shape[1] != len(grid):
+            raise TimePointsMismatchWithTimeCourse, "time course %d has %d values but %d time points were given." % (indexes[0], rows.shape[1], len(grid))
+        resampled[indexes] = rows if grid == target else resample(rows, grid, target)
+    return resampled
+
+def generate_grouped(time_courses, time_points_list, labels, sensitivity, metric_select, missing_policy=None):
+    """
+     Runs generate_batch once for every group of signals sharing a time grid, without
+     resampling.  Arguments as for resample_batch and generate_batch.
+
+     OUTPUT: (headers, values)
+     headers[i] and values[i] are what generate returns for signal i, values[i] as an array.
+    """
+    if labels is None:
+        labels = [None]*len(time_courses)
+    headers = [None]*len(time_courses)
+    values = [None]*len(time_courses)
+    for grid, indexes in group_by_grid(time_points_list).items():
+        rows = [[numpy.nan if value is None else value for value in time_courses[i]] for i in indexes]
+        group_headers, matrix = generate_batch(rows, grid, [labels[i] for i in indexes],
+                                               sensitivity, metric_select, missing_policy)
+        for row, i in enumerate(indexes):
+            headers[i] = group_headers[row]
+            values[i] = matrix[row]
+    return headers, values
+
+#----Streaming---------------------------------------------
+
+def extend_lowest_table(table, values):
+    """
+     Adds the last of values to a sparse table of range minima: table[k][i] is the position
+     of the first lowest of values[i:i+2**k].  Constant time per level.
+    """
+    count = len(values)
+    if not table:
+        table.append([])
+    table[0].append(count-1)
+    level = 1
+    while (1 << level) <= count:
+        if len(table) == level:
+            table.append([])
+        lower = table[level-1]
+        start = count - (1 << level)
+        left = lower[start]
+        right = lower[start + (1 << (level-1))]
+        table[level].append(left if values[left] <= values[right] else right)
+        level += 1
+
+def lowest_position(table, values, start, stop):
+    "Returns the position of the first lowest of values[start:stop] (stop > start)"
+    level = (stop - start).bit_length() - 1
+    left = table[level][start]
+    right = table[level][stop - (1 << level)]
+    return left if values[left] <= values[right] else right
+
+def add_interval(tree, start, stop, item):
+    "Stores item at the nodes of a segment tree (a list of 2*size lists) covering positions start to stop"
+    size = len(tree)//2
+    start += size
+    stop += size+1
+    while start < stop:
+        if start & 1:
+            tree[start].append(item)
+            start += 1
+        if stop & 1:
+            stop -= 1
+            tree[stop].append(item)
+        start >>= 1
+        stop >>= 1
+
+def remove_interval(tree, start, stop, item):
+    "Removes an item stored by add_interval"
+    size = len(tree)//2
+    start += size
+    stop += size+1
+    while start < stop:
+        if start & 1:
+            tree[start].remove(item)
+            start += 1
+        if stop & 1:
+            stop -= 1
+            tree[stop].remove(item)
+        start >>= 1
+        stop >>= 1
+
+def covering(tree, position):
+    "Returns the items stored by add_interval for the intervals holding position"
+    node = position + len(tree)//2
+    items = []
+    while node:
+        items.extend(tree[node])
+        node >>= 1
+    return items
+
+class WalkGroup(object):
+    """
+     The points of a streamed time course holding one value, which walk_groups walks
+     together, from the last point back.  walked counts the points which take their turn,
+     flagged holds the compared candidates flagged as peaks when the group walks,
+     flag_count counts every point flagged then, and failures those which walk and lose
+     the flag.
+    """
+    def __init__(self, value):
+        self.value = value
+        self.positions = []
+        self.flagged = []
+        self.flag_count = 0
+        self.walked = 0
+        self.failures = 0
+        self.dirty = set()
+        self.queued = False
+
+class TimeCourseAccumulator(object):
+    """
+     Metrics of a timecourse which arrives one timepoint at a time.
+     Input format: TimeCourseAccumulator(sensitivity, TC_label)
+
+     sensitivity, TC_label:
+     As for generate.
+
+     append adds a timepoint and keeps the running sum, the cumulative trapezoid index, the
+     maximum, the derivatives and the sum of the last 25% of the values (the Equilibrium
+     window) up to date in constant time.  generate then returns what generate returns for
+     the timepoints so far (the Equilibrium up to rounding, its window sum being updated
+     rather than summed again) and peak_finder what peak_finder returns for the values so far.
+
+     The peak state is kept up to date as well, without walking again.  vectorized_peak_finder
+     walks group by group (walk_groups), and a group only looks at what the higher groups
+     left behind, so the state is kept per group and a new point or a larger min_jump only
+     walks the groups whose input changed again, from the highest value down:
+
+     - A walk covers the points from its walker up to the nearest drop of more than min_jump
+       on either side.  These spans are kept in a segment tree, and only grow: a new point
+       can only lengthen the spans which reach the end, and a larger min_jump the spans whose
+       drops it passes (a heap of the drops).
+     - A compared candidate keeps its flag until a higher walk covers it, which is kept as
+       its witness.  When a walk stops, the widest higher walk holding it witnesses the
+       candidates in its span at once (a new highest point of a rising feed takes over from
+       the one before), and the others are looked at from the highest down as the groups
+       get to their values, so that a lower walk starting over them first takes them all.
+       Only the candidates whose flag changes are touched one by one.
+     - Within a group every span is the stretch above value - min_jump holding its walker,
+       so points of a group share a span or do not meet at all.  Of the flagged candidates
+       of a span only the first can survive its walk; the others see it and lose the flag.
+       It survives unless a higher peak lies in its span, its span reaches the beginning of a
+       time course which falls first or a rising end.
+     - The last walked points of a group walk, as long as the walks so far leave enough of
+       the group flagged, so the number of walkers only moves by the points which change.
+
+     peak_finder raises UnknownError for the same time courses as vectorized_peak_finder:
+     those which fall first, and where a walk above the first value and another walk both
+     reach the beginning.
+
+     Empty values can not be appended.
+    """
+    def __init__(self, sensitivity=None, TC_label=None):
+        self.sensitivity = sensitivity
+        self.label = TC_label
+        self.time_points = []
+        self.values = []
+        self.derivatives = []
+        self.area_index = []
+        self.total = 0
+        self.highest = None
+        self.lowest = None
+        self.window_start = 0
+        self.window_sum = 0
+        self.lowest_table = []
+        # peak state, None until there are 3 values (see start_peaks)
+        self.peak_valley = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, time_points, values):
+        "Appends many timepoints"
+        for time_point, value in zip(time_points, values):
+            self.append(time_point, value)
+
+    def append(self, time_point, value):
+        "Adds the next timepoint"
+        if value is None or value != value:
+            raise EmptyValueAppended, "empty values can not be appended to a streamed time course."
+        values = self.values
+        if values:
+            step = time_point - self.time_points[-1]
+            derivative = float(value - values[-1])/step
+            area = self.area_index[-1] + step * ((value + values[-1])/2.0)
+            self.derivatives.append(derivative)
+            self.area_index.append(area)
+            self.highest = max(self.highest, value)
+            self.lowest = min(self.lowest, value)
+        else:
+            self.area_index.append(0.0)
+            self.highest = self.lowest = value
+        self.time_points.append(time_point)
+        values.append(value)
+        self.total += value
+
+        # the window start moves by at most one timepoint
+        self.window_sum += value
+        window_start = len(values) - equilibrium_points(len(values))
+        while self.window_start < window_start:
+            self.window_sum -= values[self.window_start]
+            self.window_start += 1
+
+        extend_lowest_table(self.lowest_table, values)
+        if len(values) < 3:
+            return
+        if profiler is not None:
+            started = clock()
+            steps = self.steps if len(values) > 3 else 0
+        if len(values) == 3:
+            self.start_peaks()
+        else:
+            self.extend_peaks()
+        if profiler is not None:
+            profiler.record('accumulator.peaks', clock()-started, len(values), self.steps - steps)
+
+    def peak_sensitivity(self):
+        return DEFAULT_SENSITIVITY if self.sensitivity is None else self.sensitivity
+
+    def lowest_between(self, start, stop):
+        return lowest_position(self.lowest_table, self.values, start, stop)
+
+    #----peak state: the outcome of the walks of vectorized_peak_finder, one point at a time
+
+    def start_peaks(self):
+        "Sets the peak state up for the first 3 values"
+        y = self.values
+        self.min_jump = (self.highest - self.lowest)*self.peak_sensitivity()
+        self.falls_first = y[1] <= y[0]
+        self.rising_end = y[2] > y[1]
+        self.first_candidate = False
+        self.peak_valley = [0 if self.falls_first else -1, 0, 0 if self.rising_end else -1]
+        self.peaks = []
+        # work done, for the profiler
+        self.steps = 0
+        # the groups by value, and those to walk again (a heap of negated values)
+        self.groups = {}
+        self.queue = []
+        # points flagged when their group walks, and whether those which walk lose the flag
+        self.start_flagged = set()
+        self.failing = {}
+        # compared candidates, those a higher walk unflags (by the walker witnessing them), the
+        # others by position, and the lists stopped walks left to walk_groups, by increasing value
+        self.compared = set()
+        self.zeroed = set()
+        self.witnessed = {}
+        self.unzeroed = []
+        self.orphans = []
+        # the drops each walk stops at (right None while none follows), the spans in a
+        # segment tree, the walks reaching the end with no drop and those stopping at it
+        self.walks = {}
+        self.spans = [[] for i in xrange(8)]
+        self.open_walks = set()
+        self.ending = []
+        # walks reaching the beginning, and those of them above the first value
+        self.start_count = 0
+        self.start_above = 0
+        # min_jumps from which a drop stops being one (or two flagged candidates of a group meet)
+        self.expiry = []
+        for position in xrange(3):
+            self.add_member(position)
+        self.walk_groups()
+
+    def extend_peaks(self):
+        "Updates the peak state for the value just appended"
+        y = self.values
+        last = len(y)-1
+        if len(y) > len(self.spans)//2:
+            self.grow_spans()
+        min_jump = (self.highest - self.lowest)*self.peak_sensitivity()
+        if min_jump != self.min_jump:
+            self.min_jump = min_jump
+            self.expire()
+
+        # the old last point is now second to last, which is never a candidate, but walks
+        # when its group gets to it
+        previous = last-1
+        if self.is_peak(previous):
+            self.remove_peak(previous)
+        self.peak_valley[previous] = 0
+        self.mark(previous)
+        rising = y[last]-y[previous] > 0
+        self.peak_valley.append(0 if rising else -1)
+        changed = rising != self.rising_end
+        self.rising_end = rising
+        # walks stopping at the old last point no longer reach the end, the others which do
+        # may stop at the new one, and see a new end
+        for position in self.ending:
+            walk = self.walks.get(position)
+            if walk is not None and walk[1] == previous:
+                self.mark(position)
+        self.ending = []
+        for position in list(self.open_walks):
+            if y[position]-y[last] > min_jump:
+                self.remove_span(position)
+                self.walks[position][1] = last
+                self.open_walks.discard(position)
+                self.add_span(position)
+                self.watch_walk(position, 1)
+            if changed:
+                self.mark(position)
+        self.add_member(last)
+
+        candidate = last-2
+        if y[candidate]-y[candidate-1] >= 0 and y[candidate+1]-y[candidate] < 0:
+            if candidate == 1:
+                self.first_candidate = True
+            else:
+                self.compared.add(candidate)
+                if not self.find_witness(candidate):
+                    self.unzeroed.append(candidate)
+            self.mark(candidate)
+        self.walk_groups()
+
+    def add_member(self, position):
+        "Puts a new last point in its group, first in the order the group walks in"
+        value = self.values[position]
+        group = self.groups.get(value)
+        if group is None:
+            group = self.groups[value] = WalkGroup(value)
+        group.positions.append(position)
+        # the points walked before still walk, the last point only takes a turn
+        group.walked += 1
+        self.failing[position] = 0
+        self.mark(position)
+
+    def mark(self, position):
+        "Has the group of the point walk again from it"
+        group = self.groups[self.values[position]]
+        group.dirty.add(position)
+        if not group.queued:
+            group.queued = True
+            heapq.heappush(self.queue, -group.value)
+
+    def is_peak(self, position):
+        index = bisect_left(self.peaks, position)
+        return index < len(self.peaks) and self.peaks[index] == position
+
+    #----walks: the spans from a walker to the nearest drops, and the candidates they unflag
+
+    def drop_before(self, position, height):
+        "Returns the last point before position more than min_jump below height, -1 if there is none"
+        table = self.lowest_table
+        y = self.values
+        for level in xrange(len(table)-1, -1, -1):
+            width = 1 << level
+            self.steps += 1
+            if position >= width and not height - y[table[level][position-width]] > self.min_jump:
+                position -= width
+        return position-1
+
+    def drop_after(self, position, height):
+        "Returns the first point from position more than min_jump below height, None if there is none"
+        table = self.lowest_table
+        y = self.values
+        for level in xrange(len(table)-1, -1, -1):
+            width = 1 << level
+            self.steps += 1
+            if position + width <= len(y) and not height - y[table[level][position]] > self.min_jump:
+                position += width
+        return position if position < len(y) else None
+
+    def span(self, position):
+        "Returns the first and last point a walk covers, up to the end of the segment tree while it has no right drop"
+        left, right = self.walks[position]
+        return left+1, len(self.spans)//2-1 if right is None else right-1
+
+    def add_span(self, position):
+        start, stop = self.span(position)
+        add_interval(self.spans, start, stop, position)
+
+    def remove_span(self, position):
+        start, stop = self.span(position)
+        remove_interval(self.spans, start, stop, position)
+
+    def grow_spans(self):
+        "Doubles the segment tree of the spans"
+        self.spans = [[] for i in xrange(2*len(self.spans))]
+        for position in self.walks:
+            self.add_span(position)
+
+    def watch_walk(self, position, side):
+        "Keeps the min_jump from which the drop on one side (0 left, 1 right) stops the walk no more"
+        y = self.values
+        drop = self.walks[position][side]
+        if drop is None:
+            self.open_walks.add(position)
+        elif drop >= 0:
+            heapq.heappush(self.expiry, (y[position] - y[drop], side, position, drop))
+            if drop == len(y)-1:
+                self.ending.append(position)
+
+    def walk_from(self, position):
+        "Starts a walk"
+        height = self.values[position]
+        self.walks[position] = [self.drop_before(position, height), self.drop_after(position+1, height)]
+        self.add_span(position)
+        self.watch_walk(position, 0)
+        self.watch_walk(position, 1)
+        left, right = self.walks[position]
+        self.count_start(position, 1)
+        # a lower walk holding the span of a walk stopped before holds every candidate that
+        # one left, and witnesses those not flagged again yet (all lower than it)
+        for orphans in list(self.orphans):
+            self.steps += 1
+            if left < orphans[0] and (right is None or orphans[0] < right):
+                self.orphans.remove(orphans)
+                self.give(position, orphans)
+        self.unflag(position, left, right)
+
+    def stop_walk(self, position):
+        """
+         Ends a walk.  The candidates it witnessed are flagged again, from the highest down,
+         as walk_groups gets to their values, unless another walk witnesses them by then.
+        """
+        y = self.values
+        self.remove_span(position)
+        self.count_start(position, -1)
+        del self.walks[position]
+        self.open_walks.discard(position)
+        witnessed = self.witnessed.pop(position, [])
+        if not witnessed:
+            return
+        # the widest higher walk holding the walker, such as a new highest point of a rising
+        # feed, holds most of them and witnesses those in its span at once
+        heir = None
+        for walker in covering(self.spans, position):
+            self.steps += 1
+            if y[walker] > y[position] and (heir is None or y[walker] < y[heir]):
+                heir = walker
+        if heir is not None:
+            left, right = self.walks[heir]
+            witnessed.sort()
+            start = bisect_right(witnessed, left)
+            stop = len(witnessed) if right is None else bisect_left(witnessed, right)
+            if start < stop:
+                self.give(heir, witnessed[start:stop])
+                witnessed[start:stop] = []
+            if not witnessed:
+                return
+        witnessed.sort(key=y.__getitem__)
+        self.orphans.append(witnessed)
+
+    def give(self, walker, candidates):
+        "Makes a walker the witness of candidates it holds"
+        witnessed = self.witnessed.setdefault(walker, candidates)
+        if witnessed is not candidates:
+            # the shorter list goes into the longer one
+            if len(witnessed) < len(candidates):
+                witnessed, candidates = candidates, witnessed
+                self.witnessed[walker] = witnessed
+            witnessed.extend(candidates)
+
+    def rewitness(self, candidate):
+        "Flags a candidate left by a stopped walk again, unless another walk witnesses it"
+        if not self.find_witness(candidate):
+            self.zeroed.discard(candidate)
+            insort(self.unzeroed, candidate)
+            self.mark(candidate)
+
+    def find_witness(self, candidate):
+        """
+         Makes the lowest walker above the candidate whose span holds it its witness, if there
+         is one.  The lower walks are the wider ones, which new points leave alone the longest.
+        """
+        y = self.values
+        witness = None
+        for walker in covering(self.spans, candidate):
+            self.steps += 1
+            if y[walker] > y[candidate] and (witness is None or y[walker] < y[witness]):
+                witness = walker
+        if witness is None:
+            return False
+        self.zeroed.add(candidate)
+        self.witnessed.setdefault(witness, []).append(candidate)
+        return True
+
+    def count_start(self, position, sign):
+        "Counts a walk reaching the beginning in or out"
+        if self.walks[position][0] > 0:
+            return
+        self.start_count += sign
+        if self.values[position] > self.values[0]:
+            self.start_above += sign
+            if self.start_above == (1 if sign > 0 else 0):
+                # the first value loses its flag to the first walk above it which gets there
+                self.mark(0)
+
+    def unflag(self, position, start, stop):
+        "Unflags the flagged candidates lower than the walker between start and stop (exclusive, None for the end)"
+        y = self.values
+        height = y[position]
+        unzeroed = self.unzeroed
+        first = bisect_right(unzeroed, start)
+        end = len(unzeroed) if stop is None else bisect_left(unzeroed, stop)
+        kept = []
+        for candidate in unzeroed[first:end]:
+            self.steps += 1
+            if y[candidate] < height:
+                self.zeroed.add(candidate)
+                self.witnessed.setdefault(position, []).append(candidate)
+                self.mark(candidate)
+            else:
+                kept.append(candidate)
+        unzeroed[first:end] = kept
+
+    def expire(self):
+        "Lengthens the walks whose drops min_jump has passed"
+        y = self.values
+        expiry = self.expiry
+        while expiry and expiry[0][0] <= self.min_jump:
+            key, side, position, drop = heapq.heappop(expiry)
+            self.steps += 1
+            if side == 2:
+                # two flagged candidates of a group now share a span
+                group = self.groups[y[position]]
+                index = bisect_left(group.flagged, position)
+                if 0 < index < len(group.flagged) and group.flagged[index] == position and group.flagged[index-1] == drop:
+                    self.mark(position)
+                continue
+            walk = self.walks.get(position)
+            if walk is None or walk[side] != drop:
+                continue
+            self.remove_span(position)
+            if side == 0:
+                self.count_start(position, -1)
+                walk[0] = self.drop_before(drop, y[position])
+                self.count_start(position, 1)
+                self.unflag(position, walk[0], drop)
+            else:
+                walk[1] = self.drop_after(drop+1, y[position])
+                self.unflag(position, drop, walk[1])
+            self.add_span(position)
+            self.watch_walk(position, side)
+            self.mark(position)
+        if 1 in self.walks:
+            # the span of the second point may now hold the first flagged candidate of its group
+            self.mark(1)
+
+    #----groups: which points walk, and which flags survive
+
+    def walk_groups(self):
+        "Walks the marked groups again, highest value first, with the candidates stopped walks left"
+        y = self.values
+        queue = self.queue
+        orphans = self.orphans
+        while queue or orphans:
+            if orphans:
+                highest = max(orphans, key=lambda candidates: y[candidates[-1]])
+                if not queue or y[highest[-1]] >= -queue[0]:
+                    self.steps += 1
+                    candidate = highest.pop()
+                    if not highest:
+                        orphans.remove(highest)
+                    self.rewitness(candidate)
+                    continue
+            group = self.groups[-heapq.heappop(queue)]
+            group.queued = False
+            self.walk_group(group)
+
+    def walk_group(self, group):
+        pending = set(group.dirty)
+        for position in group.dirty:
+            self.reflag(group, position, pending)
+        group.dirty = set()
+        for position in sorted(pending, reverse=True):
+            self.evaluate(group, position)
+        self.settle(group)
+        if 1 in self.walks and self.values[1] == group.value:
+            # the second point looks at the first flagged candidate of its span
+            self.evaluate(group, 1)
+            self.settle(group)
+
+    def start_flag(self, position):
+        "Whether the point is flagged as a peak when its group walks"
+        last = len(self.values)-1
+        if position == 0:
+            return self.falls_first and not self.start_above
+        if position == last:
+            return self.rising_end
+        if position == 1:
+            return self.first_candidate
+        return position in self.compared and position not in self.zeroed
+
+    def reflag(self, group, position, pending):
+        "Updates the flag of a point for its group, marking the flagged candidate after it"
+        flag = self.start_flag(position)
+        if flag == (position in self.start_flagged):
+            return
+        if flag:
+            self.start_flagged.add(position)
+            group.flag_count += 1
+        else:
+            self.start_flagged.discard(position)
+            group.flag_count -= 1
+        if position not in self.compared:
+            return
+        flagged = group.flagged
+        index = bisect_left(flagged, position)
+        if flag:
+            flagged.insert(index, position)
+            if index:
+                self.watch_meeting(group, flagged[index-1], position)
+            index += 1
+        else:
+            del flagged[index]
+        if index < len(flagged):
+            pending.add(flagged[index])
+            if index and flagged[index-1] != position:
+                self.watch_meeting(group, flagged[index-1], flagged[index])
+            elif flag:
+                self.watch_meeting(group, position, flagged[index])
+
+    def meets(self, group, first, second):
+        "Whether two points of a group share a span"
+        return second == first+1 or not group.value - self.values[self.lowest_between(first+1, second)] > self.min_jump
+
+    def watch_meeting(self, group, first, second):
+        "Keeps the min_jump from which two flagged candidates of a group share a span"
+        if not self.meets(group, first, second):
+            key = group.value - self.values[self.lowest_between(first+1, second)]
+            heapq.heappush(self.expiry, (key, 2, second, first))
+
+    def settle(self, group):
+        "Walks from more or fewer points of the group until the walks leave as many flagged as walked"
+        positions = group.positions
+        while True:
+            walked = group.walked
+            if walked < len(positions) and walked + group.failures < group.flag_count:
+                group.walked += 1
+                self.evaluate(group, positions[-walked-1])
+            elif walked and walked-1 + group.failures - self.failing[positions[-walked]] >= group.flag_count:
+                group.walked -= 1
+                self.evaluate(group, positions[-walked])
+            else:
+                break
+
+    def evaluate(self, group, position):
+        "Walks from the point or not, and sets its flag"
+        self.steps += 1
+        positions = group.positions
+        last = len(self.values)-1
+        walked = bisect_left(positions, position) >= len(positions) - group.walked
+        walks = walked and position != 0 and position != last
+        if walks and position not in self.walks:
+            self.walk_from(position)
+        elif not walks and position in self.walks:
+            self.stop_walk(position)
+        flag = position in self.start_flagged
+        if walked:
+            # the end points only take a turn
+            peak = flag and (not walks or self.survives(group, position))
+            failing = int(flag and not peak)
+            group.failures += failing - self.failing.get(position, 0)
+            self.failing[position] = failing
+        else:
+            peak = flag
+            group.failures -= self.failing.pop(position, 0)
+        self.set_peak(position, peak)
+
+    def survives(self, group, position):
+        "Whether a flagged point keeps its flag through its walk"
+        flagged = group.flagged
+        if position == 1:
+            # the second point is no compared candidate, so it sees the first of the group
+            if flagged and self.is_peak(flagged[0]) and self.meets(group, 1, flagged[0]):
+                return False
+        else:
+            index = bisect_left(flagged, position)
+            if index and self.meets(group, flagged[index-1], position):
+                return False
+        y = self.values
+        last = len(y)-1
+        left, right = self.walks[position]
+        if self.falls_first and left <= 0:
+            return False
+        if self.rising_end and (right is None or right == last):
+            return False
+        # a higher peak between the drops
+        peaks = self.peaks
+        stop = last if right is None else right
+        index = bisect_right(peaks, max(left, 1))
+        while index < len(peaks) and peaks[index] < stop:
+            self.steps += 1
+            if y[peaks[index]] > y[position]:
+                return False
+            index += 1
+        return True
+
+    def set_peak(self, position, peak):
+        "Adds or removes a peak, marking the lower walks whose spans hold it"
+        if peak == self.is_peak(position):
+            return
+        if peak:
+            self.add_peak(position)
+        else:
+            self.remove_peak(position)
+        if position in self.compared:
+            y = self.values
+            for walker in covering(self.spans, position):
+                self.steps += 1
+                if y[walker] < y[position]:
+                    self.mark(walker)
+
+    #----peaks
+
+    def add_peak(self, position):
+        insort(self.peaks, position)
+        self.peak_valley[position] = 1
+
+    def remove_peak(self, position):
+        del self.peaks[bisect_left(self.peaks, position)]
+        self.peak_valley[position] = 0
+
+    #----snapshots
+
+    def peak_finder(self):
+        "Returns what peak_finder returns for the values so far"
+        if self.peak_valley is None:
+            return peak_finder(list(self.values), self.peak_sensitivity())
+        if self.falls_first and self.start_above and self.start_count > 1:
+            raise UnknownError, 'problem: shouldnt get here --  end peaks were not set properly. (Must be either a peak or valley)'
+        # the valleys, as set_valleys places them
+        y = self.values
+        peak_valley = list(self.peak_valley)
+        low_valley_position = None
+        start = 0
+        for count, peak in enumerate(self.peaks):
+            if peak > start:
+                position = self.lowest_between(start, peak)
+                if y[position] < self.highest:
+                    low_valley_position = position
+            if count:
+                if low_valley_position is None:
+                    raise UnknownError, 'problem: no point below the highest value before the second peak, so no valley can be set.'
+                peak_valley[low_valley_position] = -1
+            start = peak
+        return peak_valley
+
+    def generate(self, metric_select=None):
+        "Returns what generate returns for the timepoints so far"
+        num_timepoints = len(self.values)
+        if num_timepoints < 3:
+            return generate(list(self.values), list(self.time_points), self.label, self.sensitivity, metric_select)
+        names = selected_metrics(metric_select, METRIC_NAMES)
+        metrics = {}
+        if 'mean' in names:
+            metrics['mean'] = [float(self.total)/num_timepoints]
+        if 'AUC_whole' in names:
+            metrics['AUC_whole'] = [self.area_index[-1]]
+        if 'Max' in names:
+            metrics['Max'] = [self.highest]
+        if 'Equilibrium' in names:
+            metrics['Equilibrium'] = [float(self.window_sum)/(num_timepoints - self.window_start)]
+        if 'Derivative' in names:
+            metrics['Derivative'] = list(self.derivatives)
+        if 'Data_Points' in names:
+            metrics['Data_Points'] = list(self.values)
+        peak_metrics = [name for name in names if 'highest_peak' in METRIC_REQUIREMENTS[name]]
+        if peak_metrics:
+            try:
+                peak_valley = self.peak_finder()
+            except MetricMakerError:
+                # without peaks or valleys, as peak_valley_intermediate
+                peak_valley = [0]*num_timepoints
+            intermediates = {'cumulative_integral': self.area_index,
+                             'highest_peak': highest_peak(self.values, find(peak_valley, 1), find(peak_valley, -1))}
+            for name in peak_metrics:
+                metrics[name] = METRICS[name](self.values, self.time_points, intermediates)
+        headers, values = select_metrics(None, metrics, metric_select)
+        return label_headers(self.label, headers), values
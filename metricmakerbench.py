@@ -0,0 +1,341 @@
+"""Benchmarks for the metricmaker hot paths
+
+ Times diff, trapz, sort, calculate_peak_valley, peak_finder and generate on deterministic
+ synthetic timecourses from 10 to 10^6 points, and generate/generate_batch on panels of
+ 1 to 10^5 signals.  For every case the wall time and the peak memory are recorded, and a
+ scaling exponent (the slope of log(time) against log(size)) is fitted for every function
+ and kind of data.
+
+ Usage:
+ python metricmakerbench.py [--quick] [--output results.json] [--baseline baseline.json]
+
+ Results are written as JSON.  Given a baseline written by an earlier run, every case which
+ became more than --tolerance times slower is reported and the exit status is 1, so the
+ benchmark can guard deploys.
+"""
+
+__author__ = "Soren Burkhart (soren.burkhart@gmail.com)"
+__version__ = "$Revision: 0.2 $"
+__date__ = "$Date: 2010/02/01 19:40:22 $"
+__copyright__ = "Copyright (c) 2010 Soren Burkhart"
+__license__ = "Python"
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import Queue
+import resource
+import sys
+import time
+
+import numpy
+
+import metricmaker
+
+KINDS = ['smooth', 'noisy', 'oscillatory', 'missing', 'quantized']
+POINT_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+SIGNAL_COUNTS = [1, 10, 100, 1000, 10000, 100000]
+# timepoints per signal in the panel benchmarks
+PANEL_TIMEPOINTS = 24
+# fraction of empty values in the 'missing' timecourses
+MISSING_FRACTION = 0.1
+# decimals the 'quantized' timecourses are rounded to, like an instrument reading
+QUANTIZED_DECIMALS = 2
+# cases faster than this are too noisy to be reported as regressions
+NOISE_FLOOR = 0.001
+# seconds a case run in a child process may take before it is reported as an error
+CASE_TIMEOUT = 1800
+
+def synthetic_time_course(kind, num_timepoints, seed=0):
+    """
+     Returns (time_points, time_course) for a deterministic synthetic timecourse.
+
+     kind:
+     'smooth' - a rise and slow decay, like a typical activation
+     'noisy' - the smooth curve with gaussian noise
+     'oscillatory' - a damped oscillation with a little noise, starting from a trough
+     'missing' - the noisy curve with MISSING_FRACTION of the values set to None
+     'quantized' - the noisy curve rounded to QUANTIZED_DECIMALS, so most values are repeated
+    """
+    generator = numpy.random.RandomState(seed)
+    time_points = numpy.linspace(0, 24, num_timepoints)
+    smooth = 2*(1-numpy.exp(-time_points)) * numpy.exp(-time_points/8) + 1
+    if kind == 'smooth':
+        # a tiny ramp keeps the values distinct where the curve flattens out, the
+        # 'quantized' kind is the one with repeated values
+        values = smooth + time_points*1e-9
+    elif kind == 'noisy' or kind == 'missing':
+        values = smooth + generator.normal(0, 0.1, num_timepoints)
+    elif kind == 'quantized':
+        values = numpy.round(smooth + generator.normal(0, 0.1, num_timepoints), QUANTIZED_DECIMALS)
+    elif kind == 'oscillatory':
+        values = 1 - numpy.exp(-time_points/12)*numpy.cos(time_points*3) + generator.normal(0, 0.02, num_timepoints)
+    else:
+        raise ValueError, "unknown kind of timecourse %r" % kind
+    values = values.tolist()
+    if kind == 'missing':
+        for i in generator.permutation(num_timepoints)[:int(num_timepoints*MISSING_FRACTION)]:
+            values[i] = None
+    return time_points.tolist(), values
+
+def synthetic_panel(kind, num_signals, num_timepoints=PANEL_TIMEPOINTS, seed=0):
+    "Returns (time_points, time_courses) with num_signals timecourses of the given kind"
+    time_courses = []
+    for signal in xrange(num_signals):
+        time_points, time_course = synthetic_time_course(kind, num_timepoints, seed+signal)
+        time_courses.append(time_course)
+    return time_points, time_courses
+
+def point_cases():
+    """
+     Returns the benchmarks over the length of a timecourse as name -> (largest size, setup).
+     setup(time_points, time_course) returns the function to time.  Timecourses with empty
+     values are passed as a TimeCourse, which the functions accept.
+    """
+    def on_values(function):
+        def setup(time_points, time_course):
+            if None in time_course:
+                course = metricmaker.TimeCourse(time_course, time_points)
+                return lambda: function(course.time_points, course)
+            return lambda: function(time_points, time_course)
+        return setup
+
+    return {'diff': (10**6, on_values(lambda time_points, time_course: metricmaker.diff(time_course))),
+            'trapz': (10**6, on_values(metricmaker.trapz)),
+            'sort': (10**6, lambda time_points, time_course: lambda: metricmaker.sort(time_course)),
+            'calculate_peak_valley': (10**6, lambda time_points, time_course: lambda: metricmaker.calculate_peak_valley(time_course)),
+            'peak_finder': (10**6, on_values(lambda time_points, time_course: metricmaker.peak_finder(time_course, 0.1))),
+            'peak_finder_classic': (10**3, on_values(lambda time_points, time_course: metricmaker.peak_finder(time_course, 0.1, 'classic'))),
+            'generate': (10**6, on_values(lambda time_points, time_course: metricmaker.generate(time_course, time_points, 'signal', 0.1, None)))}
+
+def signal_cases():
+    "Returns the benchmarks over the number of signals as name -> (largest size, setup)"
+    def generate_each(time_points, time_courses):
+        def run():
+            # a signal where generate fails is skipped, as generate_parallel reports it
+            results = []
+            for time_course in time_courses:
+                try:
+                    results.append(metricmaker.generate(time_course, time_points, None, 0.1, None))
+                except metricmaker.MetricMakerError:
+                    results.append(None)
+            return results
+        return run
+
+    def generate_batch(time_points, time_courses):
+        return lambda: metricmaker.generate_batch(time_courses, time_points, None, 0.1, None)
+
+    return {'generate_panel': (10**4, generate_each),
+            'generate_batch': (10**5, generate_batch)}
+
+def current_rss_kb():
+    "Resident memory of this process in kB (0 where /proc is not available)"
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return 0
+
+def time_function(function, repeat=3, min_time=0.05):
+    "Returns the best time per call of function, calling it enough times to measure small sizes"
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    number = 1 if elapsed >= min_time else int(min(1000, math.ceil(min_time/max(elapsed, 1e-6))))
+    best = elapsed if number == 1 else None
+    for trial in xrange(repeat-1 if number == 1 else repeat):
+        start = time.time()
+        for call in xrange(number):
+            function()
+        elapsed = (time.time() - start)/number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run_case(setup, data, repeat):
+    """
+     Times one case, returning (seconds, peak memory in kB above the memory in use before, error).
+     The peak is the high-water mark of the process, so cases which stay under an earlier,
+     larger peak report 0.
+    """
+    start_rss = current_rss_kb()
+    try:
+        with numpy.errstate(invalid='ignore'):
+            function = setup(*data)
+            seconds = time_function(function, repeat)
+    except Exception, error:
+        return None, None, "%s: %s" % (type(error).__name__, error)
+    return seconds, max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss), None
+
+def run_case_in_child(setup, data_builder, repeat, timeout=CASE_TIMEOUT):
+    """
+     Builds the data and times one case in a forked process, so that the peak memory of the
+     case is not hidden by earlier, larger cases.  A child which is killed (e.g. out of
+     memory) or takes more than timeout seconds is reported as an error of the case.
+    """
+    queue = multiprocessing.Queue()
+    def child():
+        queue.put(run_case(setup, data_builder(), repeat))
+    process = multiprocessing.Process(target=child)
+    process.start()
+    deadline = time.time() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=min(1, max(0, deadline - time.time())))
+        except Queue.Empty:
+            if not process.is_alive():
+                # a result put just before exiting may still be on its way
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    process.join()
+                    return None, None, "ChildExited: the case process exited with code %s" % process.exitcode
+            elif time.time() >= deadline:
+                process.terminate()
+                process.join()
+                return None, None, "ChildTimeout: no result after %g seconds" % timeout
+    process.join()
+    return result
+
+def run(functions=None, kinds=None, max_points=max(POINT_SIZES), max_signals=max(SIGNAL_COUNTS),
+        repeat=3, isolate=True, log=None):
+    """
+     Runs the benchmarks and returns the results as a dictionary ready to be written as JSON.
+
+     functions, kinds:
+     Names of the functions and kinds of data to run, defaults to all.
+
+     max_points, max_signals:
+     Largest timecourse length and panel size to run.
+
+     isolate:
+     Run every case in a forked process to measure its peak memory.
+    """
+    cases = []
+    for name, (largest, setup) in sorted(point_cases().items()):
+        for size in POINT_SIZES:
+            if size <= min(largest, max_points):
+                cases.append((name, 'points', size, setup))
+    for name, (largest, setup) in sorted(signal_cases().items()):
+        for size in SIGNAL_COUNTS:
+            if size <= min(largest, max_signals):
+                cases.append((name, 'signals', size, setup))
+
+    results = []
+    for name, axis, size, setup in cases:
+        if functions and name not in functions:
+            continue
+        for kind in kinds or KINDS:
+            if axis == 'points':
+                data_builder = lambda: synthetic_time_course(kind, size)
+            else:
+                data_builder = lambda: synthetic_panel(kind, size)
+            if isolate:
+                seconds, memory, error = run_case_in_child(setup, data_builder, repeat)
+            else:
+                seconds, memory, error = run_case(setup, data_builder(), repeat)
+            result = {'function': name, 'kind': kind, axis: size,
+                      'seconds': seconds, 'peak_memory_kb': memory}
+            if error:
+                result['error'] = error
+            results.append(result)
+            if log:
+                log("%-22s %-12s %8s=%-8d %s" % (name, kind, axis, size,
+                    error or "%.6fs %dkB" % (seconds, memory)))
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': numpy.__version__,
+                     'platform': platform.platform(),
+                     'peak_finder_engine': metricmaker.PEAK_FINDER_ENGINE,
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results': results,
+            'scaling': scaling_exponents(results)}
+
+def case_key(result):
+    "Identifies a benchmark case across runs"
+    axis = 'points' if 'points' in result else 'signals'
+    return "%s/%s/%s=%d" % (result['function'], result['kind'], axis, result[axis])
+
+def scaling_exponents(results):
+    """
+     Fits time ~ size**k for every function and kind of data and returns {'function/kind': k}.
+     Sizes which take less than NOISE_FLOOR are left out; None if fewer than 2 sizes remain.
+    """
+    series = {}
+    for result in results:
+        if result.get('seconds') and result['seconds'] >= NOISE_FLOOR:
+            size = result.get('points', result.get('signals'))
+            series.setdefault("%s/%s" % (result['function'], result['kind']), []).append((size, result['seconds']))
+    exponents = {}
+    for name, points in series.items():
+        if len(points) < 2:
+            exponents[name] = None
+            continue
+        x = numpy.log([size for size, seconds in points])
+        y = numpy.log([seconds for size, seconds in points])
+        exponents[name] = float(numpy.polyfit(x, y, 1)[0])
+    return exponents
+
+def compare(results, baseline, tolerance=1.5):
+    """
+     Compares two benchmark results.  Returns a list of (case, baseline seconds, seconds) for
+     every case which is more than tolerance times slower than in the baseline, or which
+     failed while it ran in the baseline.  Cases under NOISE_FLOOR in both runs are ignored.
+    """
+    previous = dict((case_key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results['results']:
+        before = previous.get(case_key(result))
+        if before is None or before.get('seconds') is None:
+            continue
+        if result.get('seconds') is None:
+            regressions.append((case_key(result), before['seconds'], None))
+        elif result['seconds'] > before['seconds']*tolerance and result['seconds'] >= NOISE_FLOOR:
+            regressions.append((case_key(result), before['seconds'], result['seconds']))
+    return regressions
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark the metricmaker hot paths.")
+    parser.add_argument('--output', default='bench_output.json', help="where to write the results")
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="slowdown against the baseline reported as a regression")
+    parser.add_argument('--quick', action='store_true',
+                        help="only run up to 10^4 points and 10^3 signals")
+    parser.add_argument('--max-points', type=int, default=max(POINT_SIZES))
+    parser.add_argument('--max-signals', type=int, default=max(SIGNAL_COUNTS))
+    parser.add_argument('--function', action='append', dest='functions', help="function to run (repeatable)")
+    parser.add_argument('--kind', action='append', dest='kinds', choices=KINDS, help="kind of data to run (repeatable)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--in-process', action='store_true',
+                        help="do not fork for every case (peak memory is then cumulative)")
+    options = parser.parse_args(arguments)
+    if options.quick:
+        options.max_points = min(options.max_points, 10**4)
+        options.max_signals = min(options.max_signals, 10**3)
+
+    def log(line):
+        sys.stderr.write(line + "\n")
+    results = run(options.functions, options.kinds, options.max_points, options.max_signals,
+                  options.repeat, not options.in_process, log)
+    with open(options.output, 'w') as output:
+        json.dump(results, output, indent=1, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), options.tolerance)
+        for case, before, after in regressions:
+            if after is None:
+                log("REGRESSION %s failed (was %.6fs)" % (case, before))
+            else:
+                log("REGRESSION %s %.6fs -> %.6fs (x%.2f)" % (case, before, after, after/before))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
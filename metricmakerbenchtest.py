@@ -0,0 +1,64 @@
+"""Unit test for the metric maker benchmarks"""
+
+import metricmakerbench
+import os
+import time
+import unittest
+
+class BenchmarkTests(unittest.TestCase):
+    def testSyntheticTimeCourse(self):
+        for kind in metricmakerbench.KINDS:
+            time_points, time_course = metricmakerbench.synthetic_time_course(kind, 100, 3)
+            self.assertEqual(100, len(time_points))
+            self.assertEqual(100, len(time_course))
+            self.assertEqual((time_points, time_course),
+                             metricmakerbench.synthetic_time_course(kind, 100, 3))
+        time_points, time_course = metricmakerbench.synthetic_time_course('missing', 100)
+        self.assertEqual(10, time_course.count(None))
+        time_points, time_course = metricmakerbench.synthetic_time_course('quantized', 1000)
+        self.assertEqual(time_course, [round(value, metricmakerbench.QUANTIZED_DECIMALS) for value in time_course])
+        self.assertTrue(len(set(time_course)) < len(time_course))
+        self.assertRaises(ValueError, metricmakerbench.synthetic_time_course, 'flat', 10)
+        time_points, time_courses = metricmakerbench.synthetic_panel('noisy', 5)
+        self.assertEqual(5, len(time_courses))
+        self.assertEqual(metricmakerbench.PANEL_TIMEPOINTS, len(time_courses[4]))
+
+    def testScalingAndCompare(self):
+        results = {'results': [{'function': 'trapz', 'kind': 'noisy', 'points': 10**k,
+                                'seconds': 10.0**k * 1e-6, 'peak_memory_kb': 0}
+                               for k in range(1, 7)]}
+        exponents = metricmakerbench.scaling_exponents(results['results'])
+        self.assertAlmostEqual(1.0, exponents['trapz/noisy'])
+        slower = {'results': [dict(result, seconds=result['seconds']*2) for result in results['results']]}
+        slower['results'][0]['seconds'] = None
+        slower['results'][0]['error'] = 'UnknownError: '
+        self.assertEqual([], metricmakerbench.compare(results, results))
+        self.assertEqual([('trapz/noisy/points=10', results['results'][0]['seconds'], None)],
+                         metricmakerbench.compare(slower, results, 2.5))
+        # the 100 point case stays under the noise floor
+        self.assertEqual(['trapz/noisy/points=10', 'trapz/noisy/points=1000',
+                          'trapz/noisy/points=10000', 'trapz/noisy/points=100000',
+                          'trapz/noisy/points=1000000'],
+                         [case for case, before, after in metricmakerbench.compare(slower, results)])
+
+    def testRun(self):
+        results = metricmakerbench.run(['trapz', 'generate_batch'], ['smooth', 'missing'],
+                                       max_points=100, max_signals=10, repeat=1, isolate=False)
+        self.assertEqual(8, len(results['results']))
+        for result in results['results']:
+            self.assertTrue(result['seconds'] > 0)
+            self.assertFalse('error' in result)
+
+    def testChildFailures(self):
+        # a crashed or hung case is an error of that case, not of the run
+        seconds, memory, error = metricmakerbench.run_case_in_child(lambda: os._exit(3), lambda: (), 1)
+        self.assertEqual((None, None), (seconds, memory))
+        self.assertTrue(error.startswith('ChildExited') and error.endswith('3'))
+        seconds, memory, error = metricmakerbench.run_case_in_child(lambda: time.sleep(10), lambda: (), 1, timeout=0.5)
+        self.assertTrue(error.startswith('ChildTimeout'))
+        seconds, memory, error = metricmakerbench.run_case_in_child(lambda: lambda: None, lambda: (), 1)
+        self.assertEqual(None, error)
+        self.assertTrue(seconds >= 0)
+
+if __name__ == "__main__":
+    unittest.main()
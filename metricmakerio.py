@@ -0,0 +1,314 @@
+"""Bulk input and output of timecourse tables for metricmaker
+
+ A table holds one timecourse per row: an array of shape (S, N) where S = number of signals
+ and N = number of timepoints.  Tables are read from .npy files, raw little endian float64
+ files or CSV files, in blocks of rows, so that tables larger than memory can be passed
+ through generate_batch.  The metric matrix is written back out block by block as a single
+ .npy file or as a directory of append-only chunks.
+
+ CSV layout:
+ label,t1,t2,...,tN
+ signal_1,v1,v2,...,vN
+ The header row holds the time points.  Empty cells are empty values (nan).
+"""
+
+__author__ = "Soren Burkhart (soren.burkhart@gmail.com)"
+__version__ = "$Revision: 0.2 $"
+__date__ = "$Date: 2010/02/01 19:40:22 $"
+__copyright__ = "Copyright (c) 2010 Soren Burkhart"
+__license__ = "Python"
+
+import csv
+import os
+import struct
+
+import numpy
+
+import metricmaker
+
+class TableFormatError(metricmaker.MetricMakerError): pass
+
+RAW_DTYPE = numpy.dtype('<f8')
+# bytes reserved for the .npy header written by MetricWriter, so the shape can be filled in on close
+NPY_HEADER_SIZE = 128
+CHUNK_NAME = 'chunk-%06d.npy'
+COLUMNS_NAME = 'columns.txt'
+LABELS_NAME = 'labels.txt'
+
+def open_table(path, num_timepoints=None):
+    """
+     Memory-maps a table read only, for random access to its rows.
+
+     path:
+     A .npy file, or a raw little endian float64 file with num_timepoints values per row.
+
+     OUTPUT: an array of shape (S, N) backed by the file.
+     Pages which are read stay mapped; use iter_table_blocks to pass over a whole table.
+    """
+    if path.endswith('.npy'):
+        table = numpy.load(path, mmap_mode='r')
+    else:
+        num_signals = raw_signal_count(path, num_timepoints)
+        if num_signals == 0:
+            return numpy.zeros((0, num_timepoints))
+        table = numpy.memmap(path, dtype=RAW_DTYPE, mode='r', shape=(num_signals, num_timepoints))
+    if table.ndim != 2:
+        raise TableFormatError, "%s holds an array of %d dimensions, expected (signals, timepoints)." % (path, table.ndim)
+    return table
+
+def raw_signal_count(path, num_timepoints):
+    "Number of rows in a raw float64 table"
+    if not num_timepoints:
+        raise TableFormatError, "the number of timepoints is needed to read the raw table %s." % path
+    num_values, remainder = divmod(os.path.getsize(path), RAW_DTYPE.itemsize)
+    if remainder or num_values % num_timepoints:
+        raise TableFormatError, "%s does not hold whole rows of %d float64 values." % (path, num_timepoints)
+    return num_values // num_timepoints
+
+def npy_layout(table_file):
+    "Reads the header of an open .npy file and returns (shape, fortran_order, dtype, data offset)"
+    try:
+        version = numpy.lib.format.read_magic(table_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(table_file)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(table_file)
+    except ValueError, error:
+        raise TableFormatError, str(error)
+    return shape, fortran_order, dtype, table_file.tell()
+
+def iter_table_blocks(path, block_size=4096, num_timepoints=None):
+    """
+     Reads a .npy or raw float64 table block by block.
+
+     Every block is read into a new float64 array of at most block_size rows, which is
+     released once the caller is done with it, so the memory used does not depend on the
+     size of the file.
+
+     OUTPUT: yields (start, block) where block holds rows start to start+len(block).
+    """
+    with open(path, 'rb') as table_file:
+        if path.endswith('.npy'):
+            shape, fortran_order, dtype, offset = npy_layout(table_file)
+            if len(shape) != 2:
+                raise TableFormatError, "%s holds an array of %d dimensions, expected (signals, timepoints)." % (path, len(shape))
+            if fortran_order:
+                raise TableFormatError, "%s is stored column by column; its rows can only be read with open_table." % path
+            num_signals, num_timepoints = shape
+        else:
+            dtype, offset = RAW_DTYPE, 0
+            num_signals = raw_signal_count(path, num_timepoints)
+        table_file.seek(offset)
+        for start in xrange(0, num_signals, block_size):
+            rows = min(block_size, num_signals - start)
+            block = numpy.fromfile(table_file, dtype=dtype, count=rows*num_timepoints)
+            if len(block) != rows*num_timepoints:
+                raise TableFormatError, "%s ends after %d of %d rows." % (path, start + len(block)//num_timepoints, num_signals)
+            yield start, block.reshape(rows, num_timepoints).astype(float, copy=False)
+
+def iter_csv_blocks(path, block_size=4096, delimiter=','):
+    """
+     Reads a CSV table block by block (see the layout at the top of this module).
+
+     OUTPUT: yields (time_points, labels, block) where block is a float64 array of at most
+     block_size rows with nan for the empty cells.
+    """
+    with open(path, 'rb') as table_file:
+        reader = csv.reader(table_file, delimiter=delimiter)
+        try:
+            header = reader.next()
+        except StopIteration:
+            raise TableFormatError, "%s is empty." % path
+        try:
+            time_points = [float(time_point) for time_point in header[1:]]
+        except ValueError:
+            raise TableFormatError, "the header row of %s must hold the time points." % path
+        num_timepoints = len(time_points)
+
+        labels = []
+        block = numpy.empty((block_size, num_timepoints))
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != num_timepoints + 1:
+                raise TableFormatError, "line %d of %s has %d values, expected %d." % (reader.line_num, path, len(row) - 1, num_timepoints)
+            try:
+                block[len(labels)] = [float(value) if value.strip() else numpy.nan for value in row[1:]]
+            except ValueError, error:
+                raise TableFormatError, "line %d of %s: %s" % (reader.line_num, path, error)
+            labels.append(row[0])
+            if len(labels) == block_size:
+                yield time_points, labels, block
+                labels = []
+                block = numpy.empty((block_size, num_timepoints))
+        if labels:
+            yield time_points, labels, block[:len(labels)]
+
+class MetricWriter(object):
+    """
+     Writes a metric matrix block by block.
+
+     path:
+     A file name ending in .npy writes one .npy file, row by row, whose shape is filled in
+     when the writer is closed.  Any other path is a directory of append-only chunks: every
+     block becomes one chunk stored column by column, so a single metric can be read from
+     every chunk without reading the other columns.
+
+     columns:
+     The names of the matrix columns, e.g. the headers from generate_batch with no labels.
+
+     The column names, and the row labels when given, are written next to the matrix
+     (path.columns and path.labels, or columns.txt and labels.txt in the chunk directory).
+    """
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self.chunked = not path.endswith('.npy')
+        if self.chunked:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.chunks = len([name for name in os.listdir(path) if name.startswith('chunk-')])
+            columns_path = os.path.join(path, COLUMNS_NAME)
+            labels_path = os.path.join(path, LABELS_NAME)
+            if self.chunks:
+                if read_lines(columns_path) != self.columns:
+                    raise TableFormatError, "%s already holds chunks with other columns." % path
+                self.rows = sum(len(numpy.load(os.path.join(path, CHUNK_NAME % chunk), mmap_mode='r'))
+                                for chunk in xrange(self.chunks))
+        else:
+            columns_path = path + '.columns'
+            labels_path = path + '.labels'
+            self.matrix_file = open(path, 'wb')
+            self.matrix_file.write(npy_header((0, len(self.columns))))
+        write_lines(columns_path, self.columns)
+        self.labels_file = open(labels_path, 'a' if self.chunked else 'w')
+
+    def append(self, block, labels=None):
+        "Appends the rows of block, an array of shape (rows, len(columns)), with their labels"
+        block = numpy.atleast_2d(numpy.asarray(block, dtype=RAW_DTYPE))
+        if block.shape[1] != len(self.columns):
+            raise TableFormatError, "block has %d columns, expected %d." % (block.shape[1], len(self.columns))
+        if labels is None:
+            labels = [''] * len(block)
+        if len(labels) != len(block):
+            raise TableFormatError, "%d labels given for %d rows." % (len(labels), len(block))
+        if self.chunked:
+            numpy.save(os.path.join(self.path, CHUNK_NAME % self.chunks), numpy.asfortranarray(block))
+            self.chunks += 1
+        else:
+            block.tofile(self.matrix_file)
+        for label in labels:
+            self.labels_file.write("%s\n" % ('' if label is None else label))
+        self.rows += len(block)
+
+    def close(self):
+        "Finishes the output; a .npy file is only readable once its writer is closed"
+        if not self.chunked and not self.matrix_file.closed:
+            self.matrix_file.seek(0)
+            self.matrix_file.write(npy_header((self.rows, len(self.columns))))
+            self.matrix_file.close()
+        self.labels_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def npy_header(shape):
+    "A version 1.0 .npy header for a float64 array of the given shape, padded to NPY_HEADER_SIZE bytes"
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % shape
+    header_length = NPY_HEADER_SIZE - len(numpy.lib.format.MAGIC_PREFIX) - 4
+    return (numpy.lib.format.MAGIC_PREFIX + '\x01\x00' + struct.pack('<H', header_length)
+            + header.ljust(header_length - 1) + '\n')
+
+def read_lines(path):
+    with open(path) as lines:
+        return [line.rstrip('\n') for line in lines]
+
+def write_lines(path, lines):
+    with open(path, 'w') as output:
+        for line in lines:
+            output.write("%s\n" % line)
+
+def read_metrics(path, columns=None):
+    """
+     Reads a metric matrix written by MetricWriter.
+
+     columns:
+     The names of the columns to read, defaults to all.  From a chunk directory only these
+     columns are read.
+
+     OUTPUT: (columns, matrix, labels)
+    """
+    if path.endswith('.npy'):
+        names = read_lines(path + '.columns')
+        labels = read_lines(path + '.labels')
+        matrix = numpy.load(path, mmap_mode='r')
+    else:
+        names = read_lines(os.path.join(path, COLUMNS_NAME))
+        labels = read_lines(os.path.join(path, LABELS_NAME))
+        chunks = sorted(name for name in os.listdir(path) if name.startswith('chunk-'))
+        matrix = None
+    if columns is None:
+        columns = names
+    try:
+        positions = [names.index(column) for column in columns]
+    except ValueError, error:
+        raise TableFormatError, "%s: %s" % (path, error)
+    if matrix is not None:
+        return list(columns), numpy.array(matrix[:, positions]), labels
+    parts = [numpy.load(os.path.join(path, chunk), mmap_mode='r')[:, positions] for chunk in chunks]
+    if not parts:
+        return list(columns), numpy.zeros((0, len(positions))), labels
+    return list(columns), numpy.vstack(parts), labels
+
+def write_metrics(path, blocks, time_points, sensitivity, metric_select, missing_policy=None):
+    """
+     Runs generate_batch over blocks of timecourses and writes the metric matrix to path
+     (see MetricWriter).
+
+     blocks:
+     An iterable of (labels, block) pairs, labels may be None, e.g.
+     ((labels, block) for time_points, labels, block in iter_csv_blocks(csv_path))
+     ((None, block) for start, block in iter_table_blocks(npy_path))
+
+     time_points, sensitivity, metric_select, missing_policy:
+     As for metricmaker.generate_batch.
+
+     generate_batch rejects a whole block for one row with too many empty values, so those
+     rows are left out of the batch and written as rows of nan instead, keeping the output
+     in step with the input.
+
+     OUTPUT: (rows, failures)
+     rows is the number of rows written.  failures is a list of (i, error) for every row
+     written as nan, i counting the rows of all the blocks.
+    """
+    writer = None
+    failures = []
+    row = 0
+    try:
+        for labels, block in blocks:
+            block = numpy.atleast_2d(numpy.asarray(block, dtype=float))
+            if not block.size:
+                continue
+            rejected = metricmaker.too_many_empty(block, len(time_points))
+            if rejected.any():
+                # a row of zeros stands in for each rejected row, so the block still gives
+                # the headers when every row of it is rejected
+                block = numpy.where(rejected[:, None], 0.0, block)
+                for i in numpy.flatnonzero(rejected).tolist():
+                    label = labels[i] if labels is not None else None
+                    failures.append((row + i, metricmaker.TooManyEmptyValues(
+                        "found too many empty values in time course %d (%s)." % (row + i, label))))
+            headers, matrix = metricmaker.generate_batch(block, time_points, None, sensitivity, metric_select, missing_policy)
+            matrix[rejected] = numpy.nan
+            if writer is None:
+                writer = MetricWriter(path, headers[0])
+            writer.append(matrix, labels)
+            row += len(block)
+    finally:
+        if writer is not None:
+            writer.close()
+    return (writer.rows if writer is not None else 0), failures
@@ -0,0 +1,97 @@
+"""Unit test for metric maker table input and output"""
+
+import metricmaker
+import metricmakerio
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+
+class TableTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.table = numpy.arange(30, dtype=float).reshape(10, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def testTableBlocks(self):
+        numpy.save(self.path('table.npy'), self.table)
+        self.table.tofile(self.path('table.f64'))
+        for path, num_timepoints in [(self.path('table.npy'), None), (self.path('table.f64'), 3)]:
+            blocks = list(metricmakerio.iter_table_blocks(path, 4, num_timepoints))
+            self.assertEqual([0, 4, 8], [start for start, block in blocks])
+            self.assertEqual(self.table.tolist(), numpy.vstack([block for start, block in blocks]).tolist())
+            self.assertEqual(self.table.tolist(), metricmakerio.open_table(path, num_timepoints).tolist())
+        self.assertRaises(metricmakerio.TableFormatError, metricmakerio.open_table, self.path('table.f64'), 4)
+        self.assertRaises(metricmakerio.TableFormatError, metricmakerio.open_table, self.path('table.f64'))
+        numpy.save(self.path('fortran.npy'), numpy.asfortranarray(self.table))
+        self.assertRaises(metricmakerio.TableFormatError, list,
+                          metricmakerio.iter_table_blocks(self.path('fortran.npy')))
+
+    def testCSVBlocks(self):
+        with open(self.path('table.csv'), 'w') as table:
+            table.write("label,1,2,3\na,0,1,2\nb,3,,5\n\nc,6,7,8\n")
+        blocks = list(metricmakerio.iter_csv_blocks(self.path('table.csv'), 2))
+        self.assertEqual([1.0, 2.0, 3.0], blocks[0][0])
+        self.assertEqual([['a', 'b'], ['c']], [labels for time_points, labels, block in blocks])
+        self.assertTrue(numpy.isnan(blocks[0][2][1, 1]))
+        self.assertEqual([[6.0, 7.0, 8.0]], blocks[1][2].tolist())
+        with open(self.path('short.csv'), 'w') as table:
+            table.write("label,1,2,3\na,0,1\n")
+        self.assertRaises(metricmakerio.TableFormatError, list,
+                          metricmakerio.iter_csv_blocks(self.path('short.csv')))
+
+    def testMetricWriter(self):
+        for name in ['metrics.npy', 'metrics']:
+            path = self.path(name)
+            with metricmakerio.MetricWriter(path, ['x', 'y', 'z']) as writer:
+                writer.append(self.table[:4], list('abcd'))
+                writer.append(self.table[4:])
+            columns, matrix, labels = metricmakerio.read_metrics(path)
+            self.assertEqual(['x', 'y', 'z'], columns)
+            self.assertEqual(self.table.tolist(), matrix.tolist())
+            self.assertEqual(list('abcd') + ['']*6, labels)
+            columns, matrix, labels = metricmakerio.read_metrics(path, ['z', 'x'])
+            self.assertEqual(self.table[:, [2, 0]].tolist(), matrix.tolist())
+        self.assertEqual(self.table.tolist(), numpy.load(self.path('metrics.npy')).tolist())
+        # chunks are only ever appended
+        with metricmakerio.MetricWriter(self.path('metrics'), ['x', 'y', 'z']) as writer:
+            self.assertEqual(10, writer.rows)
+            writer.append(self.table[:1], ['k'])
+        self.assertEqual(11, len(metricmakerio.read_metrics(self.path('metrics'))[1]))
+        self.assertRaises(metricmakerio.TableFormatError, metricmakerio.MetricWriter, self.path('metrics'), ['x'])
+
+    def testWriteMetrics(self):
+        time_points = [1, 2, 3]
+        numpy.save(self.path('table.npy'), self.table)
+        blocks = ((None, block) for start, block in metricmakerio.iter_table_blocks(self.path('table.npy'), 3))
+        self.assertEqual((10, []), metricmakerio.write_metrics(self.path('metrics.npy'), blocks, time_points, 0.1, [1, 0, 1, 0, 0, 0, 0, 0, 0]))
+        columns, matrix, labels = metricmakerio.read_metrics(self.path('metrics.npy'))
+        self.assertEqual(['mean', 'Max'], columns)
+        self.assertEqual(numpy.column_stack([self.table.mean(axis=1), self.table.max(axis=1)]).tolist(), matrix.tolist())
+        # the missing value policy is passed on to generate_batch
+        table = numpy.arange(50, dtype=float).reshape(10, 5)
+        table[3, 2] = numpy.nan
+        numpy.save(self.path('gaps.npy'), table)
+        blocks = ((None, block) for start, block in metricmakerio.iter_table_blocks(self.path('gaps.npy'), 3))
+        metricmakerio.write_metrics(self.path('filled.npy'), blocks, range(5), 0.1, [1, 0, 0, 0, 0, 0, 0, 0, 0], 'interpolate')
+        self.assertEqual(table.mean(axis=1)[:3].tolist() + [17.0], metricmakerio.read_metrics(self.path('filled.npy'))[1][:4, 0].tolist())
+        # a row with too many empty values is written as nan, the other rows still run
+        table[[4, 9], 1:4] = numpy.nan
+        numpy.save(self.path('gaps.npy'), table)
+        blocks = ((None, block) for start, block in metricmakerio.iter_table_blocks(self.path('gaps.npy'), 3))
+        rows, failures = metricmakerio.write_metrics(self.path('rejected.npy'), blocks, range(5), 0.1, [1, 0, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(10, rows)
+        self.assertEqual([4, 9], [i for i, error in failures])
+        self.assertTrue(all(isinstance(error, metricmaker.TooManyEmptyValues) for i, error in failures))
+        means = metricmakerio.read_metrics(self.path('rejected.npy'))[1][:, 0]
+        self.assertEqual([4, 9], numpy.flatnonzero(numpy.isnan(means)).tolist())
+        self.assertEqual(table[[0, 1, 2, 5, 6, 7, 8]].mean(axis=1).tolist(), means[[0, 1, 2, 5, 6, 7, 8]].tolist())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,411 @@
+"""Local HTTP service for metric generation
+
+ Serves metricmaker.generate to a front end.  Timecourses posted by concurrent requests are
+ queued and a dispatcher thread gathers them over a short window into batches, which are
+ computed with one metricmaker.generate_batch call per group of timecourses sharing time
+ points, sensitivity and metric_select.  The request threads only parse, queue and wait, so
+ a batch never blocks the server from accepting requests.
+
+ POST /generate
+ {"time_course": [...], "time_points": [...], "label": "AKT", "sensitivity": 0.1,
+  "metric_select": [1, 1, 1, 1, 0, 0, 0, 0, 0]}
+ returns {"label": "AKT", "headers": [...], "values": [...]}, or {"label": ..., "error":
+ "TooManyEmptyValues", "message": ...} with status 422.  label, sensitivity and
+ metric_select are optional.
+
+ POST /generate with {"time_courses": [{...}, {...}]}
+ returns one JSON result per line, in order, streamed as each one is ready.
+
+ GET /stats returns the counters (see MetricService.stats), GET /health returns {"ok": true}.
+
+ When more than max_pending timecourses are waiting, requests are refused with status 503
+ and a Retry-After header.  A timecourse without a result after result_timeout seconds is
+ answered with status 504 (a "Timeout" error line when streamed).
+
+ Usage:
+ python metricmakerservice.py [--host 127.0.0.1] [--port 8080] [--window-ms 5] [--max-batch 256] [--timeout 60]
+"""
+
+__author__ = "Soren Burkhart (soren.burkhart@gmail.com)"
+__version__ = "$Revision: 0.2 $"
+__date__ = "$Date: 2010/02/01 19:40:22 $"
+__copyright__ = "Copyright (c) 2010 Soren Burkhart"
+__license__ = "Python"
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import math
+import SocketServer
+import threading
+import time
+
+import metricmaker
+
+# number of recent latencies kept for the percentiles in the stats
+LATENCY_SAMPLES = 4096
+# seconds a request waits for its results
+RESULT_TIMEOUT = 60.0
+
+class ServiceBusy(metricmaker.MetricMakerError): pass
+
+class PendingTimeCourse(object):
+    "One queued timecourse and, once the dispatcher is done with it, its result"
+    __slots__ = ('time_course', 'time_points', 'label', 'sensitivity', 'metric_select',
+                 'queued', 'result', 'done')
+
+    def __init__(self, time_course, time_points, label, sensitivity, metric_select):
+        self.time_course = time_course
+        self.time_points = time_points
+        self.label = label
+        self.sensitivity = sensitivity
+        self.metric_select = metric_select
+        self.queued = time.time()
+        self.result = None
+        self.done = threading.Event()
+
+    def finish(self, result):
+        self.result = result
+        self.done.set()
+
+    def wait(self, timeout=None):
+        "Returns the result, a dictionary ready to be sent as JSON, or None after timeout seconds"
+        self.done.wait(timeout)
+        return self.result
+
+    def batch_key(self):
+        "Timecourses with the same key can share one generate_batch call, None if this one can not"
+        if None in self.time_course or len(self.time_course) != len(self.time_points):
+            return None
+        return (tuple(self.time_points), self.sensitivity,
+                None if self.metric_select is None else tuple(self.metric_select))
+
+class BatchDispatcher(object):
+    """
+     Gathers queued timecourses into batches.
+
+     window:
+     Seconds to wait for more timecourses after the first one of a batch arrives.
+
+     max_batch:
+     Largest number of timecourses in a batch; a full batch is started at once.
+
+     max_pending:
+     Largest number of timecourses waiting to be batched.  submit raises ServiceBusy beyond it.
+    """
+    def __init__(self, window=0.005, max_batch=256, max_pending=4096):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'time_courses': 0, 'batches': 0, 'batched': 0,
+                         'rejected': 0, 'errors': 0}
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='metric batch dispatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, pending):
+        "Queues a list of PendingTimeCourse, all or none of them"
+        with self.condition:
+            if len(self.pending) + len(pending) > self.max_pending:
+                with self.lock:
+                    self.counters['rejected'] += 1
+                raise ServiceBusy, "%d timecourses are already waiting." % len(self.pending)
+            self.pending.extend(pending)
+            self.condition.notify()
+        with self.lock:
+            self.counters['requests'] += 1
+
+    def next_batch(self):
+        "Waits for the first timecourse, then for the window to pass or the batch to fill"
+        with self.condition:
+            while self.running and not self.pending:
+                self.condition.wait(0.5)
+            if not self.pending:
+                return []
+            deadline = time.time() + self.window
+            while len(self.pending) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.running:
+                    break
+                self.condition.wait(remaining)
+            return [self.pending.popleft() for i in xrange(min(self.max_batch, len(self.pending)))]
+
+    def run(self):
+        while self.running or self.pending:
+            batch = self.next_batch()
+            if batch:
+                self.process(batch)
+
+    def process(self, batch):
+        "Computes a batch, one generate_batch call per group of compatible timecourses"
+        groups = collections.OrderedDict()
+        for pending in batch:
+            try:
+                key = pending.batch_key()
+            except Exception:
+                # computed alone, where the error is reported
+                key = None
+            groups.setdefault(key, []).append(pending)
+        for key, group in groups.items():
+            try:
+                if key is None or len(group) == 1:
+                    for pending in group:
+                        self.finish_one(pending)
+                else:
+                    self.finish_group(group)
+            except Exception, error:
+                # an error fails its own timecourses, never the dispatcher
+                for pending in group:
+                    if not pending.done.is_set():
+                        self.finish(pending, error_result(pending.label, error))
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['batched'] += len(batch)
+
+    def finish_one(self, pending):
+        try:
+            headers, values = metricmaker.generate(pending.time_course, pending.time_points, None,
+                                                   pending.sensitivity, pending.metric_select)
+        except Exception, error:
+            self.finish(pending, error_result(pending.label, error))
+        else:
+            self.finish(pending, {'label': pending.label, 'headers': headers, 'values': json_values(values)})
+
+    def finish_group(self, group):
+        first = group[0]
+        try:
+            headers, matrix = metricmaker.generate_batch([pending.time_course for pending in group],
+                                                         first.time_points, None,
+                                                         first.sensitivity, first.metric_select)
+        except Exception:
+            # let every timecourse report its own error
+            for pending in group:
+                self.finish_one(pending)
+            return
+        for pending, row_headers, row in zip(group, headers, matrix.tolist()):
+            self.finish(pending, {'label': pending.label, 'headers': row_headers, 'values': json_values(row)})
+
+    def finish(self, pending, result):
+        latency = time.time() - pending.queued
+        with self.lock:
+            self.counters['time_courses'] += 1
+            if 'error' in result:
+                self.counters['errors'] += 1
+            self.latencies.append(latency)
+        pending.finish(result)
+
+    def stats(self):
+        """
+         Returns the counters: requests, time_courses, batches, mean_batch_size, rejected,
+         errors, pending, throughput (timecourses per second since the start) and the 50th,
+         95th and 99th percentile of the latency from queueing to result, in seconds.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = sorted(self.latencies)
+        stats['pending'] = len(self.pending)
+        stats['mean_batch_size'] = stats['batched']/float(stats['batches']) if stats['batches'] else 0.0
+        stats['throughput'] = stats['time_courses']/max(time.time() - self.started, 1e-9)
+        for percentile in (50, 95, 99):
+            stats['latency_p%d' % percentile] = percentile_value(latencies, percentile)
+        return stats
+
+def percentile_value(ordered, percentile):
+    "Nearest rank percentile of a sorted list, None for an empty list"
+    if not ordered:
+        return None
+    return ordered[max(0, int(math.ceil(percentile/100.0*len(ordered))) - 1)]
+
+def error_result(label, error):
+    return {'label': label, 'error': type(error).__name__, 'message': str(error)}
+
+def timeout_result(label, timeout):
+    return {'label': label, 'error': 'Timeout', 'message': "no result after %g seconds." % timeout}
+
+def json_values(values):
+    "Metric values ready for JSON: undefined metrics (nan) are None, as generate returns them"
+    return [None if value != value else value for value in values]
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def parse_time_course(item):
+    "Returns a PendingTimeCourse for one timecourse of a request, ValueError if it is malformed"
+    if not isinstance(item, dict) or 'time_course' not in item or 'time_points' not in item:
+        raise ValueError("a timecourse needs time_course and time_points")
+    time_course = item['time_course']
+    time_points = item['time_points']
+    sensitivity = item.get('sensitivity')
+    metric_select = item.get('metric_select')
+    if not isinstance(time_course, list) or not all(value is None or is_number(value) for value in time_course):
+        raise ValueError("time_course must be a list of numbers and nulls")
+    if not isinstance(time_points, list) or not all(is_number(time_point) for time_point in time_points):
+        raise ValueError("time_points must be a list of numbers")
+    if sensitivity is not None and not is_number(sensitivity):
+        raise ValueError("sensitivity must be a number")
+    if metric_select is not None and (not isinstance(metric_select, list) or
+                                      not all(isinstance(flag, (int, long, float)) for flag in metric_select)):
+        raise ValueError("metric_select must be a list of 0/1 flags")
+    if isinstance(item.get('label'), (list, dict)):
+        raise ValueError("label must be a string or a number")
+    return PendingTimeCourse(time_course, time_points, item.get('label'), sensitivity, metric_select)
+
+class MetricRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *arguments):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *arguments)
+
+    def send_json(self, status, body, extra_headers=()):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.dispatcher.stats())
+        elif self.path == '/health':
+            self.send_json(200, {'ok': True})
+        else:
+            self.send_json(404, {'error': 'NotFound', 'message': self.path})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(404, {'error': 'NotFound', 'message': self.path})
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length > self.server.max_body:
+            self.close_connection = 1
+            self.send_json(413, {'error': 'RequestTooLarge', 'message': "at most %d bytes" % self.server.max_body})
+            return
+        try:
+            body = json.loads(self.rfile.read(length))
+            streamed = isinstance(body, dict) and 'time_courses' in body
+            items = body['time_courses'] if streamed else [body]
+            pending = [parse_time_course(item) for item in items]
+        except (ValueError, TypeError), error:
+            self.send_json(400, {'error': 'BadRequest', 'message': str(error)})
+            return
+        try:
+            self.server.dispatcher.submit(pending)
+        except ServiceBusy, error:
+            self.send_json(503, {'error': 'ServiceBusy', 'message': str(error)}, [('Retry-After', '1')])
+            return
+
+        timeout = self.server.result_timeout
+        if not streamed:
+            result = pending[0].wait(timeout)
+            if result is None:
+                self.send_json(504, timeout_result(pending[0].label, timeout))
+            else:
+                self.send_json(422 if 'error' in result else 200, result)
+            return
+        # one JSON line per timecourse, sent as soon as it is ready
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        deadline = time.time() + timeout
+        for item in pending:
+            result = item.wait(max(0, deadline - time.time()))
+            if result is None:
+                result = timeout_result(item.label, timeout)
+            line = json.dumps(result) + "\n"
+            self.wfile.write("%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+        self.wfile.write("0\r\n\r\n")
+
+class MetricService(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+     The HTTP server, one thread per connection, with its BatchDispatcher.
+
+     address:
+     (host, port) to listen on; port 0 picks a free port (see server_address).
+
+     window, max_batch, max_pending:
+     As for BatchDispatcher.
+
+     max_body:
+     Largest request body accepted, in bytes.
+
+     result_timeout:
+     Seconds a request waits for its results before it is answered with a timeout.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 8080), window=0.005, max_batch=256, max_pending=4096,
+                 max_body=16*1024*1024, verbose=False, result_timeout=RESULT_TIMEOUT):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricRequestHandler)
+        self.dispatcher = BatchDispatcher(window, max_batch, max_pending)
+        self.max_body = max_body
+        self.result_timeout = result_timeout
+        self.verbose = verbose
+        self.thread = None
+
+    def stats(self):
+        return self.dispatcher.stats()
+
+    def start(self):
+        "Serves in a background thread"
+        self.dispatcher.start()
+        self.thread = threading.Thread(target=self.serve_forever, name='metric service')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        "Stops serving and finishes the queued timecourses"
+        self.shutdown()
+        self.server_close()
+        self.dispatcher.stop()
+        if self.thread is not None:
+            self.thread.join()
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Serve metricmaker.generate over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window-ms', type=float, default=5.0, help="batching window in milliseconds")
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-pending', type=int, default=4096)
+    parser.add_argument('--timeout', type=float, default=RESULT_TIMEOUT, help="seconds a request waits for its results")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    options = parser.parse_args(arguments)
+    service = MetricService((options.host, options.port), options.window_ms/1000.0,
+                            options.max_batch, options.max_pending, verbose=options.verbose,
+                            result_timeout=options.timeout)
+    service.dispatcher.start()
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+        service.dispatcher.stop()
+
+if __name__ == "__main__":
+    main()
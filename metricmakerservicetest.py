@@ -0,0 +1,130 @@
+"""Unit test for the metric maker HTTP service"""
+
+import httplib
+import json
+import metricmaker
+import metricmakerservice
+import threading
+import unittest
+
+TIME_POINTS = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+TIME_COURSE = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+
+class ServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.service = metricmakerservice.MetricService(('127.0.0.1', 0), window=0.05, max_pending=64)
+        self.service.start()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def request(self, method, path, body=None):
+        connection = httplib.HTTPConnection(*self.service.server_address)
+        connection.request(method, path, None if body is None else json.dumps(body))
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response.status, data
+
+    def testGenerate(self):
+        status, data = self.request('POST', '/generate', {'time_course': TIME_COURSE, 'time_points': TIME_POINTS,
+                                                          'label': 'AKT', 'metric_select': [1, 1, 1, 1, 0, 0, 0, 0, 0]})
+        self.assertEqual(200, status)
+        result = json.loads(data)
+        headers, values = metricmaker.generate(TIME_COURSE, TIME_POINTS, None, None, [1, 1, 1, 1, 0, 0, 0, 0, 0])
+        self.assertEqual('AKT', result['label'])
+        self.assertEqual(headers, result['headers'])
+        self.assertEqual(values, result['values'])
+        # failed peak detection leaves the peak metrics empty, batched or not
+        tied = [3, 3, 3, 1, 0, 3, 1, 3, 3, 3, 3, 3, 3]
+        status, data = self.request('POST', '/generate', {'time_course': tied, 'time_points': TIME_POINTS})
+        self.assertEqual(200, status)
+        self.assertEqual([None]*3, json.loads(data)['values'][-3:])
+        status, data = self.request('POST', '/generate', {'time_course': TIME_COURSE[:-1], 'time_points': TIME_POINTS})
+        self.assertEqual(422, status)
+        self.assertEqual('TimePointsMismatchWithTimeCourse', json.loads(data)['error'])
+        self.assertEqual(400, self.request('POST', '/generate', {'time_course': TIME_COURSE})[0])
+        self.assertEqual(404, self.request('GET', '/nowhere')[0])
+
+    def testBatching(self):
+        results = [None]*12
+        def post(i):
+            time_course = [value + i for value in TIME_COURSE]
+            results[i] = self.request('POST', '/generate', {'time_course': time_course, 'time_points': TIME_POINTS,
+                                                            'label': i})
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i, (status, data) in enumerate(results):
+            self.assertEqual(200, status)
+            result = json.loads(data)
+            expected = metricmaker.generate([value + i for value in TIME_COURSE], TIME_POINTS, None, None, None)[1]
+            self.assertEqual(i, result['label'])
+            for value, expected_value in zip(result['values'], expected):
+                self.assertAlmostEqual(expected_value, value)
+        stats = json.loads(self.request('GET', '/stats')[1])
+        self.assertEqual(12, stats['requests'])
+        self.assertEqual(12, stats['time_courses'])
+        # concurrent requests share batches
+        self.assertTrue(stats['batches'] < 12)
+        self.assertTrue(stats['latency_p99'] >= stats['latency_p50'] > 0)
+
+    def testStreaming(self):
+        items = [{'time_course': TIME_COURSE, 'time_points': TIME_POINTS, 'label': 'a'},
+                 {'time_course': [0, None, None, None, 1, 2, None, None, None, None],
+                  'time_points': range(1, 11), 'label': 'b'},
+                 {'time_course': TIME_COURSE[::-1], 'time_points': TIME_POINTS, 'label': 'c'}]
+        status, data = self.request('POST', '/generate', {'time_courses': items})
+        self.assertEqual(200, status)
+        lines = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual(['a', 'b', 'c'], [line['label'] for line in lines])
+        self.assertEqual('TooManyEmptyValues', lines[1]['error'])
+        self.assertEqual(metricmaker.generate(TIME_COURSE[::-1], TIME_POINTS, None, None, [1, 0, 0, 0, 0, 0, 0, 0, 0])[1][0],
+                         lines[2]['values'][0])
+
+    def testBadRequests(self):
+        for body in [{'time_course': 5, 'time_points': [1]},
+                     {'time_course': [1, 2, 3], 'time_points': [[1], [2], [3]]},
+                     {'time_course': [1, 2, 3], 'time_points': [1, 2, 3], 'metric_select': [[1], 0]},
+                     {'time_course': [1, 'a', 3], 'time_points': [1, 2, 3]},
+                     {'time_course': [1, 2, 3], 'time_points': [1, 2, 3], 'sensitivity': '0.1'}]:
+            status, data = self.request('POST', '/generate', body)
+            self.assertEqual(400, status)
+            self.assertEqual('BadRequest', json.loads(data)['error'])
+        # a timecourse which fails in the dispatcher fails alone
+        broken = metricmakerservice.PendingTimeCourse(5, [1], 'broken', None, None)
+        self.service.dispatcher.submit([broken])
+        self.assertEqual('TypeError', broken.wait(5)['error'])
+        status, data = self.request('POST', '/generate', {'time_course': TIME_COURSE, 'time_points': TIME_POINTS})
+        self.assertEqual(200, status)
+        # undefined metrics are null, never NaN
+        status, data = self.request('POST', '/generate', {'time_course': [0, 1, 2, 1, 2, 3, 2, None, None, None],
+                                                          'time_points': range(10), 'metric_select': [0, 0, 0, 1, 0, 0, 0, 0, 0]})
+        self.assertEqual(200, status)
+        self.assertEqual([None], json.loads(data, parse_constant=self.fail)['values'])
+
+    def testTimeout(self):
+        service = metricmakerservice.MetricService(('127.0.0.1', 0), window=1.0, result_timeout=0.1)
+        service.start()
+        try:
+            connection = httplib.HTTPConnection(*service.server_address)
+            connection.request('POST', '/generate', json.dumps({'time_course': TIME_COURSE, 'time_points': TIME_POINTS}))
+            response = connection.getresponse()
+            self.assertEqual(504, response.status)
+            self.assertEqual('Timeout', json.loads(response.read())['error'])
+            connection.close()
+        finally:
+            service.stop()
+
+    def testBackpressure(self):
+        items = [{'time_course': TIME_COURSE, 'time_points': TIME_POINTS}]*65
+        status, data = self.request('POST', '/generate', {'time_courses': items})
+        self.assertEqual(503, status)
+        self.assertEqual('ServiceBusy', json.loads(data)['error'])
+        self.assertEqual(1, self.service.stats()['rejected'])
+        self.assertEqual(200, self.request('POST', '/generate', {'time_courses': items[:64]})[0])
+
+if __name__ == "__main__":
+    unittest.main()
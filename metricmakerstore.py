@@ -0,0 +1,179 @@
+"""Persistent store of metricmaker results
+
+ Keeps the results of metricmaker.generate in an SQLite file, keyed on a hash of the content
+ of each timecourse with its time points, sensitivity and metric_select, so a rerun over a
+ panel only computes the timecourses which changed since the last run.
+
+ Every key also holds the algorithm version (see algorithm_version): results computed by an
+ older version of the metric or peak finding code are never returned, and are deleted when
+ the store is opened.
+
+ Usage:
+ with MetricStore('metrics.sqlite') as store:
+     results, failures = store.generate(time_courses, time_points, labels, 0.1, None)
+"""
+
+__author__ = "Soren Burkhart (soren.burkhart@gmail.com)"
+__version__ = "$Revision: 0.2 $"
+__date__ = "$Date: 2010/02/01 19:40:22 $"
+__copyright__ = "Copyright (c) 2010 Soren Burkhart"
+__license__ = "Python"
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import metricmaker
+
+class StoreError(metricmaker.MetricMakerError): pass
+
+# bump when a change outside metricmaker.py changes the results of generate
+ALGORITHM_VERSION = 1
+
+def algorithm_version():
+    """
+     Returns the version tag stored with every result: ALGORITHM_VERSION and a hash of the
+     metricmaker source, so any change to the metric or peak finding code invalidates the
+     stored results.
+    """
+    source = os.path.splitext(metricmaker.__file__)[0] + '.py'
+    digest = hashlib.sha1()
+    try:
+        with open(source, 'rb') as source_file:
+            digest.update(source_file.read())
+    except IOError:
+        # without the source, e.g. when only the compiled module is installed
+        digest.update(metricmaker.__version__)
+    return "%d-%s" % (ALGORITHM_VERSION, digest.hexdigest()[:16])
+
+class MetricStore(object):
+    """
+     Results of generate kept in an SQLite file.
+
+     path:
+     The SQLite file, created if it does not exist.  ':memory:' keeps the store in memory.
+
+     version:
+     The algorithm version tag, defaults to algorithm_version().  Results stored with any
+     other version are deleted when the store is opened.
+
+     Results are stored without their TC_label, so the same timecourse under another label
+     is still found.  hits and misses count the timecourses looked up since the store was
+     opened.
+    """
+    def __init__(self, path, version=None):
+        self.path = path
+        self.version = algorithm_version() if version is None else version
+        self.hits = 0
+        self.misses = 0
+        try:
+            self.connection = sqlite3.connect(path)
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                        "key TEXT PRIMARY KEY, version TEXT NOT NULL, "
+                                        "headers TEXT NOT NULL, metric_values TEXT NOT NULL)")
+                self.connection.execute("CREATE TEMP TABLE lookup (key TEXT PRIMARY KEY)")
+                self.invalidated = self.connection.execute("DELETE FROM results WHERE version != ?",
+                                                           (self.version,)).rowcount
+        except sqlite3.Error, error:
+            raise StoreError, "%s: %s" % (path, error)
+
+    def run_key(self, time_points, sensitivity, metric_select, missing_policy=None):
+        "Hash of the arguments shared by every timecourse of a run, see key"
+        if missing_policy is None:
+            missing_policy = metricmaker.MISSING_VALUE_POLICY
+        return metricmaker.content_key(self.version, 'generate', time_points, sensitivity,
+                                       metric_select, missing_policy)
+
+    def key(self, time_course, time_points, sensitivity, metric_select, run_key=None, missing_policy=None):
+        "The key of the result of generate for these arguments"
+        if run_key is None:
+            run_key = self.run_key(time_points, sensitivity, metric_select, missing_policy)
+        return metricmaker.content_key(run_key, time_course)
+
+    def lookup(self, keys):
+        """
+         Looks up many keys with one query.  Returns a dictionary key -> (headers, values)
+         holding the keys which were found.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM lookup")
+            self.connection.executemany("INSERT OR IGNORE INTO lookup VALUES (?)", ((key,) for key in keys))
+            rows = self.connection.execute("SELECT results.key, headers, metric_values FROM lookup "
+                                           "JOIN results ON results.key = lookup.key").fetchall()
+        # the results of a run share their headers, which are decoded once
+        decoded = {}
+        found = {}
+        for key, headers, values in rows:
+            if headers not in decoded:
+                decoded[headers] = json.loads(headers)
+            found[key] = (decoded[headers], json.loads(values))
+        return found
+
+    def store(self, results):
+        "Stores an iterable of (key, (headers, values)) in one transaction"
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                        ((key, self.version, json.dumps(headers), json.dumps(values))
+                                         for key, (headers, values) in results))
+
+    def generate(self, time_courses, time_points, labels, sensitivity, metric_select, workers=None,
+                 missing_policy=None):
+        """
+         generate_parallel over the timecourses which are not stored yet.
+         Input format: store.generate(time_courses, time_points, labels, sensitivity, metric_select, workers, missing_policy)
+
+         time_courses, time_points, labels, sensitivity, metric_select, missing_policy:
+         As for metricmaker.generate_parallel.
+
+         workers:
+         Number of worker processes computing the missing results, as for generate_parallel.
+
+         The stored results are looked up with one query and the new results are stored in
+         one transaction, so a rerun costs a hash per timecourse plus the work for the
+         timecourses which changed.  Failed timecourses are not stored.
+
+         OUTPUT: (results, failures) as from generate_parallel.
+        """
+        if labels is None:
+            labels = [None]*len(time_courses)
+        run_key = self.run_key(time_points, sensitivity, metric_select, missing_policy)
+        keys = [self.key(time_course, time_points, sensitivity, metric_select, run_key) for time_course in time_courses]
+        found = self.lookup(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        results = [None]*len(time_courses)
+        failures = []
+        if missing:
+            computed, computed_failures = metricmaker.generate_parallel([time_courses[i] for i in missing], time_points,
+                                                                        None, sensitivity, metric_select, workers,
+                                                                        missing_policy=missing_policy)
+            self.store((keys[i], result) for i, result in zip(missing, computed) if result is not None)
+            for i, result in zip(missing, computed):
+                found[keys[i]] = result
+            failures = [(missing[j], error) for j, error in computed_failures]
+        for i, key in enumerate(keys):
+            if found[key] is not None:
+                headers, values = found[key]
+                results[i] = (metricmaker.label_headers(labels[i], headers), list(values))
+        return results, failures
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear(self):
+        "Deletes every stored result"
+        with self.connection:
+            self.connection.execute("DELETE FROM results")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
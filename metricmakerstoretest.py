@@ -0,0 +1,73 @@
+"""Unit test for the metric maker results store"""
+
+import metricmaker
+import metricmakerstore
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+TIME_POINTS = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+
+class StoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metrics.sqlite')
+        generator = random.Random(2010)
+        self.time_courses = [[generator.random() for t in TIME_POINTS] for i in xrange(6)]
+        self.labels = ['AKT', 'JNK', 'ERK', 'p38', 'IKK', None]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testIncrementalRuns(self):
+        with metricmakerstore.MetricStore(self.path) as store:
+            results, failures = store.generate(self.time_courses, TIME_POINTS, self.labels, 0.1, None, 1)
+            self.assertEqual([], failures)
+            self.assertEqual((0, 6), (store.hits, store.misses))
+            self.assertEqual(6, len(store))
+        expected = [metricmaker.generate(time_course, TIME_POINTS, self.labels[i], 0.1, None)
+                    for i, time_course in enumerate(self.time_courses)]
+        self.assertEqual(expected, results)
+
+        # a rerun only computes the timecourses which changed
+        self.time_courses[2] = [value*2 for value in self.time_courses[2]]
+        self.time_courses[4][:7] = [None]*7
+        generate = metricmaker.generate
+        computed = []
+        metricmaker.generate = lambda time_course, *arguments: computed.append(time_course) or generate(time_course, *arguments)
+        try:
+            with metricmakerstore.MetricStore(self.path) as store:
+                results, failures = store.generate(self.time_courses, TIME_POINTS, self.labels, 0.1, None, 1)
+                self.assertEqual((4, 2), (store.hits, store.misses))
+                self.assertEqual(7, len(store))
+        finally:
+            metricmaker.generate = generate
+        self.assertEqual([self.time_courses[2], self.time_courses[4]], computed)
+        self.assertEqual(generate(self.time_courses[2], TIME_POINTS, 'ERK', 0.1, None), results[2])
+        self.assertEqual(expected[:2], results[:2])
+        self.assertEqual(None, results[4])
+        self.assertEqual([4], [i for i, error in failures])
+        self.assertTrue(isinstance(failures[0][1], metricmaker.TooManyEmptyValues))
+
+    def testVersions(self):
+        with metricmakerstore.MetricStore(self.path) as store:
+            store.generate(self.time_courses, TIME_POINTS, None, 0.1, [1, 1, 0, 0, 0, 0, 0, 0, 0], 1)
+            # other arguments are other keys
+            store.generate(self.time_courses[:2], TIME_POINTS, None, 0.2, [1, 1, 0, 0, 0, 0, 0, 0, 0], 1)
+            store.generate(self.time_courses[:1], TIME_POINTS, None, 0.1, [1, 1, 0, 0, 0, 0, 0, 0, 0], 1, 'interpolate')
+            self.assertEqual(9, store.misses)
+            self.assertEqual(9, len(store))
+        with metricmakerstore.MetricStore(self.path, 'older') as store:
+            self.assertEqual(9, store.invalidated)
+            self.assertEqual(0, len(store))
+            store.generate(self.time_courses, TIME_POINTS, None, 0.1, [1, 1, 0, 0, 0, 0, 0, 0, 0], 1)
+            self.assertEqual(6, store.misses)
+        self.assertEqual(metricmakerstore.algorithm_version(), metricmakerstore.algorithm_version())
+        self.assertTrue(metricmakerstore.algorithm_version().startswith('%d-' % metricmakerstore.ALGORITHM_VERSION))
+        self.assertRaises(metricmakerstore.StoreError, metricmakerstore.MetricStore,
+                          os.path.join(self.directory, 'missing', 'metrics.sqlite'))
+
+if __name__ == "__main__":
+    unittest.main()
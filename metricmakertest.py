@@ -1,11 +1,13 @@
 """Unit test for metric maker"""
 
+import math
 import metricmaker
+import random
 import unittest
+import warnings
 
 class MetricTests(unittest.TestCase):
     def testTooManyEmptyTimeCourses(self):
-        self.assertTrue(False,'Need resolution on whether time course is going to be allowed to have None in the array')
         time_course = [0,None,None,None,1,2,None,None,None,None ]
         time_points = [1,2,3,4,5,6,7,8,9,10]
         TC_label = None
@@ -16,7 +18,6 @@ class MetricTests(unittest.TestCase):
                           time_course, time_points, TC_label, sensitivity, metric_select)
     
     def testValidTimeCourses(self):
-        self.assertTrue(False,'Need resolution on whether time course is going to be allowed to have None in the array')
         time_course = [0,1,2,1,1,2,None,None,None,None]
         time_points = [1,2,3,4,5,6,7,8,9,10]
         TC_label = None
@@ -24,6 +25,61 @@ class MetricTests(unittest.TestCase):
         metric_select = None
         metricmaker.generate(time_course, time_points, TC_label, sensitivity, metric_select)
 
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testMissingValuePolicies(self):
+        nan = metricmaker.numpy.nan
+        time_points = [0, 1, 2, 4, 5]
+        filled = metricmaker.fill_missing([[nan, 1, nan, 3, nan], [nan]*5, [4, 3, 2, 1, 0]], time_points, 'interpolate')
+        self.assertEqual([1, 1, 1 + 2/3.0, 3, 3], filled[0].tolist())
+        self.assertTrue(metricmaker.numpy.isnan(filled[1]).all())
+        self.assertEqual([4, 3, 2, 1, 0], filled[2].tolist())
+        filled = metricmaker.fill_missing([[nan, 1, nan, 3, nan]], time_points, 'carry_forward')
+        self.assertEqual([[1, 1, 1, 3, 3]], filled.tolist())
+        self.assertRaises(metricmaker.UnknownMissingValuePolicy, metricmaker.fill_missing, [[1, 2]], [0, 1], 'zero')
+        self.assertEqual([False, True, True],
+                         metricmaker.too_many_empty(metricmaker.numpy.array([[1, nan, 2, 3], [nan, 1, nan, 2], [nan]*4]), 4).tolist())
+
+        time_course = [0,1,2,1,None,2,None,3,None,4]
+        time_points = [1,2,3,4,5,6,7,8,9,10]
+        # drop leaves the empty values out
+        headers, values = metricmaker.generate(time_course, time_points, None, None, [1, 1, 1, 1, 1, 1, 0, 0, 0])
+        self.assertAlmostEqual(13/7.0, values[0])
+        self.assertAlmostEqual(18.5, values[1])
+        self.assertEqual(4, values[2])
+        self.assertAlmostEqual(3.5, values[3])
+        self.assertEqual([1, 1, -1, None, None, None, None, None, None], values[4:13])
+        self.assertEqual(time_course, values[13:])
+        batch_headers, matrix = metricmaker.generate_batch([time_course], time_points, None, None, [1, 1, 1, 1, 0, 0, 0, 0, 0])
+        for value, expected in zip(matrix[0], values[:4]):
+            self.assertAlmostEqual(expected, value)
+        # the other policies fill the gaps first
+        for policy in ['interpolate', 'carry_forward']:
+            filled = metricmaker.fill_missing([[nan if v is None else v for v in time_course]], time_points, policy)[0].tolist()
+            self.assertEqual(metricmaker.generate(filled, time_points, None, None, None),
+                             metricmaker.generate(time_course, time_points, None, None, None, policy))
+            batch_headers, matrix = metricmaker.generate_batch([time_course, filled], time_points, None, None, None, policy)
+            self.assertTrue(metricmaker.numpy.allclose(matrix[1], matrix[0], equal_nan=True))
+        self.assertEqual([0, 1, 2, 1, 1.5, 2, 2.5, 3, 3.5, 4],
+                         metricmaker.generate(time_course, time_points, None, None, [0, 0, 0, 0, 0, 1, 0, 0, 0], 'interpolate')[1])
+        self.assertRaises(metricmaker.UnknownMissingValuePolicy,
+                          metricmaker.generate, time_course, time_points, None, None, None, 'zero')
+        # an Equilibrium window without values is undefined, without a warning
+        time_course = [0, 1, 2, 1, 2, 3, 2, None, None, None]
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual([None], metricmaker.generate(time_course, time_points, None, None, [0, 0, 0, 1, 0, 0, 0, 0, 0])[1])
+            batch_headers, matrix = metricmaker.generate_batch([time_course, time_points], time_points, None, None, [1, 0, 0, 1, 0, 0, 0, 0, 0])
+        self.assertEqual([11/7.0, 5.5], matrix[:, 0].tolist())
+        self.assertTrue(metricmaker.numpy.isnan(matrix[0, 1]))
+        self.assertEqual(9, matrix[1, 1])
+        # a window whose only value is its first one is not empty
+        self.assertEqual([4.34], metricmaker.generate(metricmaker.TimeCourse([8.8, 9.87, 4.34], [0, 1, 2]),
+                                                      [0, 1, 2], None, None, [0, 0, 0, 1, 0, 0, 0, 0, 0])[1])
+        time_course = [None, 3.39, 6.38, 8.19]
+        values = metricmaker.generate(time_course, range(4), None, None, [0, 0, 0, 1, 0, 0, 0, 0, 0])[1]
+        self.assertEqual([8.19], values)
+        self.assertEqual(values, metricmaker.generate_batch([time_course], range(4), None, None, [0, 0, 0, 1, 0, 0, 0, 0, 0])[1][0].tolist())
+
     def testZerosFunction(self):
         z = metricmaker.zeros(1,1)
         self.assertEqual([[0]], z)
@@ -94,6 +150,481 @@ class MetricTests(unittest.TestCase):
         self.assertEqual([-1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
                          metricmaker.peak_finder(time_course, sensitivity))
     
+    def testPeakFinderEngines(self):
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        expected = {0.1: [-1, 0, 1, 0, -1, 0, 0, 0, 0, 0, 1, -1, 1],
+                    0.5: [-1, 0, 1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 1],
+                    1.0: [-1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1]}
+        for engine in metricmaker.PEAK_FINDER_ENGINES:
+            for sensitivity, peaks in expected.items():
+                self.assertEqual(peaks,
+                                 metricmaker.peak_finder(time_course, sensitivity, engine))
+        self.assertRaises(metricmaker.UnknownEngine,
+                          metricmaker.peak_finder, time_course, 0.1, 'no such engine')
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testVectorizedPeakFinderMatchesClassic(self):
+        generator = random.Random(2010)
+        for trial in xrange(600):
+            time_course = [generator.random() for i in xrange(generator.randint(3, 40))]
+            if trial % 3 == 1:
+                # quantized values, as read from an instrument
+                time_course = [round(value, 1) for value in time_course]
+            elif trial % 3 == 2:
+                # few levels, so most points are tied with a peak
+                time_course = [generator.randint(0, 3) for value in time_course]
+            sensitivity = generator.choice([0, 0.05, 0.1, 0.3, 0.5, 1.0])
+            self.assertEqual(metricmaker.calculate_peak_valley(time_course),
+                             metricmaker.calculate_peak_valley_vectorized(time_course).tolist())
+            try:
+                expected = metricmaker.classic_peak_finder(time_course, sensitivity)
+            except metricmaker.UnknownError:
+                self.assertRaises(metricmaker.UnknownError,
+                                  metricmaker.vectorized_peak_finder, time_course, sensitivity)
+            else:
+                self.assertEqual(expected,
+                                 metricmaker.vectorized_peak_finder(time_course, sensitivity))
+        # the classic engine walks from the last point of a group of tied values first, here
+        # the point at 5 which is not a peak, and so never checks the peak at 2
+        time_course = [1, 3, 3, 1, 2, 3, 4, 0, 4]
+        self.assertEqual([-1, 0, 1, -1, 0, 0, 1, -1, 1],
+                         metricmaker.classic_peak_finder(time_course, 0.6))
+        self.assertEqual(metricmaker.classic_peak_finder(time_course, 0.6),
+                         metricmaker.vectorized_peak_finder(time_course, 0.6))
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testSignificanceIndex(self):
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        index = metricmaker.SignificanceIndex(time_course)
+        self.assertEqual([2, 10], sorted(index.critical_sensitivity))
+        self.assertAlmostEqual(0.6276060007504175, index.critical_sensitivity[2])
+        self.assertAlmostEqual(0.10043252047268364, index.critical_sensitivity[10])
+        self.assertEqual([[-1, 0, 1, 0, -1, 0, 0, 0, 0, 0, 1, -1, 1],
+                          [-1, 0, 1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 1],
+                          [-1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1]],
+                         metricmaker.peak_finder_sweep(time_course, [0.1, 0.5, 1.0]))
+        generator = random.Random(2010)
+        sensitivities = [i/20.0 for i in xrange(21)]
+        for trial in xrange(200):
+            time_course = [generator.random() for i in xrange(generator.randint(3, 40))]
+            if trial % 2:
+                # quantized values, with ties between peaks and other points
+                time_course = [round(3*value) for value in time_course]
+            index = metricmaker.SignificanceIndex(time_course)
+            self.assertTrue(index.indexed)
+            for sensitivity in sensitivities:
+                try:
+                    expected = metricmaker.classic_peak_finder(time_course, sensitivity)
+                except metricmaker.UnknownError:
+                    self.assertRaises(metricmaker.UnknownError, index.peak_finder, sensitivity)
+                else:
+                    self.assertEqual(expected, index.peak_finder(sensitivity))
+
+    def testGenerate(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        headers, values = metricmaker.generate(time_course, time_points, 'AKT', 0.1, [1, 1, 1, 1, 0, 0, 0, 0, 0])
+        self.assertEqual(['AKT_mean', 'AKT_AUC_whole', 'AKT_Max', 'AKT_Equilibrium'],
+                         headers)
+        self.assertEqual([metricmaker.mean(time_course),
+                          38.824680533169918,
+                          2.41681636767,
+                          metricmaker.mean(time_course[9:])],
+                         values)
+        headers, values = metricmaker.generate(time_course, time_points, 'AKT', 0.1, [0, 0, 0, 0, 1, 1, 0, 0, 0])
+        self.assertEqual(['AKT_Derivative_%d' % i for i in range(1, 13)] + ['AKT_Data_Points_%d' % i for i in range(1, 14)],
+                         headers)
+        self.assertAlmostEqual((1.590688972-1.2672097275)/0.083333333333333329, values[0])
+        self.assertEqual(time_course, values[12:])
+        self.assertRaises(metricmaker.TimePointsMismatchWithTimeCourse,
+                          metricmaker.generate,
+                          time_course, time_points[:-1], 'AKT', 0.1, None)
+
+    def testMetricPlan(self):
+        self.assertEqual([], metricmaker.plan_metrics(['mean', 'Max']))
+        self.assertEqual(['time_steps', 'diff', 'cumulative_integral'],
+                         metricmaker.plan_metrics(['Derivative', 'AUC_whole', 'mean']))
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        cumulative = metricmaker.trapz_index(time_points, time_course)
+        self.assertEqual(13, len(cumulative))
+        self.assertEqual(0, cumulative[0])
+        self.assertEqual(metricmaker.trapz(time_points, time_course), cumulative[-1])
+        self.assertAlmostEqual(metricmaker.trapz(time_points[:4], time_course[:4]), cumulative[3])
+        # peak detection only runs for the metrics which need it
+        calls = []
+        peak_finder = metricmaker.peak_finder
+        metricmaker.peak_finder = lambda *arguments: calls.append(arguments) or peak_finder(*arguments)
+        try:
+            metricmaker.generate(time_course, time_points, 'AKT', None, [1, 0, 1, 0, 0, 0, 0, 0, 0])
+            metricmaker.generate(time_course, time_points, 'AKT', 0.1, [1, 1, 1, 1, 1, 1, 0, 0, 0])
+            self.assertEqual([], calls)
+            intermediates = metricmaker.compute_intermediates(['peak_valley', 'peak_index', 'valley_index'],
+                                                              time_course, time_points, 0.1)
+        finally:
+            metricmaker.peak_finder = peak_finder
+        self.assertEqual([(time_course, 0.1)], calls)
+        self.assertEqual([2, 10, 12], intermediates['peak_index'])
+        self.assertEqual([0, 4, 11], intermediates['valley_index'])
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testTrapzWindows(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        index = metricmaker.trapz_index(time_points, time_course)
+        windows = [(0, 12), (2, 4), (4, 10), (5, 5), (11, 12)]
+        for start, end in windows:
+            self.assertAlmostEqual(metricmaker.trapz(time_points[start:end+1], time_course[start:end+1]),
+                                   metricmaker.trapz_window(index, start, end))
+        starts, ends = zip(*windows)
+        areas = metricmaker.trapz_windows(index, starts, ends)
+        self.assertEqual([metricmaker.trapz_window(index, start, end) for start, end in windows], areas.tolist())
+        batch_index = metricmaker.trapz_index_batch(time_points, [time_course, time_course[::-1]])
+        self.assertTrue(metricmaker.numpy.allclose(index, batch_index[0]))
+        areas = metricmaker.trapz_windows(batch_index, [[2, 0], [0, 1]], [[4, 12], [12, 3]])
+        self.assertAlmostEqual(metricmaker.trapz(time_points[2:5], time_course[2:5]), areas[0, 0])
+        self.assertAlmostEqual(metricmaker.trapz(time_points, time_course[::-1]), areas[1, 0])
+        self.assertAlmostEqual(metricmaker.trapz(time_points[1:4], time_course[::-1][1:4]), areas[1, 1])
+        # empty values are left out as in trapz
+        gappy = metricmaker.TimeCourse([1.0, None, 3.0, 5.0, None], [0., 1., 2., 3., 4.])
+        self.assertEqual([0.0, 0.0, 4.0, 8.0, 8.0], metricmaker.trapz_index(None, gappy))
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testAUCPeak(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        headers, values = metricmaker.generate(time_course, time_points, None, 0.1, [0, 0, 0, 0, 0, 0, 1, 0, 0])
+        self.assertEqual(['AUC_peak'], headers)
+        # the highest peak is the last timepoint, after the valley at 20 hours
+        self.assertAlmostEqual(metricmaker.trapz(time_points[11:], time_course[11:]), values[0])
+        # a rising timecourse is a single peak from its first to its last timepoint
+        rising = [float(i) for i in range(13)]
+        self.assertEqual([metricmaker.trapz(time_points, rising)],
+                         metricmaker.generate(rising, time_points, None, 0.1, [0, 0, 0, 0, 0, 0, 1, 0, 0])[1])
+        batch_headers, matrix = metricmaker.generate_batch([time_course, rising, time_course[::-1]], time_points,
+                                                           None, 0.1, [0, 0, 0, 0, 0, 0, 1, 0, 0])
+        self.assertEqual(['AUC_peak'], batch_headers[0])
+        self.assertAlmostEqual(values[0], matrix[0, 0])
+        self.assertAlmostEqual(metricmaker.trapz(time_points, rising), matrix[1, 0])
+        self.assertAlmostEqual(metricmaker.generate(time_course[::-1], time_points, None, 0.1, [0, 0, 0, 0, 0, 0, 1, 0, 0])[1][0],
+                               matrix[2, 0])
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testPeakFits(self):
+        time_points = [float(t) for t in range(11)]
+        # a linear rise of 2 per hour to a peak at 4 hours, then a decay with rate 0.5
+        time_course = [1 + 2*t for t in time_points[:5]] + [9*math.exp(-0.5*(t-4)) for t in time_points[5:]]
+        headers, values = metricmaker.generate(time_course, time_points, None, 0.1, [0, 0, 0, 0, 0, 0, 0, 1, 1])
+        self.assertEqual(['ActivationSlope_peak', 'DecayRate_peak'], headers)
+        self.assertAlmostEqual(2, values[0])
+        self.assertAlmostEqual(0.5, values[1])
+        self.assertEqual((2, 1, 1), metricmaker.least_squares([0, 1, 2], [1, 3, 5]))
+        self.assertEqual(None, metricmaker.least_squares([1, 1], [1, 3]))
+        # every peak of every row, fitted at once
+        generator = random.Random(2010)
+        time_courses = [time_course] + [[generator.random() for t in time_points] for i in xrange(20)]
+        fits = metricmaker.peak_fits(time_courses, time_points, 0.1)
+        self.assertEqual(0, fits['row'][0])
+        self.assertAlmostEqual(1, fits['activation_r_squared'][0])
+        self.assertAlmostEqual(1, fits['decay_r_squared'][0])
+        self.assertTrue(len(fits['row']) > len(time_courses))
+        for k, row in enumerate(fits['row']):
+            rise = metricmaker.least_squares(*metricmaker.segment_points(time_courses[row], time_points, fits['left'][k], fits['peak'][k]))
+            fall = metricmaker.least_squares(*metricmaker.segment_points(time_courses[row], time_points, fits['peak'][k], fits['right'][k], True))
+            for fit, slope, r_squared in [(rise, fits['activation_slope'][k], fits['activation_r_squared'][k]),
+                                          (fall, -fits['decay_rate'][k], fits['decay_r_squared'][k])]:
+                if fit is None:
+                    self.assertTrue(math.isnan(slope))
+                else:
+                    self.assertAlmostEqual(fit[0], slope)
+                    self.assertAlmostEqual(fit[2], r_squared)
+        # the metrics fit the highest peak of each row
+        batch_headers, matrix = metricmaker.generate_batch(time_courses, time_points, None, 0.1, [0, 0, 0, 0, 0, 0, 0, 1, 1])
+        for i, time_course in enumerate(time_courses):
+            for value, expected in zip(matrix[i], metricmaker.generate(time_course, time_points, None, 0.1, [0, 0, 0, 0, 0, 0, 0, 1, 1])[1]):
+                if expected is None:
+                    self.assertTrue(math.isnan(value))
+                else:
+                    self.assertAlmostEqual(expected, value)
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testGenerateBatch(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        generator = random.Random(2010)
+        time_courses = [[generator.random() for t in time_points] for i in xrange(5)]
+        labels = ['AKT', 'JNK', 'ERK', 'p38', None]
+        headers, matrix = metricmaker.generate_batch(time_courses, time_points, labels, 0.1, None)
+        self.assertEqual((5, 7 + 12 + 13), matrix.shape)
+        for i, time_course in enumerate(time_courses):
+            expected_headers, expected = metricmaker.generate(time_course, time_points, labels[i], 0.1, None)
+            self.assertEqual(expected_headers, headers[i])
+            for value, expected_value in zip(matrix[i], expected):
+                self.assertAlmostEqual(expected_value, value)
+        # a row where peak detection fails only loses its peak metrics
+        tied = [3, 3, 3, 1, 0, 3, 1, 3, 3, 3, 3, 3, 3]
+        self.assertRaises(metricmaker.UnknownError, metricmaker.peak_finder, tied, 0.1)
+        self.assertEqual([None]*3, metricmaker.generate(tied, time_points, None, 0.1, None)[1][-3:])
+        headers, matrix = metricmaker.generate_batch(time_courses[:1] + [tied], time_points, None, 0.1, None)
+        self.assertTrue(metricmaker.numpy.isnan(matrix[1, -3:]).all())
+        self.assertFalse(metricmaker.numpy.isnan(matrix[1, :-3]).any())
+        self.assertEqual(metricmaker.generate(tied, time_points, None, 0.1, [1, 1, 1, 1, 1, 1, 0, 0, 0])[1],
+                         matrix[1, :-3].tolist())
+        for value, expected_value in zip(matrix[0], metricmaker.generate(time_courses[0], time_points, None, 0.1, None)[1]):
+            self.assertAlmostEqual(expected_value, value)
+        time_courses[2][3:10] = [None]*7
+        self.assertRaises(metricmaker.TooManyEmptyValues,
+                          metricmaker.generate_batch,
+                          time_courses, time_points, labels, 0.1, None)
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testIntegerTimeCourses(self):
+        # integer values and time points give the same metrics as floats in both engines
+        time_course = [0, 3, 2, 1, 1, 2, 5, 4]
+        time_points = [0, 2, 3, 4, 5, 6, 7, 8]
+        headers, values = metricmaker.generate(time_course, time_points, None, None, None)
+        self.assertEqual([2.25, 17.5, 5, 4.5, 1.5], values[:5])
+        batch_headers, matrix = metricmaker.generate_batch([time_course], time_points, None, None, None)
+        for value, expected in zip(matrix[0], values):
+            self.assertAlmostEqual(expected, value)
+        self.assertEqual(17.5, metricmaker.trapz(time_points, time_course))
+        self.assertEqual(2.25, metricmaker.mean(time_course))
+
+    def testGenerateParallel(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        generator = random.Random(2010)
+        time_courses = [[generator.random() for t in time_points] for i in xrange(7)]
+        time_courses[3] = [None]*len(time_points)
+        # ties leave no valley between two peaks, which only empties the peak metrics
+        time_courses[5] = [3, 3, 3, 1, 0, 3, 1, 3, 3, 3, 3, 3, 3]
+        time_courses[6][4] = None
+        labels = ['signal%d' % i for i in xrange(7)]
+        for workers in (1, 2):
+            results, failures = metricmaker.generate_parallel(time_courses, time_points, labels, 0.1, None,
+                                                              workers=workers, chunk_size=2)
+            self.assertEqual(7, len(results))
+            self.assertEqual(None, results[3])
+            self.assertEqual([3], [i for i, error in failures])
+            self.assertTrue(isinstance(failures[0][1], metricmaker.TooManyEmptyValues))
+            for i in (0, 1, 2, 4, 5, 6):
+                self.assertEqual(metricmaker.generate(time_courses[i], time_points, labels[i], 0.1, None),
+                                 results[i])
+        # errors outside MetricMakerError fail their timecourse only
+        results, failures = metricmaker.generate_parallel([time_courses[0], ['x']*len(time_points)], time_points,
+                                                          None, 0.1, None, workers=1)
+        self.assertEqual([1], [i for i, error in failures])
+        self.assertTrue(isinstance(failures[0][1], TypeError))
+        self.assertEqual(metricmaker.generate(time_courses[0], time_points, None, 0.1, None), results[0])
+        results, failures = metricmaker.generate_parallel(time_courses[6:], time_points, None, 0.1, None,
+                                                          workers=1, missing_policy='interpolate')
+        self.assertEqual(metricmaker.generate(time_courses[6], time_points, None, 0.1, None, 'interpolate'), results[0])
+
+    def testResultCache(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        expected = metricmaker.generate(time_course, time_points, 'AKT', 0.1, None)
+        cache = metricmaker.enable_cache(max_entries=3)
+        try:
+            self.assertEqual(expected, metricmaker.generate(time_course, time_points, 'AKT', 0.1, None))
+            headers, values = metricmaker.generate(time_course, time_points, 'JNK', 0.1, None)
+            self.assertEqual(['JNK' + header[3:] for header in expected[0]], headers)
+            self.assertEqual(expected[1], values)
+            self.assertEqual(1, cache.hits)
+            # changing a returned array must not change the cached one
+            values[0] = None
+            peaks = metricmaker.peak_finder(time_course, 0.1)
+            peaks[2] = 0
+            self.assertEqual(expected, metricmaker.generate(time_course, time_points, 'AKT', 0.1, None))
+            self.assertEqual([-1, 0, 1, 0, -1, 0, 0, 0, 0, 0, 1, -1, 1],
+                             metricmaker.peak_finder(time_course, 0.1))
+            self.assertEqual(4, cache.hits)
+            # the least recently used result is evicted
+            for sensitivity in (0.2, 0.3, 0.4):
+                metricmaker.peak_finder(time_course, sensitivity)
+            self.assertEqual(3, cache.stats()['entries'])
+            self.assertTrue(cache.evictions > 0)
+            misses = cache.misses
+            metricmaker.generate(time_course, time_points, 'AKT', 0.1, None)
+            # generate and its peak detection were both evicted
+            self.assertEqual(misses + 2, cache.misses)
+        finally:
+            metricmaker.disable_cache()
+        self.assertEqual(None, metricmaker.result_cache)
+        small = metricmaker.ResultCache(max_entries=10, max_bytes=1000)
+        small.put('a', tuple(range(100)))
+        self.assertEqual(None, small.get('a'))
+
+    def testProfiling(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        with metricmaker.profiling() as profile:
+            metricmaker.generate(time_course, time_points, 'AKT', 0.1, [1, 0, 1, 0, 1, 0, 0, 0, 0])
+            metricmaker.peak_finder(time_course, 0.1, 'classic')
+        self.assertEqual(None, metricmaker.profiler)
+        stats = profile.stats()
+        self.assertEqual(['calculate_peak_valley', 'generate', 'generate.diff', 'generate.metrics',
+                          'generate.time_steps', 'peak_finder', 'peak_finder.sort',
+                          'peak_finder.valleys', 'peak_finder.walks'],
+                         sorted(stats))
+        self.assertEqual(1, stats['generate']['calls'])
+        self.assertEqual(13, stats['generate']['size'])
+        self.assertEqual('AKT', stats['generate']['slowest'][0][3])
+        self.assertEqual({16: 1}, stats['peak_finder']['histograms']['size'])
+        # both engines walk over the same points
+        classic_steps = stats['peak_finder.walks']['iterations']
+        self.assertTrue(classic_steps > 0)
+        with metricmaker.profiling(profile):
+            metricmaker.peak_finder(time_course, 0.1, 'classic')
+        self.assertEqual(2*classic_steps, profile.stats()['peak_finder.walks']['iterations'])
+        if metricmaker.numpy is not None:
+            with metricmaker.profiling() as vectorized:
+                metricmaker.peak_finder(time_course, 0.1, 'vectorized')
+            self.assertEqual(classic_steps, vectorized.stats()['peak_finder.walks']['iterations'])
+        self.assertTrue(profile.report().startswith('stage'))
+        self.assertEqual([0, 1, 2, 4, 4, 8, 0.5], [metricmaker.histogram_bucket(value) for value in [0, 1, 2, 3, 4, 5, 0.3]])
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testResample(self):
+        numpy = metricmaker.numpy
+        hourly = [0, 1, 2, 3, 4]
+        fine = [0, 0.5, 1, 2, 4]
+        self.assertEqual([[1, 2, 3, 4, 5]], metricmaker.resample([[1, 2, 3, 4, 5]], hourly, hourly).tolist())
+        resampled = metricmaker.resample([[0, 1, 2, None, 4], [4, 3, 2, 1, 0]], fine, [0, 0.25, 1, 3, 4, 5])
+        self.assertEqual([0, 0.5, 2], resampled[0][:3].tolist())
+        self.assertTrue(numpy.isnan(resampled[0][3]))
+        self.assertEqual(4, resampled[0][4])
+        self.assertEqual([4, 3.5, 2, 0.5, 0], resampled[1][:5].tolist())
+        self.assertTrue(numpy.isnan(resampled[:, 5]).all())
+
+        # weights are computed once per pair of grids
+        metricmaker.interpolation_weight_cache.clear()
+        time_courses = [[0., 1., 2., 3., 4.], [1., 1., 2., 4., 8.], [1., 2., 3., 4., 5.], [5., 4., 3., 2., 1.]]
+        grids = [fine, fine, hourly, fine]
+        matrix = metricmaker.resample_batch(time_courses, grids, hourly)
+        self.assertEqual([[0, 2, 3, 3.5, 4], [1, 2, 4, 6, 8], [1, 2, 3, 4, 5], [5, 3, 2, 1.5, 1]], matrix.tolist())
+        metricmaker.resample_batch(time_courses, grids, hourly)
+        self.assertEqual(1, metricmaker.interpolation_weight_cache.misses)
+        self.assertEqual(1, metricmaker.interpolation_weight_cache.hits)
+        left, right, weight = metricmaker.interpolation_weights(fine, hourly)
+        self.assertRaises(ValueError, weight.__setitem__, 0, 0.5)
+        self.assertEqual(list(metricmaker.group_by_grid(grids).values()), [[0, 1, 3], [2]])
+
+        headers, values = metricmaker.generate_grouped(time_courses, grids, ['a', 'b', 'c', 'd'], 0.1, [1, 1, 1, 0, 0, 0, 0, 0, 0])
+        for i in range(4):
+            expected_headers, expected = metricmaker.generate(time_courses[i], grids[i], 'abcd'[i], 0.1, [1, 1, 1, 0, 0, 0, 0, 0, 0])
+            self.assertEqual(expected_headers, headers[i])
+            for value, expected_value in zip(values[i], expected):
+                self.assertAlmostEqual(expected_value, value)
+
+    @unittest.skipIf(metricmaker.numpy is None, 'numpy is not installed')
+    def testTimeCourse(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        course = metricmaker.TimeCourse(time_course, time_points, 'AKT')
+        self.assertEqual(13, len(course))
+        self.assertEqual(time_course, list(course))
+        self.assertEqual(metricmaker.diff(time_course), metricmaker.diff(course))
+        self.assertAlmostEqual(38.824680533169918, metricmaker.trapz(None, course))
+        self.assertAlmostEqual(metricmaker.mean(time_course), metricmaker.mean(course))
+        self.assertEqual([-1, 0, 1, 0, -1, 0, 0, 0, 0, 0, 1, -1, 1],
+                         metricmaker.peak_finder(course, 0.1))
+        headers, values = metricmaker.generate(course, None, None, 0.1, None)
+        expected_headers, expected = metricmaker.generate(time_course, time_points, 'AKT', 0.1, None)
+        self.assertEqual(expected_headers, headers)
+        for value, expected_value in zip(values, expected):
+            self.assertAlmostEqual(expected_value, value)
+
+        # slices are views on the same buffers
+        window = course[2:5]
+        self.assertTrue(metricmaker.numpy.may_share_memory(window.values, course.values))
+        self.assertEqual(time_course[2:5], list(window))
+        self.assertEqual([0.25, 0.5, 1], window.time_points.tolist())
+        self.assertRaises(ValueError, course.__getitem__, slice(0, 10, 2))
+
+        # empty values
+        course = metricmaker.TimeCourse([0, 1, None, 3, 2, None, 1, 0], range(8))
+        self.assertEqual([2, 5], metricmaker.find(course, None))
+        self.assertEqual([1, 6], metricmaker.find(course, 1))
+        self.assertEqual(2, course.missing_count())
+        self.assertEqual([False, True, False], course[4:7].missing().tolist())
+        self.assertEqual(None, course[5])
+        self.assertEqual([1, None, None, -1, None, None, -1], metricmaker.diff(course))
+        self.assertEqual(7 / 6.0, metricmaker.mean(course))
+        self.assertEqual(10.5, metricmaker.trapz(None, course))
+        self.assertEqual([-1, 0, 0, 1, 0, 0, 0, -1],
+                         metricmaker.peak_finder(course, 0.1))
+        self.assertRaises(metricmaker.TimePointsMismatchWithTimeCourse,
+                          metricmaker.TimeCourse, [1, 2, 3], [0, 1])
+
+    def testStreaming(self):
+        time_points = [0, 0.083333333333333329, 0.25, 0.5, 1, 1.5, 2, 4, 8, 12, 16, 20, 24]
+        time_course = [1.2672097275,1.590688972,1.686169412,0.668113898,0.454789704667,0.577257919667,0.747457979667,1.04653912833,1.50108848933,1.58878468067,2.12204150567,1.92499022267,2.41681636767]
+        generator = random.Random(2010)
+        walk = [0]
+        for i in xrange(99):
+            walk.append(walk[-1] + generator.gauss(0, 1))
+        # repeated values walk in groups
+        repeated = [0, 2, 1, 3, 1, 4, 0, 2, 5, 3]
+        rounded = [round(value) for value in walk]
+        levels = [generator.randint(0, 3) for i in xrange(80)]
+        # the candidate at position 1 zeroes the candidates up to its right stop, and the
+        # candidate at position 5 looks past them to the one at position 3
+        behind_first = [0.008, 1.083, 1.022, 1.299, 0.663, 0.699, 0.655, 0.894, 0.824]
+        # falling first, the walk from 8 takes the flag of the first value, and a second walk
+        # to the beginning, from 4 and 1, leaves peak_finder nothing to set
+        first_taken = [7, 6, 8, 4, 0, 3]
+        second_start = [6, 5, 7, 3, 4, 1, 0]
+        for values, times, sensitivity in [(time_course, time_points, 0.1), (walk, range(100), 0.1),
+                                           ([generator.random() for i in xrange(60)], range(60), 0.3),
+                                           (repeated, range(10), 0.2), (rounded, range(100), 0.1),
+                                           (levels, range(80), 0.2), (behind_first, range(9), 0.3),
+                                           (first_taken, range(6), 0.3), (second_start, range(7), 0.3)]:
+            accumulator = metricmaker.TimeCourseAccumulator(sensitivity, 'AKT')
+            for count in xrange(1, len(values) + 1):
+                accumulator.append(times[count-1], values[count-1])
+                if count < 3:
+                    continue
+                try:
+                    expected = metricmaker.peak_finder(values[:count], sensitivity)
+                except metricmaker.UnknownError:
+                    self.assertRaises(metricmaker.UnknownError, accumulator.peak_finder)
+                else:
+                    self.assertEqual(expected, accumulator.peak_finder())
+                headers, expected = metricmaker.generate(values[:count], times[:count], 'AKT', sensitivity, None)
+                streamed_headers, streamed = accumulator.generate()
+                self.assertEqual(headers, streamed_headers)
+                for value, expected_value in zip(streamed, expected):
+                    if expected_value is None:
+                        self.assertEqual(None, value)
+                    else:
+                        self.assertAlmostEqual(expected_value, value)
+        accumulator = metricmaker.TimeCourseAccumulator()
+        accumulator.extend(time_points[:5], time_course[:5])
+        self.assertEqual(5, len(accumulator))
+        selected = [1, 0, 1, 0, 0, 0, 0, 0, 0]
+        self.assertEqual(['mean', 'Max'], accumulator.generate(selected)[0])
+        self.assertEqual(metricmaker.generate(time_course[:5], time_points[:5], None, None, selected),
+                         accumulator.generate(selected))
+        self.assertRaises(metricmaker.EmptyValueAppended, accumulator.append, 10, None)
+
+    def testStreamingScales(self):
+        "Appending n points does about n times the work of appending one"
+        generator = random.Random(7)
+        walk = [0]
+        for i in xrange(3999):
+            walk.append(walk[-1] + generator.gauss(0, 1))
+        feeds = [lambda i: float(i), lambda i: 0.01*i + generator.random(), lambda i: generator.random(),
+                 lambda i: walk[i], lambda i: round(walk[i], 2), lambda i: generator.randint(0, 9)]
+        for feed in feeds:
+            steps = []
+            for count in (1000, 4000):
+                accumulator = metricmaker.TimeCourseAccumulator(0.1)
+                with metricmaker.profiling() as profile:
+                    for i in xrange(count):
+                        accumulator.append(i, feed(i))
+                steps.append(profile.stages['accumulator.peaks']['iterations'])
+            # 4 times the points, 16 times the work for a tail walked again on every point
+            self.assertTrue(steps[1] < 8*steps[0], steps)
+
     def test_find(self):
         peaks = [1, 0, 1, 0, -1, 0, -1, 0, 1, -1]
         self.assertEqual([0, 2, 8],
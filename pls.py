@@ -0,0 +1,284 @@
+"""Partial least squares regression on metric matrices
+
+ Fits PLS2 models with the NIPALS algorithm, relating a matrix of metrics X (one row per
+ timecourse, e.g. from metricmaker.generate_batch) to a matrix of responses Y with one row
+ per timecourse.
+
+ Components are extracted one at a time, so fitting can stop as soon as a threshold of
+ explained Y variance is reached.  cross_validate estimates the predictive ability of each
+ number of components with k-fold cross-validation, running the folds in parallel.
+"""
+
+__author__ = "Soren Burkhart (soren.burkhart@gmail.com)"
+__version__ = "$Revision: 0.2 $"
+__date__ = "$Date: 2010/02/01 19:40:22 $"
+__copyright__ = "Copyright (c) 2010 Soren Burkhart"
+__license__ = "Python"
+
+import math
+import multiprocessing
+
+import numpy
+
+import metricmaker
+
+class PLSError(metricmaker.MetricMakerError): pass
+
+class PLSModel(object):
+    """
+     A fitted PLS2 model.  With S = number of samples, M = number of X columns, K = number of
+     Y columns and A = number of components:
+
+     weights: (M, A) X weights W
+     x_loadings: (M, A) X loadings P
+     y_loadings: (K, A) Y loadings Q
+     x_scores: (S, A) X scores T
+     y_scores: (S, A) Y scores U
+     coefficients: (M, K) regression coefficients of the scaled data, W (P'W)^-1 Q'
+     x_explained, y_explained: fraction of the X and Y variance explained by each component
+     vip: (M,) variable importance in projection of every X column
+     iterations: NIPALS iterations used by each component
+
+     x_mean, x_scale, y_mean, y_scale: the centring and scaling applied before fitting
+    """
+    def __init__(self, weights, x_loadings, y_loadings, x_scores, y_scores,
+                 x_explained, y_explained, iterations, x_mean, x_scale, y_mean, y_scale):
+        self.weights = weights
+        self.x_loadings = x_loadings
+        self.y_loadings = y_loadings
+        self.x_scores = x_scores
+        self.y_scores = y_scores
+        self.x_explained = x_explained
+        self.y_explained = y_explained
+        self.iterations = iterations
+        self.x_mean = x_mean
+        self.x_scale = x_scale
+        self.y_mean = y_mean
+        self.y_scale = y_scale
+        self.coefficients = self.component_coefficients(self.num_components)
+        self.vip = variable_importance(weights, y_explained)
+
+    @property
+    def num_components(self):
+        return self.weights.shape[1]
+
+    def component_coefficients(self, num_components):
+        "Regression coefficients of the scaled data using the first num_components components"
+        W = self.weights[:, :num_components]
+        P = self.x_loadings[:, :num_components]
+        Q = self.y_loadings[:, :num_components]
+        return numpy.dot(W, numpy.linalg.solve(numpy.dot(P.T, W), Q.T))
+
+    def predict(self, X, num_components=None):
+        """
+         Predicts Y for the rows of X, using the first num_components components (defaults
+         to all of them).
+        """
+        X = as_matrix(X, 'X')
+        if X.shape[1] != len(self.x_mean):
+            raise PLSError, "X has %d columns but the model was fitted on %d." % (X.shape[1], len(self.x_mean))
+        if num_components is None or num_components == self.num_components:
+            coefficients = self.coefficients
+        else:
+            coefficients = self.component_coefficients(num_components)
+        return numpy.dot((X - self.x_mean)/self.x_scale, coefficients)*self.y_scale + self.y_mean
+
+def as_matrix(data, name):
+    "Returns data as a 2-D float64 array, a vector being one column"
+    matrix = numpy.asarray(data, dtype=float)
+    if matrix.ndim == 1:
+        matrix = matrix[:, None]
+    if matrix.ndim != 2:
+        raise PLSError, "%s must be a matrix, got an array of %d dimensions." % (name, matrix.ndim)
+    if not numpy.isfinite(matrix).all():
+        raise PLSError, "%s holds empty or infinite values." % name
+    return matrix
+
+def centre_and_scale(matrix, scale):
+    "Returns (centred matrix, mean, scale); columns without variance are left unscaled"
+    mean = matrix.mean(axis=0)
+    centred = matrix - mean
+    if scale:
+        deviation = centred.std(axis=0, ddof=1) if len(matrix) > 1 else numpy.zeros(matrix.shape[1])
+        deviation[deviation == 0] = 1
+        centred /= deviation
+    else:
+        deviation = numpy.ones(matrix.shape[1])
+    return centred, mean, deviation
+
+def fit(X, Y, num_components=None, explained_variance=None, scale=True, tolerance=1e-10, max_iterations=500):
+    """
+     Fits a PLS2 model with NIPALS.
+     Input format: fit(X, Y, num_components, explained_variance, scale, tolerance, max_iterations)
+
+     X:
+     An (S, M) matrix of metrics, one row per sample.
+
+     Y:
+     An (S, K) matrix (or a vector) of responses for the same samples.
+
+     num_components:
+     Largest number of components to extract, defaults to the rank limit min(S-1, M).
+
+     explained_variance:
+     Stop extracting components once the components so far explain this fraction of the
+     variance of Y (e.g. 0.95).  Defaults to extracting num_components.
+
+     scale:
+     Scale every column of X and Y to unit variance after centring.
+
+     tolerance, max_iterations:
+     Convergence of the NIPALS iterations for each component.  With a single Y column the
+     first iteration is already converged.
+
+     OUTPUT: a PLSModel
+    """
+    X = as_matrix(X, 'X')
+    Y = as_matrix(Y, 'Y')
+    if len(X) != len(Y):
+        raise PLSError, "X has %d samples but Y has %d." % (len(X), len(Y))
+    if len(X) < 2:
+        raise PLSError, "at least 2 samples are needed to fit a model."
+    limit = min(len(X) - 1, X.shape[1])
+    if num_components is None:
+        num_components = limit
+    num_components = min(num_components, limit)
+    if num_components < 1:
+        raise PLSError, "at least 1 component is needed."
+
+    E, x_mean, x_scale = centre_and_scale(X, scale)
+    F, y_mean, y_scale = centre_and_scale(Y, scale)
+    x_total = (E*E).sum()
+    y_total = (F*F).sum()
+    if x_total == 0:
+        raise PLSError, "X has no variance."
+
+    weights, x_loadings, y_loadings, x_scores, y_scores = [], [], [], [], []
+    x_explained, y_explained, iterations = [], [], []
+    while len(weights) < num_components:
+        # start from the Y column with the most variance left
+        u = F[:, numpy.argmax((F*F).sum(axis=0))]
+        for iteration in xrange(1, max_iterations + 1):
+            w = numpy.dot(E.T, u)
+            w_norm = math.sqrt(numpy.dot(w, w))
+            if w_norm == 0:
+                break
+            w /= w_norm
+            t = numpy.dot(E, w)
+            tt = numpy.dot(t, t)
+            q = numpy.dot(F.T, t)/tt
+            u_next = numpy.dot(F, q)/numpy.dot(q, q) if numpy.dot(q, q) else t
+            change = u_next - u
+            u = u_next
+            if numpy.dot(change, change) <= tolerance*tolerance*numpy.dot(u, u):
+                break
+        if w_norm == 0 or tt <= tolerance*tolerance*x_total:
+            # X is exhausted, no further component can be extracted
+            break
+        p = numpy.dot(E.T, t)/tt
+        # rank one deflations, carried out in place
+        E -= numpy.outer(t, p)
+        F -= numpy.outer(t, q)
+
+        weights.append(w)
+        x_loadings.append(p)
+        y_loadings.append(q)
+        x_scores.append(t)
+        y_scores.append(u)
+        iterations.append(iteration)
+        x_explained.append(tt*numpy.dot(p, p)/x_total)
+        y_explained.append(tt*numpy.dot(q, q)/y_total if y_total else 0.0)
+        if explained_variance is not None and sum(y_explained) >= explained_variance:
+            break
+
+    if not weights:
+        raise PLSError, "no component could be extracted from X."
+    return PLSModel(numpy.array(weights).T, numpy.array(x_loadings).T, numpy.array(y_loadings).T,
+                    numpy.array(x_scores).T, numpy.array(y_scores).T,
+                    numpy.array(x_explained), numpy.array(y_explained), iterations,
+                    x_mean, x_scale, y_mean, y_scale)
+
+def variable_importance(weights, y_explained):
+    """
+     VIP scores of the X columns: vip_j = sqrt(M * sum_a(SSY_a * w_ja^2) / sum_a(SSY_a))
+     with SSY_a the Y variance explained by component a.  The weights are unit vectors.
+    """
+    total = y_explained.sum()
+    if total == 0:
+        return numpy.zeros(len(weights))
+    return numpy.sqrt(len(weights) * numpy.dot(weights*weights, y_explained) / total)
+
+def cross_validate(X, Y, folds=7, num_components=None, scale=True, workers=None):
+    """
+     Estimates the predictive ability of 1 to num_components components with k-fold
+     cross-validation.
+     Input format: cross_validate(X, Y, folds, num_components, scale, workers)
+
+     folds:
+     Number of folds.  Sample i is left out in fold i % folds, so samples ordered by time
+     or by group are spread over the folds.
+
+     workers:
+     Number of worker processes fitting the folds, defaults to the number of cpus.  With 1
+     worker the folds are fitted in this process.
+
+     OUTPUT: a dictionary with, for 1 to num_components components:
+     'press': prediction error sum of squares of every Y column, shape (A, K)
+     'q2': 1 - PRESS/SS over all Y columns, shape (A,)
+     'rmsecv': root mean squared cross-validated error of every Y column, shape (A, K)
+     'predictions': the cross-validated predictions, shape (A, S, K)
+     'best': the number of components with the highest q2
+    """
+    X = as_matrix(X, 'X')
+    Y = as_matrix(Y, 'Y')
+    if len(X) != len(Y):
+        raise PLSError, "X has %d samples but Y has %d." % (len(X), len(Y))
+    if not 2 <= folds <= len(X):
+        raise PLSError, "folds must be between 2 and the number of samples (%d)." % len(X)
+    # every training set has len(X) - ceil(len(X)/folds) samples
+    limit = min(len(X) - int(math.ceil(len(X)/float(folds))) - 1, X.shape[1])
+    if num_components is None:
+        num_components = limit
+    num_components = min(num_components, limit)
+    if num_components < 1:
+        raise PLSError, "too few samples for %d folds." % folds
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    jobs = [(X, Y, numpy.arange(fold, len(X), folds), num_components, scale) for fold in xrange(folds)]
+    if workers == 1:
+        finished = map(cross_validation_fold, jobs)
+    else:
+        pool = multiprocessing.Pool(min(workers, folds))
+        try:
+            finished = pool.map(cross_validation_fold, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    predictions = numpy.empty((num_components,) + Y.shape)
+    for job, fold_predictions in zip(jobs, finished):
+        predictions[:, job[2], :] = fold_predictions
+    errors = predictions - Y
+    press = (errors*errors).sum(axis=1)
+    total = ((Y - Y.mean(axis=0))**2).sum()
+    q2 = 1 - press.sum(axis=1)/total if total else numpy.zeros(num_components)
+    return {'press': press,
+            'q2': q2,
+            'rmsecv': numpy.sqrt(press/len(Y)),
+            'predictions': predictions,
+            'best': int(numpy.argmax(q2)) + 1}
+
+def cross_validation_fold(job):
+    """
+     Worker for cross_validate.  Fits the samples outside the fold and returns the predictions
+     for the left out samples with 1 to num_components components, shape (A, left out, K).
+     Components the training set cannot support repeat the last prediction.
+    """
+    X, Y, left_out, num_components, scale = job
+    kept = numpy.ones(len(X), dtype=bool)
+    kept[left_out] = False
+    model = fit(X[kept], Y[kept], num_components, None, scale)
+    predictions = [model.predict(X[left_out], min(components, model.num_components))
+                   for components in xrange(1, num_components + 1)]
+    return numpy.array(predictions)
@@ -0,0 +1,68 @@
+"""Unit test for partial least squares regression"""
+
+import numpy
+import pls
+import unittest
+
+class PLSTests(unittest.TestCase):
+    def setUp(self):
+        generator = numpy.random.RandomState(1)
+        self.X = generator.normal(size=(60, 8))
+        self.Y = numpy.dot(self.X, generator.normal(size=(8, 3))) + generator.normal(0, 0.1, (60, 3))
+
+    def testFit(self):
+        model = pls.fit(self.X, self.Y)
+        self.assertEqual(8, model.num_components)
+        self.assertEqual((8, 8), model.weights.shape)
+        self.assertEqual((3, 8), model.y_loadings.shape)
+        self.assertEqual((60, 8), model.x_scores.shape)
+        # the scores are orthogonal
+        scores = numpy.dot(model.x_scores.T, model.x_scores)
+        self.assertTrue(abs(scores - numpy.diag(numpy.diag(scores))).max() < 1e-8)
+        # with every component the model is the least squares fit
+        X = numpy.hstack([self.X, numpy.ones((60, 1))])
+        least_squares = numpy.dot(X, numpy.linalg.lstsq(X, self.Y, rcond=None)[0])
+        self.assertTrue(abs(model.predict(self.X) - least_squares).max() < 1e-8)
+        self.assertAlmostEqual(1.0, model.x_explained.sum())
+        self.assertAlmostEqual(8.0, (model.vip**2).sum())
+
+    def testEarlyStop(self):
+        model = pls.fit(self.X, self.Y, explained_variance=0.9)
+        self.assertEqual(3, model.num_components)
+        self.assertTrue(model.y_explained.sum() >= 0.9)
+        self.assertTrue(model.y_explained[:2].sum() < 0.9)
+        self.assertEqual(2, pls.fit(self.X, self.Y, 2).num_components)
+        full = pls.fit(self.X, self.Y)
+        self.assertTrue(abs(full.predict(self.X, 3) - model.predict(self.X)).max() < 1e-8)
+
+    def testSingleResponse(self):
+        y = self.X[:, 0]*2 + self.X[:, 1]
+        model = pls.fit(self.X, y, 1)
+        self.assertEqual([2], model.iterations)
+        self.assertEqual((60, 1), model.predict(self.X).shape)
+        self.assertEqual([0, 1], sorted(numpy.argsort(model.vip)[-2:]))
+
+    def testErrors(self):
+        self.assertRaises(pls.PLSError, pls.fit, self.X, self.Y[:10])
+        X = self.X.copy()
+        X[3, 3] = numpy.nan
+        self.assertRaises(pls.PLSError, pls.fit, X, self.Y)
+        self.assertRaises(pls.PLSError, pls.fit, numpy.ones((5, 2)), self.Y[:5])
+        self.assertRaises(pls.PLSError, pls.fit(self.X, self.Y).predict, self.X[:, :3])
+
+    def testCrossValidate(self):
+        serial = pls.cross_validate(self.X, self.Y, 5, workers=1)
+        parallel = pls.cross_validate(self.X, self.Y, 5, workers=2)
+        self.assertEqual((8, 3), serial['press'].shape)
+        self.assertEqual((8, 60, 3), serial['predictions'].shape)
+        self.assertTrue(abs(serial['press'] - parallel['press']).max() < 1e-10)
+        self.assertTrue(serial['q2'][-1] > 0.99)
+        self.assertEqual(int(numpy.argmax(serial['q2'])) + 1, serial['best'])
+        # fold 0 leaves out samples 0, 5, 10, ...
+        kept = numpy.arange(60) % 5 != 0
+        model = pls.fit(self.X[kept], self.Y[kept], 2)
+        self.assertTrue(abs(model.predict(self.X[~kept]) - serial['predictions'][1][~kept]).max() < 1e-10)
+        self.assertRaises(pls.PLSError, pls.cross_validate, self.X, self.Y, 1)
+
+if __name__ == "__main__":
+    unittest.main()